@@ -5,10 +5,8 @@ from shapely.geometry import Polygon, box
 import os
 import geemap
 import json
-import multiprocessing
 import pandas as pd
-import math
-from src import utils_download_images
+from src import utils_download_images, utils_download_metrics, utils_download_scheduler, utils_entity_resolution, utils_state_index
 
 def convert_to_geodf(df):
     """
@@ -23,9 +21,14 @@ def convert_to_geodf(df):
     gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs="EPSG:4326")
     return gdf
 
-def main():
+def main(num_workers=4, max_in_flight=16, facilities_path=None):
     """
-    Reads input data consisting of candidate wwtp names and their coordinates and downloads them using google Earth Engine using parallel processing with four processes to speed up the download.
+    Reads input data consisting of candidate wwtp names and their coordinates and downloads them using google Earth Engine. The download tasks of all states are put into a single queue that is drained by parallel worker processes, each keeping several requests in flight, to speed up the download.
+    
+    Args:
+    num_workers: number of parallel worker processes
+    max_in_flight: maximum number of concurrent Earth Engine requests per worker process, the number in flight adapts to throttling
+    facilities_path: optional path of the canonical facilities written by utils_entity_resolution, downloaded instead of the combined hydrowaste and epa list so every plant is downloaded once
     """
     # Authenticate and initialize earth engine project
     # How to authenticate: https://developers.google.com/earth-engine/guides/python_install#authentication
@@ -33,50 +36,60 @@ def main():
     ee.Initialize(project='earth-engine-project-400411')
 
     # Read input data with candidate wwtp names and their coordinates
-    df = utils_download_images.read_df()
+    if facilities_path is not None:
+        df = utils_entity_resolution.read_facilities(facilities_path)
+    else:
+        df = utils_download_images.read_df()
+
+    # Assign the states from the coordinates the same way as for the other sources, keeping the given state outside the boundaries
+    states = utils_state_index.assign_states(df["lon"], df["lat"])["state"]
+    df["state"] = pd.Series(states.to_numpy(), index=df.index).fillna(df["state"])
+
+    # Plants outside all state boundaries without a given state (e.g. just off the coast) are downloaded into the nearest state
+    missing = df["state"].isna()
+    if missing.any():
+        nearest = utils_state_index.assign_states(df.loc[missing, "lon"], df.loc[missing, "lat"], nearest=True)["state"]
+        df.loc[missing, "state"] = nearest.to_numpy()
+        print("Assigned the nearest state to plants outside all states: ", missing.sum())
+        if df["state"].isna().any():
+            print("Skipped plants without coordinates: ", df["state"].isna().sum())
 
     # Get list of state names
-    names = list(set(df["state"]))
+    names = list(set(df["state"].dropna()))
     # names.remove("California")
     # names.remove("Texas")
 
+    tasks = []
     for name in names:
 
-        print("NAME START: ", name)
-
         # Filter dataframe based on state name
         t_df = df[df["state"] == name]
 
         # Convert dataframe to geopandas dataframe
         gdf = convert_to_geodf(t_df)
 
-        print(gdf.head())
-        print("LENGTH: ", len(gdf))
+        print(name, "LENGTH: ", len(gdf))
 
-        # Create variable to help divide the dataframe into four
-        a = math.ceil(len(gdf)/4)
+        # Add the download tasks of the state to the shared list
+        tasks += utils_download_images.plant_tasks(gdf, name, False)
 
-        # Create four processes and assign the dowload_images function to them
-        p1 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[0:a], name, False)) 
-        p2 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[a:2*a], name, False)) 
-        p3 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[2*a:3*a], name, False))
-        p4 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[3*a:], name, False))
+    print("TOTAL: ", len(tasks))
 
-        # Start processes
-        p1.start() 
-        p2.start() 
-        p3.start()
-        p4.start()
+    # Drain the queue of all states with the worker processes
+    run_id = utils_download_scheduler.run_download_queue(tasks, "hw_epa", num_workers, max_in_flight)
 
-        # Wait for processes to finish
-        p1.join() 
-        p2.join()
-        p3.join()
-        p4.join()
+    print("DOWNLOAD END")
 
-        print("NAME END: ", name)
-
-    # download_images(geodf)
+    # Print the throughput, time per phase and the slowest states and plants of the run
+    utils_download_metrics.print_summary(run_id=run_id)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Download the images of the hydrowaste and epa WWTPs from Earth Engine")
+    parser.add_argument("--facilities", nargs="?", const=utils_entity_resolution.FACILITIES_PATH, default=None, help="download the canonical facilities written by python -m src.utils_entity_resolution (default path if no path is given) instead of the combined hydrowaste and epa list")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--in-flight", type=int, default=16, help="maximum number of concurrent requests per worker process")
+    args = parser.parse_args()
+
+    main(args.workers, args.in_flight, args.facilities)
\ No newline at end of file
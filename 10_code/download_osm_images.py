@@ -1,81 +1,100 @@
-import overpy
 import geopandas as gpd
 import ee
 from shapely.geometry import Polygon, box
 import os
 import geemap
 import json
-import multiprocessing
+import numpy as np
 import pandas as pd
-import math
-from src import utils_download_images
+from src import utils_download_images, utils_download_metrics, utils_download_scheduler, utils_overpass
 
 
-# Initialize OpenStreetMap (OSM) api
-api = overpy.Overpass()
-
-def get_data(name):
+def get_data(name, ways=None):
     """
-    Gets wastewater plants and their coordinates from OSM
+    Gets wastewater plants and their coordinates from OSM. The Overpass response is cached on disk, so reruns don't query OSM again.
     
     Args:
     name: name of state
+    ways: arrays of the state from utils_overpass.fetch_state, queried if None
     
     Returns:
-    plants: dictionary of plant names and a corresponding list of bounding box coordinates
-    structure: {plant_name: [(longitude1, latitude1), (longitude2, latitude2), ...]}
+    ways: dictionary of numpy arrays of OSM way ids, plant names and the node coordinates of all plants
+    structure: {"id": way ids, "name": plant names, "coords": (n, 2) array of (longitude, latitude) of all nodes, "offsets": start of every plant in coords followed by the total number of nodes}
     """ 
-    # Define OSM query of all wastewater plants within state
-    query = f"""
-        area[admin_level=4]["name"="{name}"]->.searchArea;
-        (
-        way["man_made"="wastewater_plant"](area.searchArea);
-        );
-        (._;>;);
-        out body;
-        """
+    if ways is None:
+        ways = utils_overpass.fetch_state(name)
 
-    # Call OSM api with query to get result
-    result = api.query(query)
+    # Use the name of the plant or its ID if the name is not available
+    names = np.array(
+        [way_name if way_name is not None else f"Plant_{way_id}" for way_id, way_name in zip(ways["id"], ways["name"])],
+        dtype=object,
+    )
 
-    plants = {}
+    return {**ways, "name": names}
 
-    for way in result.ways:
-        # Use the name of the plant or its ID if the name is not available
-        plant_name = way.tags.get("name", f"Plant_{way.id}")
+def convert_to_geodf(ways):
+    """
+    Converts data from OSM into a geopandas dataframe. All polygons are built at once from the flat coordinate arrays.
+    
+    Args:
+    ways: dictionary of flat arrays from get_data
+    
+    Returns:
+    gdf: geopandas dataframe with centroid and bounding box of the plants from OSM
+    """   
+    # Converts the node coordinates of all plants into Polygon objects
+    ways, geoms = utils_overpass.ways_to_polygons(ways)
+    # Converts OSM data with bounding box Polygon into geopandas dataframe
+    gdf = gpd.GeoDataFrame({'osm_id': ways["id"], 'WWTP_name': ways["name"], 'geometry': geoms}, crs="EPSG:4326")
+
+    return add_plant_columns(gdf)
 
-        # Extract latitude and longitude of nodes of bounding box
-        nodes_coords = [(node.lon, node.lat) for node in way.nodes]
+def add_plant_columns(gdf):
+    """
+    Adds the centroid and bounding box of the plant polygons to a geopandas dataframe, and makes the plant names unique
+    
+    Args:
+    gdf: geopandas dataframe with columns osm_id, WWTP_name and plant polygons in "EPSG:4326"
+    
+    Returns:
+    gdf: geopandas dataframe with additional columns centroid, minx, miny, maxx and maxy
+    """
+    # The images are named after the plants, so plants sharing a name get their id appended
+    duplicated = gdf["WWTP_name"].duplicated(keep=False)
+    gdf.loc[duplicated, "WWTP_name"] = gdf.loc[duplicated, "WWTP_name"] + "_" + gdf.loc[duplicated, "osm_id"].astype(str)
 
-        # Convert coordinates into float
-        nodes_coords = [tuple(map(float, i)) for i in nodes_coords]
+    # Gets centroid of Polygon object in the '+proj=cea' projection to account for the curvature of the earth
+    lon, lat = utils_overpass.equal_area_centroids(gdf.geometry.values)
+    gdf["centroid"] = gpd.GeoSeries.from_xy(lon, lat, index=gdf.index, crs="EPSG:4326")
 
-        plants[plant_name] = nodes_coords
+    # Bounding box of every plant
+    gdf[["minx", "miny", "maxx", "maxy"]] = gdf.geometry.bounds
 
-    return plants
+    return gdf
 
-def convert_to_geodf(plants):
+def get_data_tiled(name, tile_size=1.0):
     """
-    Converts data from OSM into a geopandas dataframe
+    Gets wastewater plants of a state from OSM tile by tile into a GeoParquet file, for large states whose single query would time out. Plants are keyed by their OSM way id, so plants sharing a name are all kept.
     
     Args:
-    plants: data dictionary from downloaded from OSM api
+    name: name of state
+    tile_size: width and height of the tiles in degrees
     
     Returns:
-    gdf: geopandas dataframe with centroid of bounding box from OSM
-    """   
-    # Converts list of node coordinates into Polygon object
-    geoms = [Polygon(plants[key]) for key in plants]
-    # Converts OSM data with bounding box Polygon into geopandas dataframe
-    gdf = gpd.GeoDataFrame({'WWTP_name': list(plants.keys()), 'geometry': geoms}, crs="EPSG:4326")
-    # Gets centroid of Polygon object, by projecting first to '+proj=cea', then back to "EPSG:4326" to account for the curvature of the earth
-    gdf["centroid"] = gdf.to_crs('+proj=cea').centroid.to_crs(epsg=4326)
+    gdf: geopandas dataframe with columns osm_id, WWTP_name, geometry, centroid and bounding box
+    """
+    gdf = utils_overpass.read_state_parquet(utils_overpass.write_state_parquet(name, tile_size=tile_size))
 
-    return gdf
+    return add_plant_columns(gdf)
 
-def main():
+def main(num_workers=4, max_in_flight=16, tiled=False):
     """
-    Gets data consisting of wwtp names and their bounding box coordinates from OSM and downloads them using google Earth Engine using parallel processing with four processes to speed up the download.
+    Gets data consisting of wwtp names and their bounding box coordinates from OSM and downloads them using google Earth Engine. The download tasks of all states are put into a single queue that is drained by parallel worker processes, each keeping several requests in flight, to speed up the download.
+    
+    Args:
+    num_workers: number of parallel worker processes
+    max_in_flight: maximum number of concurrent Earth Engine requests per worker process, the number in flight adapts to throttling
+    tiled: if True, query OSM in bounding box tiles and store the plants of every state as GeoParquet, for large states
     """
     # Authenticate and initialize earth engine project
     # How to authenticate: https://developers.google.com/earth-engine/guides/python_install#authentication
@@ -85,43 +104,37 @@ def main():
     # Create list of required state names
     names = ["Alaska", "Hawaii"]
 
-    for name in names:
+    # Get data of all states from OSM, with a few concurrent queries and cached responses
+    states = {} if tiled else utils_overpass.fetch_states(names)
 
-        print("NAME START: ", name)
+    tasks = []
+    for name in names:
 
-        # Get data from OSM
-        plants = get_data(name)
+        if tiled:
+            # Get data from OSM tile by tile as geopandas dataframe with centroid of bounding box
+            gdf = get_data_tiled(name)
+        else:
+            # Get data from OSM
+            ways = get_data(name, states[name])
 
-        # Convert data to geopandas dataframe with centroid of bounding box
-        gdf = convert_to_geodf(plants)
+            # Convert data to geopandas dataframe with centroid of bounding box
+            gdf = convert_to_geodf(ways)
 
         print(gdf.head())
-        print("LENGTH: ", len(gdf))
-
-        # Create variable to help divide the dataframe into four
-        a = math.ceil(len(gdf)/4)
+        print(name, "LENGTH: ", len(gdf))
 
-        # Create four processes and assign the dowload_images function to them
-        p1 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[0:a], name, True)) 
-        p2 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[a:2*a], name, True)) 
-        p3 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[2*a:3*a], name, True))
-        p4 = multiprocessing.Process(target=utils_download_images.download_images, args=(gdf[3*a:], name, True))
+        # Add the download tasks of the state to the shared list
+        tasks += utils_download_images.plant_tasks(gdf, name, True)
 
-        # Start processes
-        p1.start() 
-        p2.start() 
-        p3.start()
-        p4.start()
+    print("TOTAL: ", len(tasks))
 
-        # Wait for processes to finish
-        p1.join() 
-        p2.join()
-        p3.join()
-        p4.join()
+    # Drain the queue of all states with the worker processes
+    run_id = utils_download_scheduler.run_download_queue(tasks, "osm", num_workers, max_in_flight)
 
-        print("NAME END: ", name)
+    print("DOWNLOAD END")
 
-    # download_images(geodf)
+    # Print the throughput, time per phase and the slowest states and plants of the run
+    utils_download_metrics.print_summary(run_id=run_id)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
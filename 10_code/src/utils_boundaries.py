@@ -0,0 +1,110 @@
+import functools
+import os
+from src import utils_cache
+
+# The national boundary layers are stored once next to the source data
+BOUNDARY_DIRECTORY = "../00_source_data/boundaries"
+
+# Census cartographic boundary files of the national layers, and the FIPS column keying their rows
+LAYERS = {
+    "state": ("https://www2.census.gov/geo/tiger/GENZ2021/shp/cb_2021_us_state_5m.zip", "STATEFP"),
+    "county": ("https://www2.census.gov/geo/tiger/GENZ2021/shp/cb_2021_us_county_5m.zip", "GEOID"),
+    "place": ("https://www2.census.gov/geo/tiger/GENZ2021/shp/cb_2021_us_place_500k.zip", "GEOID"),
+}
+
+# Rows per row group of the stored layers. The rows are sorted by state FIPS code, so reading one state only touches its row groups.
+ROW_GROUP_SIZE = 256
+
+def layer_path(layer, directory=BOUNDARY_DIRECTORY):
+    """
+    Returns the path of the stored GeoParquet file of a layer
+    """
+    return os.path.join(directory, f"{layer}.parquet")
+
+def ingest_layer(layer, source=None, directory=BOUNDARY_DIRECTORY):
+    """
+    Reads a national boundary layer once, reprojects it to "EPSG:4326" and stores it as GeoParquet sorted by FIPS code, with a bounding box column for spatial filtering. The file is written under a temporary name and renamed once complete.
+
+    Args:
+    layer: "state", "county" or "place"
+    source: path or URL of the layer, the Census file of LAYERS if None
+    directory: directory of the stored layers
+
+    Returns:
+    path: path of the stored GeoParquet file
+    """
+    import geopandas as gpd
+
+    url, key = LAYERS[layer]
+    boundaries = gpd.read_file(source or url).to_crs(epsg=4326)
+    boundaries = boundaries.sort_values(["STATEFP", key]).reset_index(drop=True)
+
+    os.makedirs(directory, exist_ok=True)
+    path = layer_path(layer, directory)
+    part_path = f"{path}.{os.getpid()}.part"
+    boundaries.to_parquet(part_path, index=False, row_group_size=ROW_GROUP_SIZE, write_covering_bbox=True)
+    os.replace(part_path, path)
+    _read_layer.cache_clear()
+    return path
+
+@functools.lru_cache(maxsize=None)
+def _read_layer(layer, statefp, crs, directory):
+    # Reads and reprojects a layer once per process, ingesting it on first use
+    import geopandas as gpd
+
+    path = layer_path(layer, directory)
+    if not os.path.exists(path):
+        ingest_layer(layer, directory=directory)
+    filters = None if statefp is None else [("STATEFP", "==", statefp)]
+    boundaries = gpd.read_parquet(path, filters=filters)
+    if crs is not None:
+        boundaries = boundaries.to_crs(crs)
+    return boundaries
+
+def state_fips(state, directory=BOUNDARY_DIRECTORY):
+    """
+    Returns the FIPS code of a state given by name, abbreviation or FIPS code
+
+    Args:
+    state: state name (e.g. "California"), abbreviation (e.g. "CA") or FIPS code (e.g. "06")
+    directory: directory of the stored layers
+
+    Returns:
+    statefp: two-digit FIPS code
+    """
+    states = _read_layer("state", None, None, directory)
+    match = states[(states["NAME"] == state) | (states["STUSPS"] == state) | (states["STATEFP"] == state)]
+    if match.empty:
+        raise ValueError(f"Unknown state: {state}")
+    return match["STATEFP"].iloc[0]
+
+def read_layer(layer, state=None, crs="EPSG:4326", directory=BOUNDARY_DIRECTORY):
+    """
+    Returns the boundaries of a layer, optionally only those of one state, from the local store. Results are memoized per layer, state and coordinate reference system, so repeated calls take milliseconds; a copy is returned, so callers can modify it.
+
+    Args:
+    layer: "state", "county" or "place"
+    state: state name, abbreviation or FIPS code, all states if None
+    crs: coordinate reference system of the result
+    directory: directory of the stored layers
+
+    Returns:
+    boundaries: geodataframe with the Census columns of the layer (e.g. STATEFP, GEOID, NAME)
+    """
+    statefp = None if state is None else state_fips(state, directory)
+    return _read_layer(layer, statefp, crs, directory).copy()
+
+@utils_cache.cached_reader("path")
+def read_boundary_file(path):
+    """
+    Reads a local boundary file (e.g. the place or MCD shapefile of a state) reprojected to "EPSG:4326". The result is cached as GeoParquet, so the shapefile is only read and reprojected once.
+
+    Args:
+    path: path of the boundary file
+
+    Returns:
+    boundaries: geodataframe in "EPSG:4326"
+    """
+    import geopandas as gpd
+
+    return gpd.read_file(path).to_crs(epsg=4326)
@@ -0,0 +1,140 @@
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import pandas as pd
+
+# The cleaned results of the readers are cached next to the source data
+CACHE_DIRECTORY = "../00_source_data/reader_cache"
+
+def is_url(path):
+    """
+    Checks whether a source path is a URL rather than a local file
+    """
+    return "://" in str(path)
+
+def source_signature(path):
+    """
+    Describes the state of a source file by its path, modification time and size. Files sharing its name with another extension (e.g. the .dbf of a shapefile) are included, and for a directory (e.g. a File Geodatabase) all files within it. A URL is described by itself only, so its cached result is kept until it is removed.
+
+    Args:
+    path: path of the source file or directory, or URL
+
+    Returns:
+    signature: list of tuples (path, modification time in ns, size)
+    """
+    if is_url(path):
+        return [(path, None, None)]
+
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        filenames = [os.path.join(root, f) for root, _, files in os.walk(path) for f in files]
+    else:
+        filenames = glob.glob(glob.escape(os.path.splitext(path)[0]) + ".*") or [path]
+
+    signature = []
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        signature.append((filename, stat.st_mtime_ns, stat.st_size))
+    return signature
+
+def cache_key(name, sources, params):
+    """
+    Builds the cache file prefix and key of a reader call. The prefix identifies the reader and its source paths, the key also changes whenever a source file or a parameter changes.
+
+    Args:
+    name: name of the reader
+    sources: list of paths of the source files
+    params: dictionary of the other parameters of the call
+
+    Returns:
+    prefix: file name prefix shared by all cached versions of the same reader and sources
+    key: file name of the cached result without extension
+    """
+    paths = "|".join(path if is_url(path) else os.path.abspath(path) for path in sources)
+    prefix = f"{name}-{hashlib.sha1(paths.encode()).hexdigest()[:8]}"
+    state = repr(([source_signature(path) for path in sources], sorted(params.items())))
+    return prefix, f"{prefix}-{hashlib.sha1(state.encode()).hexdigest()[:16]}"
+
+def write_cache(result, filename_stem):
+    """
+    Writes a reader result in a columnar format: GeoParquet for geodataframes, Feather for dataframes with a default index and Parquet for other dataframes. The file is written under a temporary name and renamed once complete.
+
+    Args:
+    result: pandas or geopandas dataframe
+    filename_stem: path of the cached file without extension
+
+    Returns:
+    filename: path of the cached file
+    """
+    import geopandas as gpd
+
+    if isinstance(result, gpd.GeoDataFrame):
+        filename = filename_stem + ".geo.parquet"
+        write = result.to_parquet
+    elif isinstance(result.index, pd.RangeIndex) and result.index.start == 0 and result.index.step == 1:
+        filename = filename_stem + ".feather"
+        write = result.to_feather
+    else:
+        filename = filename_stem + ".parquet"
+        write = result.to_parquet
+
+    part_filename = f"{filename}.{os.getpid()}.part"
+    write(part_filename)
+    os.replace(part_filename, filename)
+    return filename
+
+def read_cache(filename):
+    """
+    Reads a result written by write_cache
+    """
+    import geopandas as gpd
+
+    if filename.endswith(".geo.parquet"):
+        return gpd.read_parquet(filename)
+    if filename.endswith(".feather"):
+        return pd.read_feather(filename)
+    return pd.read_parquet(filename)
+
+def cached_reader(*source_params):
+    """
+    Decorator caching the cleaned result of a reader of source data. The first call materializes the result as a columnar file, later calls with the same parameters load that file instead of parsing the source again. The key combines path, modification time and size of the source files with the other parameters, so a changed source file or parameter reads the source again and replaces the stale cached versions. The decorated reader takes an additional use_cache argument to bypass the cache.
+
+    Args:
+    source_params: names of the reader parameters holding paths of source files
+
+    Returns:
+    decorator: function wrapping a reader returning a pandas or geopandas dataframe
+    """
+    def decorator(reader):
+        signature = inspect.signature(reader)
+
+        @functools.wraps(reader)
+        def wrapper(*args, use_cache=True, **kwargs):
+            if not use_cache:
+                return reader(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            sources = [bound.arguments[param] for param in source_params]
+            params = {k: v for k, v in bound.arguments.items() if k not in source_params}
+            prefix, key = cache_key(reader.__name__, sources, params)
+
+            cached = glob.glob(os.path.join(CACHE_DIRECTORY, glob.escape(key) + ".*"))
+            cached = [filename for filename in cached if not filename.endswith(".part")]
+            if cached:
+                return read_cache(cached[0])
+
+            result = reader(*args, **kwargs)
+
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            # Remove the stale versions of the same reader and sources before writing the new one
+            for stale in glob.glob(os.path.join(CACHE_DIRECTORY, glob.escape(prefix) + "-*")):
+                os.remove(stale)
+            write_cache(result, os.path.join(CACHE_DIRECTORY, key))
+            return result
+
+        return wrapper
+
+    return decorator
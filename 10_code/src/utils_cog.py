@@ -0,0 +1,169 @@
+import concurrent.futures
+import functools
+import glob
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+# Creation options of the cloud optimized GeoTIFFs: 512x512 internal tiles, lossless compression and overviews
+COG_OPTIONS = {
+    "COMPRESS": "DEFLATE",
+    "PREDICTOR": "2",
+    "BLOCKSIZE": "512",
+    "OVERVIEWS": "AUTO",
+    "OVERVIEW_RESAMPLING": "AVERAGE",
+}
+
+def is_cog(filename):
+    """
+    Checks whether a GeoTIFF is already tiled, compressed and has overviews
+
+    Input:
+    - filename: path of the .tif file
+
+    Output:
+    - True if the file is a cloud optimized GeoTIFF
+    """
+    with rasterio.open(filename) as src:
+        return (
+            src.profile.get("tiled", False)
+            and src.compression is not None
+            and len(src.overviews(1)) > 0
+        )
+
+def convert_to_cog(filename, output_filename=None):
+    """
+    Converts a GeoTIFF to a cloud optimized GeoTIFF with internal tiling, lossless compression and overviews. The converted file is written next to the output first and renamed once complete, so the conversion can be done in place.
+
+    Input:
+    - filename: path of the .tif file
+    - output_filename: path of the converted file, the input is replaced if None
+
+    Output:
+    - output_filename: path of the converted file
+    """
+    if output_filename is None:
+        output_filename = filename
+
+    part_filename = output_filename + ".cog.part"
+    rasterio.shutil.copy(filename, part_filename, driver="COG", **COG_OPTIONS)
+    os.replace(part_filename, output_filename)
+    return output_filename
+
+def _convert_if_needed(filename):
+    """
+    Converts a file to a cloud optimized GeoTIFF unless it already is one
+
+    Output:
+    - True if the file was converted
+    """
+    if is_cog(filename):
+        return False
+    convert_to_cog(filename)
+    return True
+
+def convert_directory(directory, num_workers=4):
+    """
+    Converts all existing images of the WWTP_Images/{state} directories to cloud optimized GeoTIFFs in place, in parallel. Files that are already converted are skipped, so the conversion can be interrupted and restarted.
+
+    Input:
+    - directory: path of the image directory, e.g. "../00_source_data/WWTP_Images"
+    - num_workers: number of worker processes
+
+    Output:
+    - num_converted: number of converted files
+    """
+    filenames = sorted(
+        glob.glob(os.path.join(directory, "*.tif")) + glob.glob(os.path.join(directory, "*", "*.tif"))
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        converted = list(executor.map(_convert_if_needed, filenames, chunksize=16))
+    print(f"Converted {sum(converted)} of {len(filenames)} images in {directory}")
+    return sum(converted)
+
+def read_center_crop(filename, crop_size):
+    """
+    Reads only the center window of an image, e.g. for training with center crops
+
+    Input:
+    - filename: path of the .tif file
+    - crop_size: width and height of the window in pixels
+
+    Output:
+    - img: numpy array of shape (crop_size, crop_size, bands), padded with 0 if the image is smaller
+    """
+    with rasterio.open(filename) as src:
+        window = Window(
+            (src.width - crop_size) // 2, (src.height - crop_size) // 2, crop_size, crop_size
+        )
+        img = src.read(window=window, boundless=True, fill_value=0)
+    return np.moveaxis(img, 0, -1)
+
+def read_thumbnail(filename, max_size=512, bands=(1, 2, 3)):
+    """
+    Reads a downsampled version of an image whose longest side is at most max_size pixels. For cloud optimized GeoTIFFs the read is served from the closest overview instead of the full resolution data.
+
+    Input:
+    - filename: path of the .tif file
+    - max_size: maximum width and height of the thumbnail in pixels
+    - bands: bands to read
+
+    Output:
+    - img: numpy array of shape (bands, height, width)
+    - transform: affine transform of the thumbnail, to plot it in map coordinates
+    """
+    with rasterio.open(filename) as src:
+        factor = max(1.0, max(src.width, src.height) / max_size)
+        out_shape = (len(bands), int(src.height / factor), int(src.width / factor))
+        img = src.read(list(bands), out_shape=out_shape, resampling=Resampling.average)
+        transform = src.transform * src.transform.scale(src.width / out_shape[2], src.height / out_shape[1])
+    return img, transform
+
+def load_center_crop(path, crop_size):
+    """
+    Loads the center crop of an image as a PIL image
+
+    Input:
+    - path: path of the .tif file
+    - crop_size: width and height of the center crop in pixels
+
+    Output:
+    - img: RGB PIL image
+    """
+    from PIL import Image
+
+    img = read_center_crop(path, crop_size)
+    # The first three bands are used as RGB, images with fewer bands are read as grayscale like the default loader does
+    img = img[:, :, :3] if img.shape[2] >= 3 else img[:, :, 0]
+    return Image.fromarray(img).convert("RGB")
+
+def center_crop_loader(crop_size):
+    """
+    Returns an image loader for torchvision's ImageFolder that reads only the center crop of every image instead of the whole raster. The loader can be pickled, so it also works with DataLoader worker processes.
+
+    Input:
+    - crop_size: width and height of the center crop in pixels
+
+    Output:
+    - loader: function returning a PIL image from a file path
+    """
+    return functools.partial(load_center_crop, crop_size=crop_size)
+
+def main():
+    """
+    Converts the existing image directories to cloud optimized GeoTIFFs from the command line
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert downloaded WWTP images to cloud optimized GeoTIFFs")
+    parser.add_argument("directory", nargs="?", default="../00_source_data/WWTP_Images", help="image directory with one subdirectory per state")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    args = parser.parse_args()
+
+    convert_directory(args.directory, args.workers)
+
+if __name__ == "__main__":
+    main()
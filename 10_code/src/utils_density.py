@@ -0,0 +1,52 @@
+import numpy as np
+
+# Opacity of the bins with the fewest points, so single plants stay visible next to dense areas
+MIN_ALPHA = 0.25
+
+def density_grid(lon, lat, extent, shape):
+    """
+    Counts the points in the bins of a regular grid in one vectorized pass. Points outside the extent or with missing coordinates are left out.
+
+    Args:
+    lon: array-like of longitudes
+    lat: array-like of latitudes
+    extent: tuple (xmin, xmax, ymin, ymax) of the grid
+    shape: tuple (rows, columns) of the grid
+
+    Returns:
+    counts: numpy array of shape (rows, columns) with the number of points of every bin, the first row is the southernmost
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    xmin, xmax, ymin, ymax = extent
+    rows, cols = shape
+
+    inside = (lon >= xmin) & (lon < xmax) & (lat >= ymin) & (lat < ymax)
+    col = ((lon[inside] - xmin) / (xmax - xmin) * cols).astype(np.int64)
+    row = ((lat[inside] - ymin) / (ymax - ymin) * rows).astype(np.int64)
+    return np.bincount(row * cols + col, minlength=rows * cols).reshape(rows, cols)
+
+def density_image(grids, colors):
+    """
+    Composes the density grids of several sources into one RGBA image, one color channel per source. The intensity of a source in a bin grows with the logarithm of its count; bins with several sources mix their colors by intensity, and the opacity follows the strongest source.
+
+    Args:
+    grids: list of numpy arrays from density_grid
+    colors: list of matplotlib colors, one per grid
+
+    Returns:
+    image: numpy array of shape (rows, columns, 4) with RGBA values between 0 and 1, transparent where there are no points
+    """
+    import matplotlib.colors
+
+    intensities = np.stack(
+        [np.log1p(grid) / np.log1p(grid.max()) if grid.max() > 0 else np.zeros(grid.shape) for grid in grids]
+    )
+    rgb = np.array([matplotlib.colors.to_rgb(color) for color in colors])
+
+    total = intensities.sum(axis=0)
+    image = np.zeros(intensities.shape[1:] + (4,))
+    image[..., :3] = np.einsum("kij,kc->ijc", intensities, rgb) / np.maximum(total, 1e-12)[..., None]
+    strongest = intensities.max(axis=0)
+    image[..., 3] = np.where(strongest > 0, MIN_ALPHA + (1 - MIN_ALPHA) * strongest, 0)
+    return image
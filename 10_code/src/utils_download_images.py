@@ -8,15 +8,22 @@ import json
 import multiprocessing
 import pandas as pd
 import math
+import functools
+import time
+from src import utils_cache, utils_cog, utils_download_metrics
 
-def read_df():
+@utils_cache.cached_reader("path")
+def read_df(path="../00_source_data/combined_epa_hw_WWTP.csv"):
     """
-    Read input data consisting of list of candidate wwtp names and coordinates from hydrowaste and epa
+    Read input data consisting of list of candidate wwtp names and coordinates from hydrowaste and epa. The result is cached as a Feather file until the .csv file changes.
+    
+    Args:
+    path: path of the .csv file
     
     Returns:
     df: pandas dataframe consisting of list of candidate wwtp names and coordinates from hydrowaste and epa
     """     
-    df = pd.read_csv("../00_source_data/combined_epa_hw_WWTP.csv")
+    df = pd.read_csv(path)
 
     return df
 
@@ -29,68 +36,170 @@ def write_data_to_csv(df):
     """   
     df.to_csv("../00_source_data/wwtps.csv")
 
-def download_images(df, name, is_osm):
+def image_path(name, wwtp_name):
     """
-    Downloads images of WWTPs of type .tif from Earth Engine. It uses either the coordinates given or the centroid coordinates to define a square area around the coordinates of distance 0.02 longitude and latitude units.
+    Returns the path of the downloaded image of a WWTP
+    
+    Args:
+    name: name of state
+    wwtp_name: name of the wwtp
+    
+    Returns:
+    filename: path of the .tif file
+    """
+    return os.path.join(f"../00_source_data/WWTP_Images/{name}", f"{wwtp_name}.tif")
+
+def plant_tasks(df, name, is_osm):
+    """
+    Builds the list of download tasks for the WWTPs of a state. Each task holds everything a worker needs to download one image, so tasks from different states can be mixed in a single queue.
     
     Args:
     df: pandas dataframe with wwtp name and coordinates
     name: name of state
     is_osm: True if the data is from OSM (uses centroid of bounding box), False if the data is from hydrowaste and epa (uses given coordinates)
-    """   
-    # Define directory to store downloaded images
-    downloaded_directory = f"../00_source_data/WWTP_Images/{name}"
+    
+    Returns:
+    tasks: list of tuples (state name, wwtp name, center longitude, center latitude)
+    """
+    # OSM dataframes name the column WWTP_name, hydrowaste and epa use wwtp_name
+    name_column = "wwtp_name" if "wwtp_name" in df.columns else "WWTP_name"
+
+    # If the download is for hydrowaste and epa data, use given coordinates
+    # If the download is for OSM data, use bounding box centroid
+    centers = df["centroid"] if is_osm else df.geometry
+
+    # Read the coordinates of all wwtps at once instead of row by row
+    center_x = centers.x.to_numpy(dtype=float)
+    center_y = centers.y.to_numpy(dtype=float)
+
+    return list(zip([name] * len(df), df[name_column], center_x.tolist(), center_y.tolist()))
+
+def tile_bounds(center_x, center_y):
+    """
+    Computes the bounds of the square areas around the given coordinates of distance 0.02 longitude and latitude units. Works on single coordinates as well as on numpy arrays of coordinates.
+    
+    Args:
+    center_x: longitude of the center of the image
+    center_y: latitude of the center of the image
+    
+    Returns:
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude)
+    """
+    # Define padding to add to coordinates to get square area around wwtp
+    # Chosen since most bounding boxes have height and width within 0.02
+    length = 0.01
+    height = 0.01
+
+    return center_x - length, center_y - height, center_x + length, center_y + height
+
+@functools.lru_cache(maxsize=None)
+def naip_image():
+    """
+    Builds the NAIP mosaic that every image is cut from. It is built once per process and reused for every region, as it is identical for every wwtp.
+    
+    Returns:
+    image: NAIP mosaic with R, G and B channels, with masked pixels set to 0
+    """
+    # Define database to download from, date range and channels
+    # NAIP dataset: https://developers.google.com/earth-engine/datasets/catalog/USDA_NAIP_DOQQ
+    collection = (
+        ee.ImageCollection("USDA/NAIP/DOQQ")
+        .filterDate("2010-01-01", "2024-01-01")
+        .select(['R', 'G', 'B'])
+    )
+
+    # Create Image object
+    return ee.Image(collection.mosaic()).unmask()
+
+def tile_image(center_x, center_y):
+    """
+    Builds the Earth Engine image and region of a square area around the given coordinates of distance 0.02 longitude and latitude units
+    
+    Args:
+    center_x: longitude of the center of the image
+    center_y: latitude of the center of the image
+    
+    Returns:
+    image: NAIP image to download
+    roi: region of the image
+    """
+    # Only the region differs between wwtps, the mosaic is shared
+    roi = ee.Geometry.Rectangle(list(tile_bounds(center_x, center_y)))
+    return naip_image(), roi
+
+def download_url(bounds):
+    """
+    Requests the Earth Engine download URL of the NAIP image of a region as a GeoTIFF. It is used as the URL function of the download pipeline, for single wwtp images as well as for rasters covering a group of nearby wwtps.
+    
+    Args:
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude) of the region
+    
+    Returns:
+    url: URL serving the .tif file
+    """
+    roi = ee.Geometry.Rectangle(list(bounds))
+    return naip_image().getDownloadURL({"region": roi, "scale": 1, "format": "GEO_TIFF"})
+
+def download_image(name, wwtp_name, center_x, center_y):
+    """
+    Downloads a single image of a WWTP of type .tif from Earth Engine, covering a square area around the given coordinates of distance 0.02 longitude and latitude units. The image is skipped if it already exists.
+    
+    Args:
+    name: name of state
+    wwtp_name: name of the wwtp, used as the file name
+    center_x: longitude of the center of the image
+    center_y: latitude of the center of the image
+    """
+    # Define path of image file for download
+    filename = image_path(name, wwtp_name)
     # Create directory if it doesn't exist
-    if not os.path.exists(downloaded_directory):
-        os.mkdir(downloaded_directory)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    # If the image already exists, there is nothing to do
+    if os.path.exists(filename):
+        return
+
+    image, roi = tile_image(center_x, center_y)
+
+    # Download image with above parameters
+    geemap.ee_export_image(
+        image, filename=filename, scale=1, region=roi, file_per_band=False
+    )
+
+    # Store the image as a tiled, compressed cloud optimized GeoTIFF with overviews
+    if os.path.exists(filename):
+        utils_cog.convert_to_cog(filename)
+
+def download_images(df, name, is_osm, metrics_path=utils_download_metrics.METRICS_LOG_PATH):
+    """
+    Downloads images of WWTPs of type .tif from Earth Engine. It uses either the coordinates given or the centroid coordinates to define a square area around the coordinates of distance 0.02 longitude and latitude units. The time and size of every download are recorded in the metrics log.
+    
+    Args:
+    df: pandas dataframe with wwtp name and coordinates
+    name: name of state
+    is_osm: True if the data is from OSM (uses centroid of bounding box), False if the data is from hydrowaste and epa (uses given coordinates)
+    metrics_path: path of the JSON-lines metrics log, see utils_download_metrics
+    """   
+    metrics = utils_download_metrics.MetricsLog(metrics_path, utils_download_metrics.new_run_id())
 
     # For every wwtp
-    for idx, row in df.iterrows():
-
-        # Define path of image file for download
-        filename = os.path.join(downloaded_directory, f"{row['wwtp_name']}.tif")
-
-        # If the image doesn't exist
-        if not os.path.exists(filename):
-
-            # Define padding to add to coordinates to get square area around wwtp
-            # Chosen since most bounding boxes have height and width within 0.02
-            length = 0.01
-            height = 0.01
-
-            # If the download is for hydrowaste and epa data, use given coordinates
-            if not is_osm:
-                center_x = row.geometry.x
-                center_y = row.geometry.y
-            
-            # If the download is for OSM data, use bounding box centroid
-            else:
-                center_x = row.centroid.x
-                center_y = row.centroid.y
-
-            # Define square area around the coordinates of wwtp using Polygon object and padding defined above
-            large_polygon = ee.Geometry.Polygon([(center_x+length, center_y+height), (center_x+length, center_y-height), 
-            (center_x-length, center_y-height), (center_x-length, center_y+height)])
-
-            # Convert Polygon into Feature object
-            feature = ee.Feature(large_polygon, {})
-
-            # Define database to download from, date range and channels
-            # NAIP dataset: https://developers.google.com/earth-engine/datasets/catalog/USDA_NAIP_DOQQ
-            collection = (
-                ee.ImageCollection("USDA/NAIP/DOQQ")
-                .filterDate("2010-01-01", "2024-01-01")
-                .select(['R', 'G', 'B'])
-            )
-
-            # Create Image object
-            image = ee.Image(collection.mosaic())
-
-            # Get region to download from Feature object
-            roi = feature.geometry()
-
-            # Download image with above parameters
-            image = image.clip(roi).unmask()
-            geemap.ee_export_image(
-                image, filename=filename, scale=1, region=roi, file_per_band=False
-            )
\ No newline at end of file
+    for task in plant_tasks(df, name, is_osm):
+        filename = image_path(name, task[1])
+        if os.path.exists(filename):
+            continue
+
+        start = time.time()
+        error = None
+        try:
+            download_image(*task)
+        except Exception as e:
+            error = e
+        elapsed = time.time() - start
+
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        status = "done" if error is None and size > 0 else "failed"
+        # The geemap export does the URL request, transfer and writing in one call
+        metrics.write("job", source="osm" if is_osm else "hw_epa", states=[name], images=1, elapsed_s=elapsed, bytes=size, transfer_s=elapsed, error=None if error is None else str(error))
+        metrics.write("tile", source="osm" if is_osm else "hw_epa", state=name, wwtp_name=task[1], elapsed_s=elapsed, status=status)
+
+    metrics.close()
@@ -0,0 +1,287 @@
+import hashlib
+import os
+import sqlite3
+import time
+from src import utils_download_images
+
+# The manifest lives next to the WWTP_Images directory
+MANIFEST_PATH = "../00_source_data/WWTP_Images_manifest.sqlite"
+
+def file_checksum(filename):
+    """
+    Computes the sha256 checksum of a file, reading it in chunks
+
+    Args:
+    filename: path of the file
+
+    Returns:
+    checksum: hex digest of the file
+    """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def validate_image(filename):
+    """
+    Checks that a downloaded image is a complete GeoTIFF. The last row of the image is read, which fails for files truncated by a killed worker.
+
+    Args:
+    filename: path of the .tif file
+
+    Returns:
+    error: None if the image is valid, otherwise a description of the problem
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    if not os.path.exists(filename):
+        return "file not written"
+    if os.path.getsize(filename) == 0:
+        return "empty file"
+    try:
+        with rasterio.open(filename) as src:
+            src.read(window=Window(0, src.height - 1, src.width, 1))
+    except Exception as e:
+        return f"corrupt file: {e}"
+    return None
+
+class DownloadManifest:
+    """
+    Persistent SQLite manifest of downloaded images. It records status, attempt count, byte size, checksum, elapsed time and error for every (source, state, plant) image, so that restarts know what is left to download without listing directories.
+
+    Args:
+    path: path of the SQLite database
+
+    Status values:
+    pending: known but not downloaded yet
+    running: download started but not finished (e.g. the worker was killed)
+    done: downloaded and validated
+    failed: the download raised an error
+    corrupt: the download finished but the file is not a valid GeoTIFF
+    """
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        # Several worker processes write to the manifest, so wait for locks instead of failing
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tiles (
+                source TEXT NOT NULL,
+                state TEXT NOT NULL,
+                wwtp_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                size INTEGER,
+                checksum TEXT,
+                elapsed REAL,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (source, state, wwtp_name)
+            )
+            """
+        )
+        self.conn.commit()
+
+    def close(self):
+        """
+        Closes the connection to the database
+        """
+        self.conn.close()
+
+    def _update(self, source, name, wwtp_name, **fields):
+        """
+        Inserts or updates the row of an image with the given fields
+        """
+        fields["updated_at"] = time.time()
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{c}=excluded.{c}" for c in fields)
+        self.conn.execute(
+            f"""
+            INSERT INTO tiles (source, state, wwtp_name, {columns}) VALUES (?, ?, ?, {placeholders})
+            ON CONFLICT (source, state, wwtp_name) DO UPDATE SET {updates}
+            """,
+            (source, name, wwtp_name, *fields.values()),
+        )
+        self.conn.commit()
+
+    def statuses(self, source):
+        """
+        Reads the status and size of every image of a source in a single query
+
+        Args:
+        source: name of the data source, e.g. "hw_epa" or "osm"
+
+        Returns:
+        statuses: dictionary {(state name, wwtp name): (status, size)}
+        """
+        rows = self.conn.execute(
+            "SELECT state, wwtp_name, status, size FROM tiles WHERE source = ?", (source,)
+        )
+        return {(name, wwtp_name): (status, size) for name, wwtp_name, status, size in rows}
+
+    def is_done(self, name, wwtp_name, source=None):
+        """
+        Checks whether an image is recorded as downloaded, by the given source or by any source if None
+        """
+        query = "SELECT 1 FROM tiles WHERE state = ? AND wwtp_name = ? AND status = 'done'"
+        params = (name, wwtp_name)
+        if source is not None:
+            query += " AND source = ?"
+            params += (source,)
+        return self.conn.execute(query, params).fetchone() is not None
+
+    def pending(self, tasks, source, verify=False):
+        """
+        Filters the tasks down to the images that still need to be downloaded, i.e. images that are missing, failed, corrupt or were interrupted. Finished images are checked against one listing of every state directory, so images deleted after they finished are fetched again. Images that are not in the manifest yet but already exist on disk (downloaded before the manifest existed) are validated once and adopted.
+
+        Args:
+        tasks: list of tasks from utils_download_images.plant_tasks
+        source: name of the data source
+        verify: if True, also check that the size of every finished image on disk still matches the manifest
+
+        Returns:
+        pending_tasks: list of tasks that need to be downloaded
+        """
+        statuses = self.statuses(source)
+        listings = {}
+
+        def exists(name, wwtp_name):
+            # One directory listing per state instead of a stat per image
+            if name not in listings:
+                directory = os.path.dirname(utils_download_images.image_path(name, ""))
+                try:
+                    listings[name] = {entry.name for entry in os.scandir(directory)}
+                except FileNotFoundError:
+                    listings[name] = set()
+            return os.path.basename(utils_download_images.image_path(name, wwtp_name)) in listings[name]
+
+        pending_tasks = []
+        new_rows = []
+        for task in tasks:
+            name, wwtp_name = task[0], task[1]
+            status, size = statuses.get((name, wwtp_name), (None, None))
+
+            if status == "done" and exists(name, wwtp_name):
+                if not verify:
+                    continue
+                filename = utils_download_images.image_path(name, wwtp_name)
+                if os.path.getsize(filename) == size:
+                    continue
+
+            # Unknown image: adopt it if a valid file is already on disk
+            if status is None:
+                filename = utils_download_images.image_path(name, wwtp_name)
+                if exists(name, wwtp_name) and validate_image(filename) is None:
+                    self.mark_done(source, name, wwtp_name, filename, elapsed=None)
+                    continue
+                new_rows.append((source, name, wwtp_name, time.time()))
+
+            pending_tasks.append(task)
+
+        # Register the new images in one transaction
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO tiles (source, state, wwtp_name, status, updated_at) VALUES (?, ?, ?, 'pending', ?)",
+            new_rows,
+        )
+        self.conn.commit()
+
+        return pending_tasks
+
+    def mark_started(self, source, name, wwtp_name):
+        """
+        Marks an image as being downloaded and increases its attempt count
+        """
+        self.conn.execute(
+            """
+            INSERT INTO tiles (source, state, wwtp_name, status, attempts, updated_at) VALUES (?, ?, ?, 'running', 1, ?)
+            ON CONFLICT (source, state, wwtp_name) DO UPDATE SET status='running', attempts=attempts+1, updated_at=excluded.updated_at
+            """,
+            (source, name, wwtp_name, time.time()),
+        )
+        self.conn.commit()
+
+    def mark_done(self, source, name, wwtp_name, filename, elapsed, size=None, checksum=None):
+        """
+        Marks an image as downloaded, recording its size and checksum. They are computed from the file when not given.
+        """
+        self._update(
+            source, name, wwtp_name,
+            status="done",
+            size=os.path.getsize(filename) if size is None else size,
+            checksum=file_checksum(filename) if checksum is None else checksum,
+            elapsed=elapsed,
+            error=None,
+        )
+
+    def mark_failed(self, source, name, wwtp_name, error, elapsed, status="failed"):
+        """
+        Marks an image as failed or corrupt, recording the error
+        """
+        self._update(source, name, wwtp_name, status=status, elapsed=elapsed, error=str(error))
+
+    def progress(self):
+        """
+        Summarizes the manifest by source, state and status without touching the image directories
+
+        Returns:
+        rows: list of tuples (source, state, status, number of images, total bytes)
+        """
+        return self.conn.execute(
+            """
+            SELECT source, state, status, COUNT(*), COALESCE(SUM(size), 0)
+            FROM tiles GROUP BY source, state, status ORDER BY source, state, status
+            """
+        ).fetchall()
+
+    def print_progress(self):
+        """
+        Prints the progress of the downloads per source and state
+        """
+        for source, name, status, count, size in self.progress():
+            print(f"{source:8} {name:20} {status:8} {count:6} {size / 1e6:10.1f} MB")
+
+def start_download(manifest, source, task):
+    """
+    Records the start of the download of an image. Any stale file left by an earlier failed or interrupted attempt is removed first so that it is fetched again. A file recorded as downloaded is kept, since the image path is shared by the sources (e.g. an image of the same plant downloaded by another source).
+
+    Args:
+    manifest: DownloadManifest
+    source: name of the data source
+    task: tuple (state name, wwtp name, center longitude, center latitude)
+    """
+    name, wwtp_name = task[0], task[1]
+    filename = utils_download_images.image_path(name, wwtp_name)
+
+    if os.path.exists(filename) and not manifest.is_done(name, wwtp_name):
+        os.remove(filename)
+
+    manifest.mark_started(source, name, wwtp_name)
+
+def finish_download(manifest, source, task, result, error, elapsed):
+    """
+    Records the outcome of the download of an image
+
+    Args:
+    manifest: DownloadManifest
+    source: name of the data source
+    task: tuple (state name, wwtp name, center longitude, center latitude)
+    result: dictionary with the size, checksum and validation error of the image, None if the download raised
+    error: exception raised by the download, None if it finished
+    elapsed: time spent on the download in seconds
+    """
+    name, wwtp_name = task[0], task[1]
+
+    if error is not None:
+        manifest.mark_failed(source, name, wwtp_name, error, elapsed)
+    elif result["error"] is not None:
+        manifest.mark_failed(source, name, wwtp_name, result["error"], elapsed, status="corrupt")
+    else:
+        filename = utils_download_images.image_path(name, wwtp_name)
+        manifest.mark_done(
+            source, name, wwtp_name, filename, elapsed,
+            size=result["size"], checksum=result["checksum"],
+        )
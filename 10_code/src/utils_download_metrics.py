@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import time
+import uuid
+
+# The metrics are stored next to the WWTP_Images directory
+METRICS_LOG_PATH = "../00_source_data/download_metrics.jsonl"
+PROMETHEUS_PATH = "../00_source_data/download_metrics.prom"
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Phases of a download job, in the order they happen
+PHASES = ("queued", "url", "transfer", "write")
+
+def new_run_id():
+    """
+    Creates an identifier for a download run, used to tell the events of different runs apart in the log
+
+    Returns:
+    run_id: string identifier
+    """
+    return time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+
+class MetricsLog:
+    """
+    Append-only JSON-lines log of download events. Every worker process opens its own log; lines are written with a single call in append mode, so events of several processes don't interleave.
+
+    Args:
+    path: path of the JSON-lines file
+    run_id: identifier of the download run
+    """
+    def __init__(self, path=METRICS_LOG_PATH, run_id=None):
+        self.path = path
+        self.run_id = run_id
+        self.file = open(path, "a", buffering=1)
+
+    def write(self, event, **fields):
+        """
+        Writes one event to the log
+
+        Args:
+        event: type of the event, e.g. "job", "tile", "worker" or "run"
+        fields: values of the event
+        """
+        record = {"event": event, "time": time.time(), "run_id": self.run_id, "pid": os.getpid(), **fields}
+        self.file.write(json.dumps(record, default=str) + "\n")
+
+    def close(self):
+        """
+        Closes the log file
+        """
+        self.file.close()
+
+class WorkerStats:
+    """
+    Tracks the utilization of a worker, i.e. the average share of its request slots that were busy
+
+    Args:
+    max_in_flight: number of request slots of the worker
+    """
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.start = self.last = time.time()
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+
+    def _advance(self):
+        now = time.time()
+        self.busy_seconds += self.in_flight * (now - self.last)
+        self.last = now
+
+    def submitted(self):
+        """
+        Records that a request was submitted
+        """
+        self._advance()
+        self.in_flight += 1
+
+    def finished(self):
+        """
+        Records that a request finished
+        """
+        self._advance()
+        self.in_flight -= 1
+
+    def summary(self):
+        """
+        Returns the wall time, busy slot-seconds and utilization of the worker
+        """
+        self._advance()
+        wall = self.last - self.start
+        utilization = self.busy_seconds / (wall * self.max_in_flight) if wall > 0 else 0.0
+        return {"wall_s": wall, "busy_s": self.busy_seconds, "utilization": utilization}
+
+def read_events(path=METRICS_LOG_PATH, run_id=None):
+    """
+    Reads the events of the log, optionally only those of one run
+
+    Args:
+    path: path of the JSON-lines file
+    run_id: identifier of the run, all runs if None
+
+    Returns:
+    events: list of dictionaries
+    """
+    events = []
+    if not os.path.exists(path):
+        return events
+    with open(path) as f:
+        for line in f:
+            # A line cut off by a killed process is skipped
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if run_id is None or record.get("run_id") == run_id:
+                events.append(record)
+    return events
+
+def histogram(values, buckets=LATENCY_BUCKETS):
+    """
+    Computes the cumulative bucket counts of a histogram, as used by Prometheus
+
+    Args:
+    values: list of values
+    buckets: upper bounds of the buckets
+
+    Returns:
+    counts: list of tuples (upper bound, number of values smaller or equal), ending with ("+Inf", total)
+    """
+    counts = [(str(bound), sum(v <= bound for v in values)) for bound in buckets]
+    counts.append(("+Inf", len(values)))
+    return counts
+
+def aggregate(events):
+    """
+    Aggregates the events of the log into the download metrics
+
+    Args:
+    events: list of events from read_events
+
+    Returns:
+    metrics: dictionary with latencies, bytes, bytes per second, time per phase, status counts, retries, throttled requests and worker utilization
+    """
+    jobs = [e for e in events if e["event"] == "job"]
+    tiles = [e for e in events if e["event"] == "tile"]
+    workers = [e for e in events if e["event"] == "worker"]
+    runs = [e for e in events if e["event"] == "run_end"]
+    retries = [e for e in events if e["event"] == "retry"]
+
+    transfer_seconds = sum(e.get("transfer_s") or 0 for e in jobs)
+    total_bytes = sum(e.get("bytes") or 0 for e in jobs)
+
+    status_counts = {}
+    for e in tiles:
+        status_counts[e["status"]] = status_counts.get(e["status"], 0) + 1
+
+    return {
+        "latencies": [e["elapsed_s"] for e in jobs],
+        "url_latencies": [e["url_s"] for e in jobs if e.get("url_s") is not None],
+        "bytes": total_bytes,
+        "bytes_per_second": total_bytes / transfer_seconds if transfer_seconds > 0 else 0.0,
+        "phase_seconds": {p: sum(e.get(f"{p}_s") or 0 for e in jobs) for p in PHASES},
+        "status_counts": status_counts,
+        "retries": len(retries) + sum(e.get("retried", 0) for e in runs),
+        "throttled": sum(e["throttled"] for e in retries),
+        "utilization": {str(e["pid"]): e["utilization"] for e in workers},
+    }
+
+def write_prometheus(events, path=PROMETHEUS_PATH):
+    """
+    Writes the aggregated metrics as a Prometheus textfile (for the node exporter textfile collector). The file is replaced atomically.
+
+    Args:
+    events: list of events from read_events
+    path: path of the .prom file
+    """
+    metrics = aggregate(events)
+    lines = []
+
+    for name, values, description in (
+        ("wwtp_download_job_seconds", metrics["latencies"], "Latency of download jobs from submission to finish"),
+        ("wwtp_download_url_seconds", metrics["url_latencies"], "Latency of the download URL requests"),
+    ):
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        for bound, count in histogram(values):
+            lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+        lines += [f"{name}_sum {sum(values)}", f"{name}_count {len(values)}"]
+
+    lines += [
+        "# HELP wwtp_download_bytes_total Bytes downloaded",
+        "# TYPE wwtp_download_bytes_total counter",
+        f"wwtp_download_bytes_total {metrics['bytes']}",
+        "# HELP wwtp_download_bytes_per_second Bytes downloaded per second of transfer",
+        "# TYPE wwtp_download_bytes_per_second gauge",
+        f"wwtp_download_bytes_per_second {metrics['bytes_per_second']}",
+        "# HELP wwtp_download_phase_seconds_total Time spent queued, requesting URLs, transferring and writing",
+        "# TYPE wwtp_download_phase_seconds_total counter",
+    ]
+    lines += [f'wwtp_download_phase_seconds_total{{phase="{p}"}} {s}' for p, s in metrics["phase_seconds"].items()]
+    lines += [
+        "# HELP wwtp_download_tiles_total Images by final status",
+        "# TYPE wwtp_download_tiles_total counter",
+    ]
+    lines += [f'wwtp_download_tiles_total{{status="{s}"}} {c}' for s, c in metrics["status_counts"].items()]
+    lines += [
+        "# HELP wwtp_download_retries_total Retried downloads",
+        "# TYPE wwtp_download_retries_total counter",
+        f"wwtp_download_retries_total {metrics['retries']}",
+        "# HELP wwtp_download_throttled_total Requests throttled by Earth Engine",
+        "# TYPE wwtp_download_throttled_total counter",
+        f"wwtp_download_throttled_total {metrics['throttled']}",
+        "# HELP wwtp_download_worker_utilization Share of the request slots of a worker that were busy",
+        "# TYPE wwtp_download_worker_utilization gauge",
+    ]
+    lines += [f'wwtp_download_worker_utilization{{worker="{w}"}} {u}' for w, u in metrics["utilization"].items()]
+
+    part_path = path + ".part"
+    with open(part_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(part_path, path)
+
+def print_summary(path=METRICS_LOG_PATH, run_id=None, top=10):
+    """
+    Prints the overall metrics and the slowest states and plants of the log
+
+    Args:
+    path: path of the JSON-lines file
+    run_id: identifier of the run, all runs if None
+    top: number of states and plants to show
+    """
+    events = read_events(path, run_id)
+    metrics = aggregate(events)
+    tiles = [e for e in events if e["event"] == "tile"]
+
+    print(f"Jobs: {len(metrics['latencies'])}, images: {len(tiles)}, statuses: {metrics['status_counts']}, retries: {metrics['retries']}, throttled: {metrics['throttled']}")
+    print(f"Downloaded: {metrics['bytes'] / 1e6:.1f} MB at {metrics['bytes_per_second'] / 1e6:.2f} MB/s")
+    print("Time per phase: " + ", ".join(f"{p} {s:.1f}s" for p, s in metrics["phase_seconds"].items()))
+    for worker, utilization in metrics["utilization"].items():
+        print(f"Worker {worker}: {utilization:.0%} utilized")
+
+    # Slowest states by total download time
+    states = {}
+    for e in tiles:
+        total, count = states.get(e["state"], (0.0, 0))
+        states[e["state"]] = (total + (e.get("elapsed_s") or 0), count + 1)
+    print("\nSlowest states:")
+    for state, (total, count) in sorted(states.items(), key=lambda s: -s[1][0])[:top]:
+        print(f"{state:20} {total:10.1f}s total {total / count:8.2f}s per image {count:6} images")
+
+    print("\nSlowest plants:")
+    for e in sorted(tiles, key=lambda e: -(e.get("elapsed_s") or 0))[:top]:
+        print(f"{e['state']:20} {e['wwtp_name'][:40]:40} {e.get('elapsed_s') or 0:8.2f}s {e['status']}")
+
+def main():
+    """
+    Prints the summary of the download metrics, or writes the Prometheus textfile, from the command line
+    """
+    parser = argparse.ArgumentParser(description="Summarize the download metrics")
+    parser.add_argument("command", choices=["summary", "prometheus"], help="print the summary or write the Prometheus textfile")
+    parser.add_argument("--log", default=METRICS_LOG_PATH, help="path of the JSON-lines metrics log")
+    parser.add_argument("--run-id", default=None, help="only use the events of this run")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest states and plants to show")
+    parser.add_argument("--output", default=PROMETHEUS_PATH, help="path of the Prometheus textfile")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        print_summary(args.log, args.run_id, args.top)
+    else:
+        write_prometheus(read_events(args.log, args.run_id), args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import functools
+import multiprocessing
+import os
+import time
+from src import (
+    utils_download_images,
+    utils_download_manifest,
+    utils_download_metrics,
+    utils_ee_pipeline,
+    utils_rate_limit,
+    utils_tile_planner,
+)
+
+def queue_jobs(job_queue):
+    """
+    Yields download jobs from the shared queue until the stop signal (None) is received
+    
+    Args:
+    job_queue: multiprocessing queue with items (time the job was queued, job)
+    
+    Returns:
+    item: generator of (time the job was queued, job)
+    """
+    while True:
+        item = job_queue.get()
+
+        # None is the signal that the queue has been drained
+        if item is None:
+            return
+
+        yield item
+
+def fetch_item(item, url_fn):
+    """
+    Downloads the job of a queue item, see utils_tile_planner.fetch_job
+    """
+    return utils_tile_planner.fetch_job(item[1], url_fn=url_fn)
+
+def worker(job_queue, source, manifest_path, max_in_flight, url_fn, metrics_path, run_id, adaptive, max_retries):
+    """
+    Takes download jobs from the shared queue and downloads them with up to max_in_flight concurrent requests until the stop signal (None) is received. The number of requests in flight adapts to throttling by Earth Engine, and failed jobs are retried with backoff. The outcome of every download is recorded in the manifest, and its timings in the metrics log.
+    
+    Args:
+    job_queue: multiprocessing queue with items (time the job was queued, job), jobs are lists of tasks of the form (state name, wwtp name, center longitude, center latitude)
+    source: name of the data source, e.g. "hw_epa" or "osm"
+    manifest_path: path of the download manifest
+    max_in_flight: maximum number of requests in flight in this worker
+    url_fn: function returning the download URL of region bounds
+    metrics_path: path of the JSON-lines metrics log
+    run_id: identifier of the download run
+    adaptive: if True, adapt the number of requests in flight with an AIMD controller, otherwise keep it at max_in_flight
+    max_retries: maximum number of retries of a job with a retryable error
+    """
+    # SQLite connections can't be shared between processes, so every worker opens its own
+    manifest = utils_download_manifest.DownloadManifest(manifest_path)
+    metrics = utils_download_metrics.MetricsLog(metrics_path, run_id)
+    stats = utils_download_metrics.WorkerStats(max_in_flight)
+    controller = utils_rate_limit.AIMDController(maximum=max_in_flight) if adaptive else None
+    submitted_at = {}
+
+    def on_submit(item):
+        enqueued_at, job = item
+        # Only the first attempt counts as queued, the wait before a retry is backoff
+        submitted_at.setdefault(id(item), time.time())
+        stats.submitted()
+        for task in job:
+            utils_download_manifest.start_download(manifest, source, task)
+
+    def on_result(item, results, error, elapsed):
+        enqueued_at, job = item
+        stats.finished()
+
+        # Timings of the phases of the job, the writing time is the sum over its images
+        timings = {"queued_s": submitted_at.pop(id(item)) - enqueued_at}
+        if results is not None:
+            timings.update(
+                url_s=results[0]["url_s"],
+                transfer_s=results[0]["transfer_s"],
+                write_s=sum(r["write_s"] for r in results),
+            )
+        metrics.write(
+            "job",
+            source=source,
+            states=sorted(set(task[0] for task in job)),
+            images=len(job),
+            elapsed_s=elapsed,
+            bytes=0 if results is None else sum(r["transfer_bytes"] for r in results),
+            error=None if error is None else str(error),
+            limit=max_in_flight if controller is None else controller.limit,
+            **timings,
+        )
+
+        for i, task in enumerate(job):
+            result = None if results is None else results[i]
+            utils_download_manifest.finish_download(manifest, source, task, result, error, elapsed)
+
+            if error is not None:
+                status = "failed"
+            elif result["error"] is not None:
+                status = "corrupt"
+            else:
+                status = "done"
+            metrics.write("tile", source=source, state=task[0], wwtp_name=task[1], elapsed_s=elapsed, status=status)
+
+            if error is not None:
+                # A failed image must not take the worker down with it, the remaining jobs still need a worker
+                print("FAILED: ", task[0], task[1], error)
+
+    def on_retry(item, error, attempt, delay):
+        enqueued_at, job = item
+        stats.finished()
+        metrics.write(
+            "retry",
+            source=source,
+            states=sorted(set(task[0] for task in job)),
+            attempt=attempt,
+            delay_s=delay,
+            throttled=utils_rate_limit.is_throttling_error(error),
+            error=str(error),
+            limit=max_in_flight if controller is None else controller.limit,
+        )
+
+    utils_ee_pipeline.run_pipeline(
+        queue_jobs(job_queue),
+        functools.partial(fetch_item, url_fn=url_fn),
+        max_in_flight=max_in_flight,
+        on_submit=on_submit,
+        on_result=on_result,
+        controller=controller,
+        max_retries=max_retries,
+        on_retry=on_retry,
+    )
+
+    metrics.write("worker", max_in_flight=max_in_flight, **stats.summary())
+    metrics.close()
+    manifest.close()
+
+def run_download_queue(
+    tasks,
+    source,
+    num_workers=4,
+    max_in_flight=16,
+    manifest_path=utils_download_manifest.MANIFEST_PATH,
+    url_fn=utils_download_images.download_url,
+    group_tiles=True,
+    metrics_path=utils_download_metrics.METRICS_LOG_PATH,
+    prometheus_path=utils_download_metrics.PROMETHEUS_PATH,
+    adaptive=True,
+    max_retries=5,
+):
+    """
+    Downloads all given tasks with a fixed number of worker processes that share a single queue. Each worker keeps several requests in flight and takes the next job as soon as one finishes, so a slow image or state never leaves the other workers idle. Images that the manifest records as done are skipped, and wwtps with overlapping image areas are downloaded with a single request.
+    
+    Args:
+    tasks: list of tasks from utils_download_images.plant_tasks, may contain tasks from several states
+    source: name of the data source, e.g. "hw_epa" or "osm"
+    num_workers: number of worker processes
+    max_in_flight: maximum number of requests in flight per worker process
+    manifest_path: path of the download manifest
+    url_fn: function returning the download URL of region bounds, e.g. a fake endpoint for offline runs
+    group_tiles: if True, download one covering raster for groups of wwtps with overlapping image areas
+    metrics_path: path of the JSON-lines metrics log
+    prometheus_path: path of the Prometheus textfile written at the end of the run
+    adaptive: if True, every worker adapts its number of requests in flight to throttling (AIMD), up to max_in_flight
+    max_retries: maximum number of retries of a job with a retryable error, with jittered exponential backoff
+    
+    Returns:
+    run_id: identifier of the run in the metrics log
+    """
+    # Only download images that are missing, failed, corrupt or were interrupted
+    manifest = utils_download_manifest.DownloadManifest(manifest_path)
+    statuses = manifest.statuses(source)
+    tasks = manifest.pending(tasks, source)
+    print("PENDING: ", len(tasks))
+
+    run_id = utils_download_metrics.new_run_id()
+    metrics = utils_download_metrics.MetricsLog(metrics_path, run_id)
+    start = time.time()
+
+    # Group overlapping images into jobs downloaded with a single request
+    jobs = utils_tile_planner.plan_jobs(tasks) if group_tiles else [[task] for task in tasks]
+    summary = utils_tile_planner.plan_summary(jobs)
+    print(
+        f"REQUESTS: {summary['requests']} for {summary['images']} images, "
+        f"saved {summary['requests_saved']} requests and {summary['bytes_saved'] / 1e6:.1f} MB"
+    )
+
+    # Create the state directories up front so that workers don't race to create them
+    for name in set(task[0] for task in tasks):
+        os.makedirs(os.path.dirname(utils_download_images.image_path(name, "")), exist_ok=True)
+
+    # Images that failed, were corrupt or were interrupted in an earlier run are retries
+    retried = sum(
+        statuses.get((task[0], task[1]), (None, None))[0] in ("failed", "corrupt", "running") for task in tasks
+    )
+    metrics.write("run_start", source=source, num_workers=num_workers, max_in_flight=max_in_flight, **summary)
+
+    job_queue = multiprocessing.Queue()
+    for job in jobs:
+        job_queue.put((time.time(), job))
+
+    # One stop signal per worker, placed after all jobs
+    for _ in range(num_workers):
+        job_queue.put(None)
+
+    # Create processes and assign the worker function to them
+    processes = [
+        multiprocessing.Process(
+            target=worker,
+            args=(job_queue, source, manifest_path, max_in_flight, url_fn, metrics_path, run_id, adaptive, max_retries),
+        )
+        for _ in range(num_workers)
+    ]
+
+    # Start processes
+    for p in processes:
+        p.start()
+
+    # Wait for processes to finish
+    for p in processes:
+        p.join()
+
+    metrics.write("run_end", source=source, wall_s=time.time() - start, retried=retried)
+    metrics.close()
+    utils_download_metrics.write_prometheus(utils_download_metrics.read_events(metrics_path, run_id), prometheus_path)
+
+    manifest.print_progress()
+    manifest.close()
+    return run_id
@@ -0,0 +1,189 @@
+import concurrent.futures
+import hashlib
+import heapq
+import os
+import threading
+import time
+import requests
+from src import utils_cog, utils_download_images, utils_download_manifest, utils_rate_limit
+
+# Every thread keeps its own HTTP session so that connections are reused between requests
+_local = threading.local()
+
+def get_session():
+    """
+    Returns the requests session of the current thread, creating it on first use
+
+    Returns:
+    session: requests.Session
+    """
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+def stream_to_file(url, filename, chunk_size=1 << 20, timeout=300):
+    """
+    Streams the response of a URL straight to disk. The data is written to a temporary .part file that is renamed once complete, so an interrupted download never leaves a file that looks finished; the .part file of a failed download is removed. The checksum is computed while streaming.
+
+    Args:
+    url: URL to download
+    filename: path of the output file
+    chunk_size: number of bytes read from the response at a time
+    timeout: timeout of the request in seconds
+
+    Returns:
+    size: number of bytes written
+    checksum: sha256 checksum of the file
+    """
+    part_filename = filename + ".part"
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with get_session().get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(part_filename, "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    sha.update(chunk)
+                    size += len(chunk)
+    except BaseException:
+        # Don't let the partial files of failed attempts pile up across retries
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        raise
+    os.replace(part_filename, filename)
+    return size, sha.hexdigest()
+
+def fetch_tile(task, url_fn=utils_download_images.download_url, validate=True, cog=True):
+    """
+    Downloads the image of one task: requests its download URL and streams the response to disk
+
+    Args:
+    task: tuple (state name, wwtp name, center longitude, center latitude)
+    url_fn: function returning the download URL of the region bounds of a task
+    validate: if True, check that the written file is a complete GeoTIFF
+    cog: if True, convert the image to a tiled, compressed cloud optimized GeoTIFF with overviews
+
+    Returns:
+    result: dictionary with the size, checksum and validation error (None if valid) of the image, the number of downloaded bytes and the time spent requesting the URL, transferring and writing
+    """
+    filename = utils_download_images.image_path(task[0], task[1])
+
+    start = time.time()
+    url = url_fn(utils_download_images.tile_bounds(task[2], task[3]))
+    url_done = time.time()
+    size, checksum = stream_to_file(url, filename)
+    transfer_done = time.time()
+    transfer_bytes = size
+
+    error = utils_download_manifest.validate_image(filename) if validate else None
+    if error is not None:
+        # Don't leave a broken file behind that looks like a finished download
+        os.remove(filename)
+    elif cog:
+        utils_cog.convert_to_cog(filename)
+        size, checksum = os.path.getsize(filename), utils_download_manifest.file_checksum(filename)
+
+    return {
+        "size": size,
+        "checksum": checksum,
+        "error": error,
+        "transfer_bytes": transfer_bytes,
+        "url_s": url_done - start,
+        "transfer_s": transfer_done - url_done,
+        "write_s": time.time() - transfer_done,
+    }
+
+def _timed(fetch_fn, task):
+    """
+    Runs the fetch function of a task and returns its result, error and elapsed time instead of raising
+    """
+    start = time.time()
+    try:
+        return fetch_fn(task), None, time.time() - start
+    except Exception as e:
+        return None, e, time.time() - start
+
+def run_pipeline(
+    tasks,
+    fetch_fn,
+    max_in_flight=8,
+    on_submit=None,
+    on_result=None,
+    controller=None,
+    max_retries=0,
+    on_retry=None,
+):
+    """
+    Downloads the tasks with a pool of threads, keeping up to max_in_flight requests in flight. Tasks are taken lazily from the iterable, so it can be a generator reading from a queue. The callbacks run in the calling thread, so they can safely use objects that are not thread safe such as the SQLite manifest.
+
+    Failed tasks with a retryable error (throttling, transient server errors) are retried with jittered exponential backoff. Waiting tasks don't occupy a request slot. With an AIMD controller, the number of requests in flight adapts between its minimum and max_in_flight: it grows while requests succeed and is cut when Earth Engine throttles.
+
+    Args:
+    tasks: iterable of tasks
+    fetch_fn: function downloading one task, e.g. fetch_tile
+    max_in_flight: maximum number of requests in flight at the same time
+    on_submit: function called with the task before every attempt is submitted
+    on_result: function called with (task, result, error, elapsed) once the task is finished or out of retries
+    controller: utils_rate_limit.AIMDController adapting the number of requests in flight, fixed at max_in_flight if None
+    max_retries: maximum number of retries of a task
+    on_retry: function called with (task, error, attempt, delay) when a task is scheduled for a retry
+    """
+    task_iter = iter(tasks)
+    exhausted = False
+    in_flight = {}
+    # Heap of tasks waiting for a retry: (time the retry is due, sequence number, task, attempt)
+    retries = []
+    sequence = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            limit = max_in_flight if controller is None else min(controller.limit, max_in_flight)
+
+            # Top up the requests in flight, due retries first
+            while len(in_flight) < limit:
+                if retries and retries[0][0] <= time.time():
+                    _, _, task, attempt = heapq.heappop(retries)
+                elif not exhausted:
+                    try:
+                        task, attempt = next(task_iter), 0
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                else:
+                    break
+                if on_submit is not None:
+                    on_submit(task)
+                in_flight[executor.submit(_timed, fetch_fn, task)] = (task, attempt, time.time())
+
+            if not in_flight and not retries and exhausted:
+                break
+
+            # Wait for at least one request to finish, or until the next retry is due
+            timeout = max(0.0, retries[0][0] - time.time()) if retries else None
+            if not in_flight:
+                time.sleep(timeout)
+                continue
+            done, _ = concurrent.futures.wait(
+                in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in done:
+                task, attempt, started_at = in_flight.pop(future)
+                result, error, elapsed = future.result()
+
+                if error is not None and utils_rate_limit.is_throttling_error(error) and controller is not None:
+                    controller.on_throttle(started_at)
+                elif error is None and controller is not None:
+                    controller.on_success()
+
+                if error is not None and attempt < max_retries and utils_rate_limit.is_retryable_error(error):
+                    delay = utils_rate_limit.backoff_delay(attempt)
+                    sequence += 1
+                    heapq.heappush(retries, (time.time() + delay, sequence, task, attempt + 1))
+                    if on_retry is not None:
+                        on_retry(task, error, attempt + 1, delay)
+                    continue
+
+                if on_result is not None:
+                    on_result(task, result, error, elapsed)
@@ -0,0 +1,302 @@
+import os
+import numpy as np
+import pandas as pd
+from src import utils_nearest, utils_state_index
+
+# The canonical facilities and their source records are stored next to the source data
+FACILITIES_PATH = "../00_source_data/facilities.parquet"
+PROVENANCE_PATH = "../00_source_data/facility_sources.parquet"
+
+# Default paths of the source data read by the command line
+HYDROWASTE_PATH = "../HydroWASTE_v10/HydroWASTE_v10.csv"
+EPA_PATH = "../FRS_Wastewater/CWA_summaries_060314.gdb"
+OSM_PATH = "../WWTP_list_all_state/WWTP_all_states.csv"
+
+# Records of different sources closer than this distance in km are the same facility
+MATCH_RADIUS = 1.0
+
+# Name, longitude and latitude columns of the readers of every source
+SOURCE_COLUMNS = {
+    "osm": ("WWTP_name", "osm_longitude", "osm_latitude"),
+    "epa": ("CWP_NAME", "epa_lon", "epa_lat"),
+    "hw": ("hw_WWTP_NAME", "hw_lon", "hw_lat"),
+    "client": ("FacilityName", "lon", "lat"),
+}
+
+# The record of the first source in this order gives the name and location of a facility: OSM centroids lie on the plant, the EPA and HydroWASTE coordinates may be at an outfall or an address
+SOURCE_PRIORITY = ("osm", "epa", "hw", "client")
+
+def stack_sources(sources, columns=SOURCE_COLUMNS):
+    """
+    Stacks the records of all sources into one table of points. Records with missing coordinates are left out.
+
+    Args:
+    sources: dictionary mapping source names (keys of columns) to the dataframes of their readers
+    columns: dictionary mapping source names to tuples (name column, longitude column, latitude column)
+
+    Returns:
+    points: dataframe with columns source, source_row (row in the dataframe of the source), name, lon, lat and state (missing if the source has no state column)
+    """
+    frames = []
+    for source, df in sources.items():
+        name_col, lon_col, lat_col = columns[source]
+        frames.append(
+            pd.DataFrame(
+                {
+                    "source": source,
+                    "source_row": np.arange(len(df)),
+                    "name": df[name_col].to_numpy(dtype=object),
+                    "lon": df[lon_col].to_numpy(dtype=float),
+                    "lat": df[lat_col].to_numpy(dtype=float),
+                    "state": df["state"].to_numpy(dtype=object) if "state" in df.columns else None,
+                }
+            )
+        )
+    points = pd.concat(frames, ignore_index=True)
+    return points[points["lon"].notna() & points["lat"].notna()].reset_index(drop=True)
+
+def union_find(num_points, first, second):
+    """
+    Clusters points connected by pairs with a vectorized union-find: every round hooks the larger root of each pair onto the smaller one and then compresses the paths, until both points of every pair have the same root
+
+    Args:
+    num_points: number of points
+    first: numpy array of the first points of the pairs
+    second: numpy array of the second points of the pairs
+
+    Returns:
+    roots: numpy array with the smallest point of the cluster of every point
+    """
+    parent = np.arange(num_points)
+    while True:
+        root_1, root_2 = parent[first], parent[second]
+        linked = root_1 != root_2
+        if not linked.any():
+            return parent
+        np.minimum.at(parent, np.maximum(root_1, root_2)[linked], np.minimum(root_1, root_2)[linked])
+        # Path compression, every point points to its root
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+def cannot_link_union_find(num_points, first, second, groups):
+    """
+    Clusters points connected by pairs, merging the pairs in the given order with a union-find that refuses any merge that would put two points of the same group (e.g. source) into one cluster, also through chains of pairs
+
+    Args:
+    num_points: number of points
+    first: numpy array of the first points of the pairs
+    second: numpy array of the second points of the pairs
+    groups: numpy array of the integer group code of every point
+
+    Returns:
+    roots: numpy array with the smallest point of the cluster of every point
+    """
+    parent = np.arange(num_points)
+    # Set of the groups in every cluster as a bit mask, kept at the root of the cluster
+    members = [1 << int(group) for group in groups]
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in zip(first.tolist(), second.tolist()):
+        a, b = find(i), find(j)
+        if a == b or members[a] & members[b]:
+            continue
+        a, b = min(a, b), max(a, b)
+        parent[b] = a
+        members[a] |= members[b]
+
+    return np.array([find(i) for i in range(num_points)], dtype=np.int64)
+
+def cluster_points(points, radius=MATCH_RADIUS, link_same_source=False):
+    """
+    Finds all pairs of points within the radius in a single pass over one spatial index, and clusters the pairs into facilities
+
+    Args:
+    points: dataframe from stack_sources
+    radius: distance in km below which two points are the same facility
+    link_same_source: if False, a facility holds at most one record of every source, so nearby but distinct plants of one source are never merged, neither directly nor through a record of another source lying between them. The closest pairs are merged first.
+
+    Returns:
+    labels: numpy array with the cluster of every point, the smallest row of its cluster
+    """
+    index = utils_nearest.NearestIndex(points["lon"], points["lat"])
+    # The tree is searched by great-circle distance, slightly widened so no pair within the geodesic radius is missed
+    pairs = index.query_pairs(radius * 1.01)
+    pairs = pairs[pairs["distance"] < radius]
+    first, second = pairs["first"].to_numpy(), pairs["second"].to_numpy()
+    if link_same_source:
+        return union_find(len(points), first, second)
+
+    source_codes, _ = pd.factorize(points["source"])
+    different = source_codes[first] != source_codes[second]
+    order = np.argsort(pairs["distance"].to_numpy()[different], kind="stable")
+    return cannot_link_union_find(len(points), first[different][order], second[different][order], source_codes)
+
+def canonical_facilities(points, labels, priority=SOURCE_PRIORITY):
+    """
+    Builds the canonical facility table and the provenance of its records. Every facility takes its name, location and state from its record of the highest priority source; names shared by several facilities get the facility id appended, so they can be used as image file names.
+
+    Args:
+    points: dataframe from stack_sources
+    labels: numpy array of the clusters from cluster_points
+    priority: tuple of the source names, highest priority first
+
+    Returns:
+    facilities: dataframe with one row per facility and columns facility_id, wwtp_name, lon, lat, state, source (of the name and location), sources (all sources, "|"-separated in priority order), num_sources, num_records and num_<source> for every source
+    provenance: dataframe with one row per record and columns facility_id, source, source_row, name, lon, lat and distance (km from the facility location)
+    """
+    _, facility = np.unique(labels, return_inverse=True)
+    rank = {source: i for i, source in enumerate(priority)}
+    source_rank = points["source"].map(lambda s: rank.get(s, len(priority))).to_numpy()
+
+    # The first record of every facility in priority order is its representative
+    order = np.lexsort((np.arange(len(points)), source_rank, facility))
+    first = order[np.r_[True, facility[order][1:] != facility[order][:-1]]]
+    facilities = pd.DataFrame(
+        {
+            "facility_id": np.arange(len(first)),
+            "wwtp_name": points["name"].to_numpy(dtype=object)[first],
+            "lon": points["lon"].to_numpy()[first],
+            "lat": points["lat"].to_numpy()[first],
+            "state": points["state"].to_numpy(dtype=object)[first],
+            "source": points["source"].to_numpy(dtype=object)[first],
+        }
+    )
+    # Missing names are replaced by the facility id, duplicated names get it appended
+    names = facilities["wwtp_name"].fillna("Facility").astype(str)
+    duplicated = names.duplicated(keep=False) | facilities["wwtp_name"].isna()
+    facilities["wwtp_name"] = names.where(~duplicated, names + "_" + facilities["facility_id"].astype(str))
+
+    sources = [s for s in priority if (points["source"] == s).any()]
+    sources += sorted(set(points["source"]) - set(sources))
+    counts = {s: np.bincount(facility[(points["source"] == s).to_numpy()], minlength=len(first)) for s in sources}
+    facilities["sources"] = ["|".join(s for s in sources if counts[s][i]) for i in range(len(first))]
+    facilities["num_sources"] = sum((counts[s] > 0).astype(int) for s in sources)
+    facilities["num_records"] = np.bincount(facility, minlength=len(first))
+    for s in sources:
+        facilities[f"num_{s}"] = counts[s]
+
+    provenance = pd.DataFrame(
+        {
+            "facility_id": facility,
+            "source": points["source"],
+            "source_row": points["source_row"],
+            "name": points["name"],
+            "lon": points["lon"],
+            "lat": points["lat"],
+        }
+    )
+    provenance["distance"] = utils_nearest.geodesic_distance(
+        provenance["lon"], provenance["lat"], facilities["lon"].to_numpy()[facility], facilities["lat"].to_numpy()[facility]
+    )
+    provenance = provenance.sort_values(["facility_id", "distance"], kind="stable").reset_index(drop=True)
+    return facilities, provenance
+
+def resolve_facilities(sources, radius=MATCH_RADIUS, link_same_source=False, columns=SOURCE_COLUMNS, priority=SOURCE_PRIORITY):
+    """
+    Resolves the records of several WWTP data sources into canonical facilities, so every plant is downloaded and classified once
+
+    Args:
+    sources: dictionary mapping source names to the dataframes of their readers
+    radius: distance in km below which records of different sources are the same facility
+    link_same_source: if True, also link records of the same source within the radius, otherwise a facility holds at most one record of every source
+    columns: dictionary mapping source names to tuples (name column, longitude column, latitude column)
+    priority: tuple of the source names whose record gives the name and location of a facility, highest priority first
+
+    Returns:
+    facilities: dataframe of the canonical facilities, see canonical_facilities
+    provenance: dataframe of the source records of every facility
+    """
+    points = stack_sources(sources, columns)
+    labels = cluster_points(points, radius, link_same_source)
+    return canonical_facilities(points, labels, priority)
+
+def build_facilities(
+    HydroWaste_path,
+    EPA_path,
+    osm_path=None,
+    client_data_path=None,
+    us_boundary_path=utils_state_index.STATE_BOUNDARIES_PATH,
+    radius=MATCH_RADIUS,
+):
+    """
+    Reads the available sources with the readers of utils_plot and resolves them into canonical facilities
+
+    Args:
+    HydroWaste_path: path to the HydroWaste data
+    EPA_path: path to the EPA data
+    osm_path: optional path to the manually tagged OSM data
+    client_data_path: optional path to the client data
+    us_boundary_path: path to the US boundary shapefile
+    radius: distance in km below which records of different sources are the same facility
+
+    Returns:
+    facilities: dataframe of the canonical facilities
+    provenance: dataframe of the source records of every facility
+    """
+    from src import utils_plot
+
+    sources = {
+        "hw": utils_plot.read_HydroWaste_data(HydroWaste_path, us_boundary_path),
+        "epa": utils_plot.read_EPA_data(EPA_path, us_boundary_path=us_boundary_path),
+    }
+    if osm_path is not None:
+        sources["osm"] = utils_plot.read_osm_data(osm_path, us_boundary_path)
+    if client_data_path is not None:
+        sources["client"] = utils_plot.read_client_data(client_data_path)
+    return resolve_facilities(sources, radius)
+
+def write_facilities(facilities, provenance, facilities_path=FACILITIES_PATH, provenance_path=PROVENANCE_PATH):
+    """
+    Writes the canonical facilities and their provenance as Parquet files. The files are written under temporary names and renamed once complete.
+
+    Args:
+    facilities: dataframe of the canonical facilities
+    provenance: dataframe of the source records of every facility
+    facilities_path: path of the facilities file
+    provenance_path: path of the provenance file
+    """
+    for df, path in ((facilities, facilities_path), (provenance, provenance_path)):
+        part_path = f"{path}.{os.getpid()}.part"
+        df.to_parquet(part_path, index=False)
+        os.replace(part_path, path)
+
+def read_facilities(path=FACILITIES_PATH):
+    """
+    Reads the canonical facilities, with the columns wwtp_name, lon, lat and state used by the downloader
+    """
+    return pd.read_parquet(path)
+
+def main():
+    """
+    Builds and writes the canonical facilities of the available sources from the command line
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Resolve the WWTP records of all sources into canonical facilities")
+    parser.add_argument("--hydrowaste", default=HYDROWASTE_PATH, help="path of the HydroWASTE data")
+    parser.add_argument("--epa", default=EPA_PATH, help="path of the EPA data")
+    parser.add_argument("--osm", default=None, help="optional path of the manually tagged OSM data")
+    parser.add_argument("--client", default=None, help="optional path of the client data")
+    parser.add_argument("--us-boundary", default=utils_state_index.STATE_BOUNDARIES_PATH, help="path of the US boundary shapefile")
+    parser.add_argument("--radius", type=float, default=MATCH_RADIUS, help="distance in km below which records of different sources are the same facility")
+    parser.add_argument("--output", default=FACILITIES_PATH, help="path of the facilities Parquet file")
+    parser.add_argument("--provenance", default=PROVENANCE_PATH, help="path of the provenance Parquet file")
+    args = parser.parse_args()
+
+    facilities, provenance = build_facilities(args.hydrowaste, args.epa, args.osm, args.client, args.us_boundary, args.radius)
+    write_facilities(facilities, provenance, args.output, args.provenance)
+    print(f"Wrote {len(facilities)} facilities from {len(provenance)} records to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import functools
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src import utils_download_images, utils_ee_pipeline, utils_rate_limit
+
+def make_geotiff_bytes(bounds=(-100.01, 39.99, -99.99, 40.01), resolution=1e-4):
+    """
+    Creates an RGB GeoTIFF of the given bounds in memory, used as the payload of the fake endpoint so that downloads pass validation and can be cut into windows
+
+    Args:
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude) of the image
+    resolution: size of a pixel in degrees
+
+    Returns:
+    payload: bytes of the GeoTIFF
+    """
+    import numpy as np
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_origin
+
+    width = max(1, int(round((bounds[2] - bounds[0]) / resolution)))
+    height = max(1, int(round((bounds[3] - bounds[1]) / resolution)))
+    data = np.random.default_rng(0).integers(0, 255, (3, height, width), dtype=np.uint8)
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 3,
+        "dtype": "uint8",
+        "crs": "EPSG:4326",
+        "transform": from_origin(bounds[0], bounds[3], resolution, resolution),
+    }
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data)
+        return memfile.read()
+
+class FakeEarthEngineHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the fake Earth Engine download endpoint. Every GET request waits for the configured latency and then returns a GeoTIFF of the requested bounds (or the fixed payload of the server) in chunks. Requests beyond the concurrency limit of the server, and a random share of all requests, are throttled with HTTP 429.
+    """
+    def do_GET(self):
+        server = self.server
+
+        # Throttle like Earth Engine does: too many concurrent requests, or randomly injected quota errors
+        with server.lock:
+            server.active += 1
+            throttled = (
+                server.max_concurrent is not None and server.active > server.max_concurrent
+            ) or random.random() < server.throttle_rate
+            if throttled:
+                server.throttled += 1
+        try:
+            if throttled:
+                self.send_error(429, "Too many concurrent requests")
+                return
+            self._send_image()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _send_image(self):
+        server = self.server
+        time.sleep(server.latency)
+
+        payload = server.payload
+        if payload is None:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            bounds = tuple(float(v) for v in query["bbox"][0].split(","))
+            payload = make_geotiff_bytes(bounds, server.resolution)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        for i in range(0, len(payload), 1 << 16):
+            self.wfile.write(payload[i:i + (1 << 16)])
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+def start_fake_server(latency=0.5, payload=None, resolution=1e-4, max_concurrent=None, throttle_rate=0.0, port=0):
+    """
+    Starts the fake Earth Engine download endpoint in a background thread
+
+    Args:
+    latency: time in seconds the server waits before answering a request
+    payload: bytes returned for every request, a GeoTIFF of the requested bounds by default
+    resolution: size of a pixel in degrees of the generated GeoTIFFs
+    max_concurrent: number of concurrent requests above which requests are throttled, unlimited if None
+    throttle_rate: share of requests that are throttled at random
+    port: port to listen on, a free port is chosen if 0
+
+    Returns:
+    server: running ThreadingHTTPServer, with the base URL in server.url and the number of throttled requests in server.throttled. Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeEarthEngineHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.payload = payload
+    server.resolution = resolution
+    server.max_concurrent = max_concurrent
+    server.throttle_rate = throttle_rate
+    server.lock = threading.Lock()
+    server.active = 0
+    server.throttled = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def fake_download_url(base_url, bounds, latency=0.0):
+    """
+    URL function pointing at the fake endpoint, with the same signature as utils_download_images.download_url once base_url is bound with functools.partial
+
+    Args:
+    base_url: base URL of the fake server
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude) of the region
+    latency: time in seconds to wait, simulating the getDownloadURL call to Earth Engine
+
+    Returns:
+    url: URL of the image on the fake server
+    """
+    time.sleep(latency)
+    query = urllib.parse.urlencode({"bbox": ",".join(str(v) for v in bounds)})
+    return f"{base_url}/download?{query}"
+
+def benchmark(
+    num_tasks=200,
+    in_flight_values=(1, 4, 16, 32),
+    latency=0.3,
+    url_latency=0.1,
+    max_concurrent=None,
+    throttle_rate=0.0,
+    adaptive=False,
+    max_retries=5,
+):
+    """
+    Measures the throughput of the download pipeline against the fake endpoint for different numbers of requests in flight
+
+    Args:
+    num_tasks: number of images to download per run
+    in_flight_values: numbers of requests in flight to compare
+    latency: latency of the fake download endpoint in seconds
+    url_latency: latency of the simulated getDownloadURL call in seconds
+    max_concurrent: number of concurrent requests above which the endpoint throttles, unlimited if None
+    throttle_rate: share of requests the endpoint throttles at random
+    adaptive: if True, adapt the number of requests in flight with an AIMD controller, up to the compared value
+    max_retries: maximum number of retries of a throttled or failed download
+
+    Returns:
+    results: list of tuples (requests in flight, images per second, MB per second, throttled requests, failed images)
+    """
+    server = start_fake_server(latency=latency, max_concurrent=max_concurrent, throttle_rate=throttle_rate)
+    url_fn = functools.partial(fake_download_url, server.url, latency=url_latency)
+    tasks = [("Benchmark", f"WWTP_{i}", -100.0, 40.0) for i in range(num_tasks)]
+
+    results = []
+    try:
+        for max_in_flight in in_flight_values:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+
+                def fetch_fn(task):
+                    url = url_fn(utils_download_images.tile_bounds(task[2], task[3]))
+                    return utils_ee_pipeline.stream_to_file(url, os.path.join(tmp_dir, f"{task[1]}.tif"))
+
+                sizes = []
+                errors = []
+
+                def on_result(task, result, error, elapsed):
+                    if error is None:
+                        sizes.append(result[0])
+                    else:
+                        errors.append(error)
+
+                throttled_before = server.throttled
+                start = time.time()
+                utils_ee_pipeline.run_pipeline(
+                    tasks,
+                    fetch_fn,
+                    max_in_flight=max_in_flight,
+                    on_result=on_result,
+                    controller=utils_rate_limit.AIMDController(maximum=max_in_flight) if adaptive else None,
+                    max_retries=max_retries,
+                )
+                elapsed = time.time() - start
+
+            throttled = server.throttled - throttled_before
+            results.append((max_in_flight, num_tasks / elapsed, sum(sizes) / 1e6 / elapsed, throttled, len(errors)))
+            print(
+                f"in flight: {max_in_flight:3}  images/s: {num_tasks / elapsed:8.1f}  MB/s: {sum(sizes) / 1e6 / elapsed:8.2f}"
+                f"  throttled: {throttled:5}  failed: {len(errors):5}"
+            )
+    finally:
+        server.shutdown()
+
+    return results
+
+def main():
+    """
+    Runs the offline benchmark of the download pipeline from the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline against a fake Earth Engine endpoint")
+    parser.add_argument("--tasks", type=int, default=200, help="number of images to download per run")
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 4, 16, 32], help="numbers of requests in flight to compare")
+    parser.add_argument("--latency", type=float, default=0.3, help="latency of the download endpoint in seconds")
+    parser.add_argument("--url-latency", type=float, default=0.1, help="latency of the getDownloadURL call in seconds")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="number of concurrent requests above which the endpoint throttles")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests throttled at random")
+    parser.add_argument("--adaptive", action="store_true", help="adapt the number of requests in flight to throttling")
+    parser.add_argument("--retries", type=int, default=5, help="maximum number of retries of a throttled download")
+    args = parser.parse_args()
+
+    benchmark(
+        args.tasks,
+        args.in_flight,
+        args.latency,
+        args.url_latency,
+        args.max_concurrent,
+        args.throttle_rate,
+        args.adaptive,
+        args.retries,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import gzip
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from src import utils_overpass
+
+def make_state_response(num_plants=100, nodes_per_plant=8, seed=0, geom=False, bbox=(-120, 30, -75, 48)):
+    """
+    Creates an Overpass XML response with the layout of a state query (all nodes, then the ways referencing them), or of a tile query with the node coordinates inline (out geom), used to record responses without the network
+
+    Args:
+    num_plants: number of wastewater plant ways
+    nodes_per_plant: number of nodes of every way, the last one repeats the first to close the polygon
+    seed: seed of the random plant locations, plants with the same seed and index have the same way id
+    geom: if True, write the coordinates inline into the ways like out geom
+    bbox: tuple (west, south, east, north) the plants are placed in
+
+    Returns:
+    response: bytes of the XML response
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.column_stack([rng.uniform(bbox[0], bbox[2], num_plants), rng.uniform(bbox[1], bbox[3], num_plants)])
+    angles = np.linspace(0, 2 * np.pi, nodes_per_plant - 1, endpoint=False)
+
+    nodes = []
+    ways = []
+    for i, (lon, lat) in enumerate(centers):
+        refs = [1000000 * (seed + 1) + i * nodes_per_plant + j for j in range(nodes_per_plant - 1)]
+        points = [
+            (ref, f"{lat + 0.002 * np.sin(angle):.7f}", f"{lon + 0.002 * np.cos(angle):.7f}") for ref, angle in zip(refs, angles)
+        ]
+        if geom:
+            nds = "".join(f'\n    <nd ref="{ref}" lat="{y}" lon="{x}"/>' for ref, y, x in points + points[:1])
+        else:
+            nodes += [f'  <node id="{ref}" lat="{y}" lon="{x}"/>' for ref, y, x in points]
+            nds = "".join(f'\n    <nd ref="{ref}"/>' for ref in refs + refs[:1])
+        name = f'\n    <tag k="name" v="Plant {i}"/>' if i % 4 else ""
+        ways.append(f'  <way id="{500000 * (seed + 1) + i}">{nds}\n    <tag k="man_made" v="wastewater_plant"/>{name}\n  </way>')
+
+    return "\n".join(
+        ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="fake Overpass">'] + nodes + ways + ["</osm>"]
+    ).encode()
+
+def record_response(query, response, recordings_directory):
+    """
+    Stores a response as the recording of a query, in the same layout as the cache of utils_overpass, so any cache directory can be served as recordings
+
+    Args:
+    query: Overpass QL query
+    response: bytes of the response
+    recordings_directory: directory of the recorded responses
+    """
+    os.makedirs(recordings_directory, exist_ok=True)
+    with gzip.open(utils_overpass.cache_path(query, recordings_directory), "wb") as f:
+        f.write(response)
+
+class FakeOverpassHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the fake Overpass interpreter endpoint. Every POST request waits for the configured latency and then returns the recorded response of its query, or 404 if the query wasn't recorded.
+    """
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        query = urllib.parse.parse_qs(body).get("data", [""])[0]
+        path = utils_overpass.cache_path(query, server.recordings_directory)
+
+        with server.lock:
+            server.queries += 1
+        time.sleep(server.latency)
+
+        if not os.path.exists(path):
+            self.send_error(404, "Query was not recorded")
+            return
+        with gzip.open(path, "rb") as f:
+            response = f.read()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/osm3s+xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+def start_fake_server(recordings_directory, latency=0.0, port=0):
+    """
+    Starts the fake Overpass endpoint in a background thread
+
+    Args:
+    recordings_directory: directory of the recorded responses, e.g. an existing cache directory
+    latency: time in seconds the server waits before answering a query
+    port: port to listen on, a free port is chosen if 0
+
+    Returns:
+    server: running ThreadingHTTPServer, with the interpreter URL in server.url and the number of answered queries in server.queries. Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOverpassHandler)
+    server.daemon_threads = True
+    server.recordings_directory = recordings_directory
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.queries = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/api/interpreter"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def benchmark(num_states=50, num_plants=200, latency=1.0, max_concurrent=utils_overpass.MAX_CONCURRENT_QUERIES):
+    """
+    Measures an ingestion of recorded state responses from the fake endpoint, once with an empty cache and once rerun from the cache, and compares the parsing with overpy
+
+    Args:
+    num_states: number of states to ingest
+    num_plants: number of plants per state
+    latency: latency of the fake endpoint in seconds
+    max_concurrent: maximum number of concurrent queries
+
+    Returns:
+    results: dictionary with the seconds of the cold run, the cached run and of overpy parsing the same responses
+    """
+    import overpy
+
+    names = [f"State {i}" for i in range(num_states)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        recordings_directory = os.path.join(tmp_dir, "recordings")
+        cache_directory = os.path.join(tmp_dir, "cache")
+        for i, name in enumerate(names):
+            record_response(utils_overpass.state_query(name), make_state_response(num_plants, seed=i), recordings_directory)
+
+        server = start_fake_server(recordings_directory, latency)
+        try:
+            for run in ("cold", "cached"):
+                start = time.time()
+                states = utils_overpass.fetch_states(names, server.url, cache_directory, max_concurrent=max_concurrent)
+                results[run] = time.time() - start
+                print(f"{run:8} {results[run]:8.2f}s  queries sent: {server.queries:4}  plants: {sum(len(s['id']) for s in states.values())}")
+        finally:
+            server.shutdown()
+
+        start = time.time()
+        for name in names:
+            with gzip.open(utils_overpass.cache_path(utils_overpass.state_query(name), cache_directory), "rb") as f:
+                overpy.Overpass().parse_xml(f.read())
+        results["overpy"] = time.time() - start
+        print(f"overpy parsing of the cached responses: {results['overpy']:.2f}s")
+
+    return results
+
+def main():
+    """
+    Runs the offline benchmark of the OSM ingestion from the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the OSM ingestion against a fake Overpass endpoint")
+    parser.add_argument("--states", type=int, default=50, help="number of states to ingest")
+    parser.add_argument("--plants", type=int, default=200, help="number of plants per state")
+    parser.add_argument("--latency", type=float, default=1.0, help="latency of the endpoint in seconds")
+    parser.add_argument("--concurrent", type=int, default=utils_overpass.MAX_CONCURRENT_QUERIES, help="maximum number of concurrent queries")
+    args = parser.parse_args()
+
+    benchmark(args.states, args.plants, args.latency, args.concurrent)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+
+# Mean radius of the earth in km, used by the great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+def unit_vectors(lon, lat):
+    """
+    Converts longitudes and latitudes to 3D coordinates on the unit sphere, where the straight-line (chord) distance between two points grows monotonically with their great-circle distance
+
+    Args:
+    lon: array-like of longitudes in degrees
+    lat: array-like of latitudes in degrees
+
+    Returns:
+    xyz: numpy array of shape (n, 3)
+    """
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+def chord_length(distance_km):
+    """
+    Converts a great-circle distance in km to the chord length between the points on the unit sphere
+    """
+    return 2 * np.sin(np.minimum(distance_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+def haversine_distance(lon_1, lat_1, lon_2, lat_2):
+    """
+    Computes the great-circle distances between pairs of points on a sphere with the mean earth radius
+
+    Args:
+    lon_1, lat_1: array-like of the coordinates of the first points in degrees
+    lon_2, lat_2: array-like of the coordinates of the second points in degrees
+
+    Returns:
+    distance: numpy array of the distances in km
+    """
+    lon_1, lat_1, lon_2, lat_2 = (np.radians(np.asarray(v, dtype=float)) for v in (lon_1, lat_1, lon_2, lat_2))
+    a = np.sin((lat_2 - lat_1) / 2) ** 2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def geodesic_distance(lon_1, lat_1, lon_2, lat_2):
+    """
+    Computes the geodesic distances between pairs of points on the WGS84 ellipsoid, the same distances as geopy.distance.geodesic, in one vectorized call
+
+    Args:
+    lon_1, lat_1: array-like of the coordinates of the first points in degrees
+    lon_2, lat_2: array-like of the coordinates of the second points in degrees
+
+    Returns:
+    distance: numpy array of the distances in km
+    """
+    from pyproj import Geod
+
+    lon_1, lat_1, lon_2, lat_2 = (np.asarray(v, dtype=float) for v in (lon_1, lat_1, lon_2, lat_2))
+    _, _, distance = Geod(ellps="WGS84").inv(lon_1, lat_1, lon_2, lat_2)
+    return np.asarray(distance) / 1000
+
+# Distance kernels by name
+DISTANCES = {"geodesic": geodesic_distance, "haversine": haversine_distance}
+
+class NearestIndex:
+    """
+    Nearest-neighbour index over target points (e.g. the WWTPs of one data source). The KD-tree is built once on the 3D unit-sphere coordinates of the targets, so nearest neighbours are found by great-circle distance, and all source points are queried in one batch. Results refer to the targets by their row and name; the distances in km are computed afterwards with a vectorized kernel.
+
+    Args:
+    lon: array-like of the target longitudes
+    lat: array-like of the target latitudes
+    names: optional array-like of the target names
+    """
+    def __init__(self, lon, lat, names=None):
+        from scipy.spatial import cKDTree
+
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.names = None if names is None else np.asarray(names, dtype=object)
+        # Targets with missing coordinates are left out of the tree
+        self.rows = np.flatnonzero(~(np.isnan(self.lon) | np.isnan(self.lat)))
+        self.tree = cKDTree(unit_vectors(self.lon[self.rows], self.lat[self.rows]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _result(self, source, target, rank, lon, lat, distance):
+        # Builds the result table of source and target rows, with the target names and the distances
+        result = pd.DataFrame({"source": source, "target": target})
+        if rank is not None:
+            result["rank"] = rank
+        if self.names is not None:
+            result["target_name"] = np.append(self.names, None)[target]
+
+        distances = np.full(len(target), np.nan)
+        found = target >= 0
+        distances[found] = DISTANCES[distance](
+            lon[source[found]], lat[source[found]], self.lon[target[found]], self.lat[target[found]]
+        )
+        result["distance"] = distances
+        return result
+
+    def query(self, lon, lat, k=1, max_distance=None, distance="geodesic", workers=-1):
+        """
+        Finds the k nearest targets of every source point
+
+        Args:
+        lon: array-like of the source longitudes
+        lat: array-like of the source latitudes
+        k: number of nearest targets per source point
+        max_distance: optional great-circle distance in km beyond which targets are not returned
+        distance: "geodesic" (WGS84 ellipsoid) or "haversine" (sphere) distances in the result
+        workers: number of threads querying the tree, -1 for all cores
+
+        Returns:
+        nearest: dataframe with k rows per source point, ordered by source and rank, and columns source (row of the source point), target (row of the target, -1 if none was found), rank (0 for the nearest, only if k > 1), target_name (if the index has names) and distance (km)
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+
+        target = np.full((len(lon), k), -1, dtype=np.int64)
+        if len(valid) and len(self):
+            bound = np.inf if max_distance is None else chord_length(max_distance)
+            _, nearest = self.tree.query(
+                unit_vectors(lon[valid], lat[valid]), k=k, distance_upper_bound=bound, workers=workers
+            )
+            nearest = nearest.reshape(len(valid), k)
+            # Missing neighbours are returned as the number of points in the tree
+            found = nearest < len(self)
+            target[valid] = np.where(found, self.rows[np.minimum(nearest, len(self) - 1)], -1)
+
+        source = np.repeat(np.arange(len(lon)), k)
+        rank = np.tile(np.arange(k), len(lon)) if k > 1 else None
+        return self._result(source, target.ravel(), rank, lon, lat, distance)
+
+    def query_radius(self, lon, lat, radius, distance="geodesic", workers=-1):
+        """
+        Finds all targets within a great-circle radius of every source point
+
+        Args:
+        lon: array-like of the source longitudes
+        lat: array-like of the source latitudes
+        radius: radius in km
+        distance: "geodesic" (WGS84 ellipsoid) or "haversine" (sphere) distances in the result
+        workers: number of threads querying the tree, -1 for all cores
+
+        Returns:
+        pairs: dataframe with one row per pair, ordered by source and distance, and columns source, target, target_name (if the index has names) and distance (km); source points without targets in the radius have no rows
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+
+        if len(valid) and len(self):
+            neighbours = self.tree.query_ball_point(
+                unit_vectors(lon[valid], lat[valid]), r=chord_length(radius), workers=workers, return_sorted=False
+            )
+            counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+            source = np.repeat(valid, counts)
+            target = self.rows[np.fromiter((t for n in neighbours for t in n), dtype=np.int64, count=counts.sum())]
+        else:
+            source = target = np.empty(0, dtype=np.int64)
+
+        pairs = self._result(source, target, None, lon, lat, distance)
+        return pairs.sort_values(["source", "distance"], kind="stable").reset_index(drop=True)
+
+    def query_pairs(self, radius, distance="geodesic"):
+        """
+        Finds all pairs of targets within a great-circle radius of each other, in one pass over the tree
+
+        Args:
+        radius: radius in km
+        distance: "geodesic" (WGS84 ellipsoid) or "haversine" (sphere) distances in the result
+
+        Returns:
+        pairs: dataframe with one row per pair and columns first and second (rows of the targets, first < second) and distance (km)
+        """
+        pairs = self.tree.query_pairs(chord_length(radius), output_type="ndarray")
+        first = self.rows[pairs[:, 0]]
+        second = self.rows[pairs[:, 1]]
+        pairs = pd.DataFrame({"first": np.minimum(first, second), "second": np.maximum(first, second)})
+        pairs["distance"] = DISTANCES[distance](
+            self.lon[pairs["first"]], self.lat[pairs["first"]], self.lon[pairs["second"]], self.lat[pairs["second"]]
+        )
+        return pairs.sort_values(["first", "second"]).reset_index(drop=True)
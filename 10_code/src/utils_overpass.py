@@ -0,0 +1,487 @@
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+import requests
+from src import utils_rate_limit, utils_state_index
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+
+# Raw Overpass responses are cached next to the other source data, one gzipped file per query
+CACHE_DIRECTORY = "../00_source_data/osm_cache"
+
+# Cached responses older than this (in seconds) are downloaded again
+CACHE_TTL = 30 * 24 * 3600
+
+# The public Overpass instances allow two concurrent queries per IP address
+MAX_CONCURRENT_QUERIES = 2
+
+# State boundaries used to tile the states, and the GeoParquet files of the tiled ingestion
+STATE_BOUNDARIES_PATH = utils_state_index.STATE_BOUNDARIES_PATH
+PARQUET_DIRECTORY = "../00_source_data/osm_plants"
+
+def state_query(name):
+    """
+    Builds the Overpass query of all wastewater plants within a state
+
+    Args:
+    name: name of state
+
+    Returns:
+    query: Overpass QL query
+    """
+    return f"""
+        area[admin_level=4]["name"="{name}"]->.searchArea;
+        (
+        way["man_made"="wastewater_plant"](area.searchArea);
+        );
+        (._;>;);
+        out body;
+        """
+
+def query_key(query):
+    """
+    Hashes a query into the key of its cached response. Indentation and blank lines don't change the key.
+
+    Args:
+    query: Overpass QL query
+
+    Returns:
+    key: hex digest of the normalized query
+    """
+    normalized = "\n".join(line.strip() for line in query.strip().splitlines() if line.strip())
+    return hashlib.sha256(normalized.encode()).hexdigest()[:32]
+
+def cache_path(query, cache_directory=CACHE_DIRECTORY):
+    """
+    Returns the path of the cached response of a query
+    """
+    return os.path.join(cache_directory, f"{query_key(query)}.osm.gz")
+
+def is_cached(query, cache_directory=CACHE_DIRECTORY, ttl=CACHE_TTL):
+    """
+    Checks whether a query has a cached response younger than the TTL
+
+    Args:
+    query: Overpass QL query
+    cache_directory: directory of the cached responses
+    ttl: maximum age of the cached response in seconds, never expires if None
+
+    Returns:
+    True if the cached response can be used
+    """
+    path = cache_path(query, cache_directory)
+    if not os.path.exists(path):
+        return False
+    return ttl is None or time.time() - os.path.getmtime(path) < ttl
+
+def fetch_query(query, url=OVERPASS_URL, cache_directory=CACHE_DIRECTORY, ttl=CACHE_TTL, max_retries=5, timeout=900):
+    """
+    Gets the raw response of a query, from the cache if possible. Otherwise the response is streamed into a gzipped .part file that is renamed once complete, so an interrupted download never leaves a truncated cache entry. Throttled queries (HTTP 429), server errors and timeouts are retried with jittered exponential backoff.
+
+    Args:
+    query: Overpass QL query
+    url: URL of the Overpass interpreter endpoint
+    cache_directory: directory of the cached responses
+    ttl: maximum age of a cached response in seconds, never expires if None
+    max_retries: maximum number of retries of a failed query
+    timeout: timeout of the request in seconds
+
+    Returns:
+    path: path of the cached, gzipped response
+    """
+    path = cache_path(query, cache_directory)
+    if is_cached(query, cache_directory, ttl):
+        return path
+
+    os.makedirs(cache_directory, exist_ok=True)
+    part_path = f"{path}.{os.getpid()}.part"
+    attempt = 0
+    while True:
+        try:
+            with requests.post(url, data={"data": query}, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                with gzip.open(part_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+            os.replace(part_path, path)
+            return path
+        except Exception as error:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if attempt >= max_retries or not utils_rate_limit.is_retryable_error(error):
+                raise
+            delay = utils_rate_limit.backoff_delay(attempt, base=5.0)
+            print(f"Overpass query failed ({error}), retrying in {delay:.0f}s")
+            time.sleep(delay)
+            attempt += 1
+
+def parse_ways(path):
+    """
+    Parses a cached Overpass XML response of ways and their nodes into flat arrays. The file is read as a stream and every element is discarded once parsed, so no object is built per node and memory only holds the arrays.
+
+    Args:
+    path: path of the gzipped response
+
+    Returns:
+    ways: dictionary of numpy arrays
+    structure: {"id": way ids, "name": name tags (None if missing), "coords": (n, 2) array of longitude and latitude of the nodes of all ways, one way after the other, "offsets": start of every way in coords followed by the total number of nodes}
+    """
+    node_ids, node_lon, node_lat = [], [], []
+    way_ids, way_names, refs, counts = [], [], [], []
+
+    with gzip.open(path, "rb") as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            if elem.tag == "node":
+                node_ids.append(int(elem.get("id")))
+                node_lon.append(float(elem.get("lon")))
+                node_lat.append(float(elem.get("lat")))
+            elif elem.tag == "way":
+                way_refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+                way_ids.append(int(elem.get("id")))
+                way_names.append(tags.get("name"))
+                refs += way_refs
+                counts.append(len(way_refs))
+            elif elem.tag == "remark":
+                # Overpass reports timeouts and memory errors in a remark of an otherwise valid response
+                raise RuntimeError(f"Overpass error: {elem.text}")
+            else:
+                continue
+            root.clear()
+
+    # Look up the coordinates of the node references of all ways at once
+    node_ids = np.array(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids)
+    sorted_ids = node_ids[order]
+    refs = np.array(refs, dtype=np.int64)
+    position = np.searchsorted(sorted_ids, refs).clip(0, max(len(sorted_ids) - 1, 0))
+    found = sorted_ids[position] == refs if len(sorted_ids) > 0 else np.zeros(len(refs), dtype=bool)
+    index = order[position] if len(sorted_ids) > 0 else position
+
+    # Ways without nodes or with nodes missing from the response are dropped
+    counts = np.array(counts, dtype=np.int64)
+    way_of_node = np.repeat(np.arange(len(counts)), counts)
+    keep = counts > 0
+    keep[way_of_node[~found]] = False
+    if not keep.all():
+        print(f"Dropped {np.sum(~keep)} ways with missing nodes from {path}")
+    index = index[keep[way_of_node]]
+
+    return {
+        "id": np.array(way_ids, dtype=np.int64)[keep],
+        "name": np.array(way_names, dtype=object)[keep],
+        "coords": np.column_stack([np.array(node_lon, dtype=float)[index], np.array(node_lat, dtype=float)[index]]),
+        "offsets": np.concatenate([[0], np.cumsum(counts[keep])]),
+    }
+
+def fetch_state(name, url=OVERPASS_URL, cache_directory=CACHE_DIRECTORY, ttl=CACHE_TTL):
+    """
+    Gets the wastewater plants of a state as flat arrays, from the cache if possible
+
+    Args:
+    name: name of state
+    url: URL of the Overpass interpreter endpoint
+    cache_directory: directory of the cached responses
+    ttl: maximum age of a cached response in seconds, never expires if None
+
+    Returns:
+    ways: dictionary of numpy arrays from parse_ways
+    """
+    path = fetch_query(state_query(name), url, cache_directory, ttl)
+    try:
+        return parse_ways(path)
+    except (RuntimeError, ET.ParseError):
+        # A failed query must not be served from the cache on the next run
+        os.remove(path)
+        raise
+
+def fetch_states(names, url=OVERPASS_URL, cache_directory=CACHE_DIRECTORY, ttl=CACHE_TTL, max_concurrent=MAX_CONCURRENT_QUERIES):
+    """
+    Gets the wastewater plants of several states, running at most max_concurrent queries against Overpass at a time. Cached states don't send a query.
+
+    Args:
+    names: list of state names
+    url: URL of the Overpass interpreter endpoint
+    cache_directory: directory of the cached responses
+    ttl: maximum age of a cached response in seconds, never expires if None
+    max_concurrent: maximum number of concurrent queries
+
+    Returns:
+    states: dictionary of state names and their arrays from parse_ways
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = {
+            name: executor.submit(fetch_state, name, url, cache_directory, ttl) for name in names
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+def state_tiles(name, tile_size=1.0, boundaries_path=STATE_BOUNDARIES_PATH, bbox=None):
+    """
+    Splits the bounding box of a state into square tiles, keeping only the tiles that overlap the state
+
+    Args:
+    name: name of state
+    tile_size: width and height of the tiles in degrees
+    boundaries_path: path of the state boundaries with a NAME column
+    bbox: tuple (west, south, east, north) to tile instead of the state boundary, all tiles are kept
+
+    Returns:
+    tiles: list of tuples (west, south, east, north)
+    """
+    import shapely
+
+    if bbox is None:
+        boundaries = utils_state_index.read_regions(boundaries_path, ("NAME",))
+        state = boundaries.loc[boundaries["NAME"] == name, "geometry"].union_all()
+        bbox = state.bounds
+    else:
+        state = None
+
+    west, south, east, north = bbox
+    xs = np.arange(west, east, tile_size)
+    ys = np.arange(south, north, tile_size)
+    x, y = (a.ravel() for a in np.meshgrid(xs, ys))
+    tiles = shapely.box(x, y, np.minimum(x + tile_size, east), np.minimum(y + tile_size, north))
+    if state is not None:
+        tiles = tiles[shapely.intersects(tiles, state)]
+
+    return [tuple(b) for b in shapely.bounds(tiles).tolist()]
+
+def tile_query(name, bbox):
+    """
+    Builds the Overpass query of the wastewater plants of a state within one tile. The nodes of every way are returned inline with their coordinates (out geom), instead of as separate elements.
+
+    Args:
+    name: name of state
+    bbox: tuple (west, south, east, north) of the tile
+
+    Returns:
+    query: Overpass QL query
+    """
+    west, south, east, north = bbox
+    return f"""
+        [timeout:180];
+        area[admin_level=4]["name"="{name}"]->.searchArea;
+        way["man_made"="wastewater_plant"](area.searchArea)({south},{west},{north},{east});
+        out geom;
+        """
+
+def parse_geom_ways(path):
+    """
+    Parses a cached Overpass XML response of ways with inline geometry (out geom) into flat arrays, as a stream
+
+    Args:
+    path: path of the gzipped response
+
+    Returns:
+    ways: dictionary of numpy arrays with the structure of parse_ways
+    """
+    way_ids, way_names, lon, lat, counts = [], [], [], [], []
+
+    with gzip.open(path, "rb") as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            if elem.tag == "way":
+                nds = [nd for nd in elem.iter("nd") if nd.get("lat") is not None]
+                tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+                way_ids.append(int(elem.get("id")))
+                way_names.append(tags.get("name"))
+                lon += [float(nd.get("lon")) for nd in nds]
+                lat += [float(nd.get("lat")) for nd in nds]
+                counts.append(len(nds))
+                root.clear()
+            elif elem.tag == "remark":
+                raise RuntimeError(f"Overpass error: {elem.text}")
+
+    return {
+        "id": np.array(way_ids, dtype=np.int64),
+        "name": np.array(way_names, dtype=object),
+        "coords": np.column_stack([np.array(lon, dtype=float), np.array(lat, dtype=float)]),
+        "offsets": np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+    }
+
+def select_ways(ways, mask):
+    """
+    Selects a subset of the ways of the flat arrays
+
+    Args:
+    ways: dictionary of numpy arrays from parse_ways
+    mask: boolean array with one value per way
+
+    Returns:
+    ways: dictionary of numpy arrays of the selected ways
+    """
+    counts = np.diff(ways["offsets"])
+    return {
+        "id": ways["id"][mask],
+        "name": ways["name"][mask],
+        "coords": ways["coords"][np.repeat(mask, counts)],
+        "offsets": np.concatenate([[0], np.cumsum(counts[mask])]),
+    }
+
+def ways_to_polygons(ways):
+    """
+    Builds the polygons of all ways at once from the flat arrays. Rings that aren't closed are closed, and ways with fewer than three distinct nodes are dropped.
+
+    Args:
+    ways: dictionary of numpy arrays from parse_ways
+
+    Returns:
+    ways: dictionary of numpy arrays of the ways that form polygons
+    polygons: numpy array of shapely Polygons, one per way
+    """
+    import shapely
+
+    coords, offsets = ways["coords"], ways["offsets"]
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    first = coords[offsets[:-1][nonempty]]
+    last = coords[offsets[1:][nonempty] - 1]
+    unclosed = np.zeros(len(counts), dtype=bool)
+    unclosed[nonempty] = (first != last).any(axis=1)
+
+    # Close the open rings by repeating their first node
+    coords = np.insert(coords, offsets[1:][unclosed], coords[offsets[:-1][unclosed]], axis=0)
+    counts = counts + unclosed
+    keep = counts >= 4
+    if not keep.all():
+        print(f"Dropped {np.sum(~keep)} ways with fewer than three nodes")
+
+    ways = select_ways({**ways, "coords": coords, "offsets": np.concatenate([[0], np.cumsum(counts)])}, keep)
+    polygons = shapely.from_ragged_array(
+        shapely.GeometryType.POLYGON, ways["coords"], (ways["offsets"], np.arange(len(ways["id"]) + 1))
+    )
+    return ways, polygons
+
+def equal_area_centroids(polygons):
+    """
+    Computes the centroids of polygons in the cylindrical equal-area projection ('+proj=cea'), to account for the curvature of the earth, with a single projection of all their coordinates
+
+    Args:
+    polygons: numpy array of shapely Polygons in longitude and latitude
+
+    Returns:
+    lon: numpy array of the longitudes of the centroids
+    lat: numpy array of the latitudes of the centroids
+    """
+    import shapely
+    from pyproj import Transformer
+
+    if len(polygons) == 0:
+        return np.empty(0), np.empty(0)
+
+    to_cea = Transformer.from_crs("EPSG:4326", "+proj=cea", always_xy=True)
+    _, coords, offsets = shapely.to_ragged_array(polygons)
+    x, y = to_cea.transform(coords[:, 0], coords[:, 1])
+    projected = shapely.from_ragged_array(shapely.GeometryType.POLYGON, np.column_stack([x, y]), offsets)
+    centroids = shapely.get_coordinates(shapely.centroid(projected))
+    return to_cea.transform(centroids[:, 0], centroids[:, 1], direction="INVERSE")
+
+def _geoparquet_schema():
+    """
+    Returns the arrow schema of the plant GeoParquet files, with the GeoParquet metadata of the WKB geometry column in longitude and latitude
+    """
+    import pyarrow as pa
+    from pyproj import CRS
+
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {"encoding": "WKB", "geometry_types": ["Polygon"], "crs": CRS.from_epsg(4326).to_json_dict()}
+        },
+    }
+    return pa.schema(
+        [("osm_id", pa.int64()), ("WWTP_name", pa.string()), ("geometry", pa.binary())],
+        metadata={"geo": json.dumps(geo)},
+    )
+
+def write_state_parquet(
+    name,
+    output_path=None,
+    tile_size=1.0,
+    url=OVERPASS_URL,
+    cache_directory=CACHE_DIRECTORY,
+    ttl=CACHE_TTL,
+    max_concurrent=MAX_CONCURRENT_QUERIES,
+    boundaries_path=STATE_BOUNDARIES_PATH,
+    bbox=None,
+):
+    """
+    Gets the wastewater plants of a state tile by tile and writes them incrementally to a GeoParquet file, one row group per tile, so memory stays flat however large the state is. The tiles are queried concurrently and cached like state queries. Plants are keyed by their OSM way id, so plants crossing tile borders are only written once and plants sharing a name are all kept. Plants without a name are named after their id.
+
+    Args:
+    name: name of state
+    output_path: path of the GeoParquet file, {PARQUET_DIRECTORY}/{name}.parquet if None
+    tile_size: width and height of the tiles in degrees
+    url: URL of the Overpass interpreter endpoint
+    cache_directory: directory of the cached responses
+    ttl: maximum age of a cached response in seconds, never expires if None
+    max_concurrent: maximum number of concurrent queries
+    boundaries_path: path of the state boundaries shapefile
+    bbox: tuple (west, south, east, north) to tile instead of the state boundary
+
+    Returns:
+    output_path: path of the GeoParquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import shapely
+
+    if output_path is None:
+        output_path = os.path.join(PARQUET_DIRECTORY, f"{name}.parquet")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    queries = [tile_query(name, tile) for tile in state_tiles(name, tile_size, boundaries_path, bbox)]
+    schema = _geoparquet_schema()
+    seen = set()
+    part_path = output_path + ".part"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        paths = executor.map(lambda query: fetch_query(query, url, cache_directory, ttl), queries)
+
+        with pq.ParquetWriter(part_path, schema) as writer:
+            # Tiles are parsed and written one at a time, in order, while the next ones download
+            for path in paths:
+                ways = parse_geom_ways(path)
+                new = ~np.isin(ways["id"], list(seen))
+                # A way can also be repeated within a tile response
+                new &= np.isin(np.arange(len(new)), np.unique(ways["id"], return_index=True)[1])
+                ways, polygons = ways_to_polygons(select_ways(ways, new))
+                seen.update(ways["id"].tolist())
+
+                names = [n if n is not None else f"Plant_{i}" for i, n in zip(ways["id"], ways["name"])]
+                writer.write_table(pa.table(
+                    {"osm_id": ways["id"], "WWTP_name": names, "geometry": shapely.to_wkb(polygons)},
+                    schema=schema,
+                ))
+
+    os.replace(part_path, output_path)
+    print(f"{name}: {len(seen)} plants from {len(queries)} tiles written to {output_path}")
+    return output_path
+
+def read_state_parquet(path):
+    """
+    Reads the plants of a GeoParquet file written by write_state_parquet
+
+    Args:
+    path: path of the GeoParquet file
+
+    Returns:
+    gdf: geopandas dataframe with columns osm_id, WWTP_name and geometry
+    """
+    import geopandas as gpd
+
+    return gpd.read_parquet(path)
@@ -6,10 +6,10 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import seaborn as sns
 import ast
-from scipy.spatial import cKDTree
-from geopy.distance import geodesic
+import os
 from rasterio.plot import show
 import statsmodels.api as sm
+from src import utils_boundaries, utils_cache, utils_density, utils_nearest, utils_raster, utils_state_index, utils_summary_cube, utils_web_map
 
 
 def state_name_abbrev_pair():
@@ -80,6 +80,7 @@ def state_name_abbrev_pair():
     return state_pair
 
 
+@utils_cache.cached_reader("HydroWaste_path", "us_boundary_path")
 def read_HydroWaste_data(HydroWaste_path, us_boundary_path):
     """
     Read HydroWaste data, filter out the data points that are not in the US, and return a dataframe with columns:
@@ -97,23 +98,33 @@ def read_HydroWaste_data(HydroWaste_path, us_boundary_path):
     """
     hw_data = pd.read_csv(HydroWaste_path, encoding="latin1")
     hw_us = hw_data[hw_data["COUNTRY"] == "United States"]
-    gdf_hw_us = gpd.GeoDataFrame(
-        hw_us, geometry=gpd.points_from_xy(hw_us.LON_WWTP, hw_us.LAT_WWTP)
+    hw_us.reset_index(drop=True, inplace=True)
+
+    # Assign the states from the coordinates with the shared state index
+    states = utils_state_index.assign_states(
+        hw_us["LON_WWTP"], hw_us["LAT_WWTP"], boundaries_path=us_boundary_path
     )
-    gdf_hw_us.crs = {"init": "epsg:4326"}
-    gdf_hw_us.reset_index(drop=True, inplace=True)
-
-    us_boundary = gpd.read_file(us_boundary_path)
-    gdf_hw_us = gdf_hw_us.to_crs(us_boundary.crs)
-    gdf_hw_us = gpd.sjoin(gdf_hw_us, us_boundary, how="inner", op="within")
-    df_hw_us = gdf_hw_us.loc[
-        :, ["WWTP_NAME", "LAT_WWTP", "LON_WWTP", "NAME", "geometry"]
-    ]
-    df_hw_us.columns = ["hw_WWTP_NAME", "hw_lat", "hw_lon", "state", "geometry"]
+    inside = states["state"].notna().to_numpy()
+
+    df_hw_us = gpd.GeoDataFrame(
+        {
+            "hw_WWTP_NAME": hw_us["WWTP_NAME"],
+            "hw_lat": hw_us["LAT_WWTP"],
+            "hw_lon": hw_us["LON_WWTP"],
+            "state": states["state"],
+        },
+        geometry=gpd.points_from_xy(hw_us["LON_WWTP"], hw_us["LAT_WWTP"]),
+        crs="EPSG:4326",
+    )[inside]
     return df_hw_us
 
 
-def read_EPA_data(EPA_path):
+# Name patterns of the EPA facilities that are WWTPs
+EPA_WWTP_PATTERNS = ["WWTP", "WWTF", "STP", "WQCF", "WRP", "WWRF"]
+
+
+@utils_cache.cached_reader("EPA_path", "us_boundary_path")
+def read_EPA_data(EPA_path, bbox=None, state=None, us_boundary_path=utils_state_index.STATE_BOUNDARIES_PATH):
     """
     Read EPA data, filter out the data points that are not WWTP, and return a dataframe with columns:
     - CWP_NAME: name of the WWTP
@@ -121,55 +132,202 @@ def read_EPA_data(EPA_path):
     - geometry: geometry of the WWTP
     - epa_lon: longitude of the WWTP
     - epa_lat: latitude of the WWTP
+    - state: name of the state containing the WWTP, assigned like for the other sources
+
+    Only the needed columns are read, and the name, state and bounding box filters are applied by the Arrow-based pyogrio engine while reading, so only the matching facilities are loaded.
 
     Input:
     - EPA_path: path to the EPA data
+    - bbox: optional tuple (min longitude, min latitude, max longitude, max latitude) to read
+    - state: optional state abbreviation or name to read
+    - us_boundary_path: path to the US boundary shapefile
 
     Output:
-    - epa_WWTP: dataframe with columns CWP_NAME, CWP_STATE, geometry, epa_lon, epa_lat
-    """
-    df_epa = gpd.read_file(EPA_path)
+    - epa_WWTP: dataframe with columns CWP_NAME, CWP_STATE, geometry, epa_lon, epa_lat, state
+    """
+    import pyogrio
+    from pyproj import CRS, Transformer
+
+    where = "(" + " OR ".join(f"CWP_NAME LIKE '%{pattern}%'" for pattern in EPA_WWTP_PATTERNS) + ")"
+    if state is not None:
+        state = state_name_abbrev_pair().get(state, state)
+        where += f" AND CWP_STATE = '{state}'"
+
+    # The bounding box is filtered in the coordinate reference system of the layer
+    if bbox is not None:
+        layer_crs = pyogrio.read_info(EPA_path)["crs"]
+        if layer_crs is not None and not CRS(layer_crs).equals(CRS.from_epsg(4326)):
+            bbox = Transformer.from_crs("EPSG:4326", layer_crs, always_xy=True).transform_bounds(*bbox)
+
+    df_epa = gpd.read_file(
+        EPA_path,
+        engine="pyogrio",
+        use_arrow=True,
+        columns=["CWP_NAME", "CWP_STATE"],
+        where=where,
+        bbox=bbox,
+    )
     df_epa = df_epa.to_crs(epsg=4326)
     gpd_epa = df_epa.loc[:, ["CWP_NAME", "CWP_STATE", "geometry"]]
-    epa_WWTP = gpd_epa[gpd_epa["CWP_NAME"].str.contains("WWTP|WWTF|STP|WQCF|WRP|WWRF")]
+    # LIKE is case-insensitive, the patterns are matched exactly on the remaining rows
+    epa_WWTP = gpd_epa[gpd_epa["CWP_NAME"].str.contains("|".join(EPA_WWTP_PATTERNS))].copy()
     epa_WWTP.drop_duplicates(inplace=True)
     epa_WWTP.reset_index(drop=True, inplace=True)
     epa_WWTP.loc[:, "epa_lon"] = epa_WWTP.geometry.x
     epa_WWTP.loc[:, "epa_lat"] = epa_WWTP.geometry.y
+    epa_WWTP["state"] = utils_state_index.assign_states(
+        epa_WWTP["epa_lon"], epa_WWTP["epa_lat"], boundaries_path=us_boundary_path
+    )["state"].to_numpy()
     return epa_WWTP
 
 
-def read_osm_data(osm_path):
+def report_malformed(df, valid, column, source):
     """
-    Read manually tagged OSM data and return a dataframe with columns:
-    - osm_name: name of the WWTP
-    - osm_longitude: longitude of the WWTP
-    - osm_latitude: latitude of the WWTP
+    Report the rows whose coordinates could not be parsed
+
+    Input:
+    - df: dataframe that was parsed
+    - valid: boolean array, False for the malformed rows
+    - column: name of the parsed column
+    - source: name of the data source, for the report
+    """
+    if valid.all():
+        return
+    rows = df.index[~valid]
+    print(
+        f"Skipped {len(rows)} rows of {source} with malformed {column}: "
+        f"{list(rows[:10])}{' ...' if len(rows) > 10 else ''}"
+    )
+
+
+# Decimal number as written in WKT and coordinate strings
+NUMBER_PATTERN = r"^[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$"
+
+
+def to_arrow_strings(values):
+    """
+    Convert an array-like of strings to an Arrow string array, missing and non-string values become null
+
+    Input:
+    - values: array-like of strings
+
+    Output:
+    - strings: pyarrow string array
+    """
+    import pyarrow as pa
+
+    return pa.array(pd.Series(values).astype("string"), type=pa.large_string())
+
+
+def parse_floats(strings):
+    """
+    Parse an Arrow string array into floats at once. Strings that are not a number become NaN instead of raising.
+
+    Input:
+    - strings: pyarrow string array
+
+    Output:
+    - values: float64 numpy array
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    strings = pc.utf8_trim_whitespace(strings)
+    is_number = pc.fill_null(pc.match_substring_regex(strings, NUMBER_PATTERN), False)
+    numbers = pc.if_else(is_number, strings, pa.scalar(None, type=strings.type))
+    return pc.cast(numbers, pa.float64()).to_numpy(zero_copy_only=False)
+
+
+def split_pairs(strings, separator=None):
+    """
+    Split every string of an Arrow string array into exactly two parts
+
+    Input:
+    - strings: pyarrow string array
+    - separator: string separating the parts, runs of whitespace if None
+
+    Output:
+    - first: pyarrow string array of the first parts, null if the string has not exactly two parts
+    - second: pyarrow string array of the second parts, null if the string has not exactly two parts
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if separator is None:
+        parts = pc.utf8_split_whitespace(strings)
+    else:
+        parts = pc.split_pattern(strings, separator)
+    is_pair = pc.fill_null(pc.equal(pc.list_value_length(parts), 2), False)
+    parts = pc.if_else(is_pair, parts, pa.scalar(None, type=parts.type))
+    return pc.list_element(parts, 0), pc.list_element(parts, 1)
+
+
+def parse_wkt_points(wkt):
+    """
+    Parse WKT point strings into longitude and latitude arrays at once
+
+    Input:
+    - wkt: array-like of WKT strings, e.g. "POINT (-121.8 37.6)"
+
+    Output:
+    - lon: float64 array of longitudes, NaN for malformed rows
+    - lat: float64 array of latitudes, NaN for malformed rows
+    - valid: boolean array, False for rows that are not a point with two coordinates
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    strings = pc.utf8_trim_whitespace(to_arrow_strings(wkt))
+    is_point = pc.fill_null(pc.match_substring_regex(strings, r"^POINT\s*\([^()]*\)$"), False)
+    # Strip the leading "POINT (" and the trailing ")" to keep the coordinates
+    coordinates = pc.utf8_trim(
+        pc.utf8_slice_codeunits(pc.if_else(is_point, strings, pa.scalar(None, type=strings.type)), 5),
+        characters=" \t()",
+    )
+    lon, lat = (parse_floats(part) for part in split_pairs(coordinates))
+    valid = ~(np.isnan(lon) | np.isnan(lat))
+    return lon, lat, valid
+
+
+def parse_lat_lon_pairs(lat_lon):
     """
+    Parse "lat, lon" strings into latitude and longitude arrays at once
+
+    Input:
+    - lat_lon: array-like of strings, e.g. "37.6, -121.8"
 
-    def extract_lon_lat(centroid_str):
-        """
-        Extract longitude and latitude from the centroid string
+    Output:
+    - lat: float64 array of latitudes, NaN for malformed rows
+    - lon: float64 array of longitudes, NaN for malformed rows
+    - valid: boolean array, False for rows without two numbers
+    """
+    lat, lon = (parse_floats(part) for part in split_pairs(to_arrow_strings(lat_lon), ","))
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    return lat, lon, valid
 
-        Input:
-        - centroid_str: centroid string
 
-        Output:
-        - lon: longitude
-        - lat: latitude
-        """
-        clean_str = centroid_str.replace("POINT (", "").replace(")", "")
-        lon, lat = map(float, clean_str.split(" "))
-        return lon, lat
+@utils_cache.cached_reader("osm_path", "us_boundary_path")
+def read_osm_data(osm_path, us_boundary_path=utils_state_index.STATE_BOUNDARIES_PATH):
+    """
+    Read manually tagged OSM data and return a dataframe with columns:
+    - osm_name: name of the WWTP
+    - osm_longitude: longitude of the WWTP
+    - osm_latitude: latitude of the WWTP
+    - state: name of the state containing the WWTP, assigned like for the other sources
 
+    Rows whose centroid is not a valid WKT point are reported and skipped.
+    """
     df_osm = pd.read_csv(
         osm_path,
     )
-    df_osm["osm_longitude"], df_osm["osm_latitude"] = zip(
-        *df_osm["centroid"].apply(extract_lon_lat)
-    )
-    df_osm = df_osm.drop(columns=["centroid"])
+    lon, lat, valid = parse_wkt_points(df_osm["centroid"])
+    report_malformed(df_osm, valid, "centroid", osm_path)
+    df_osm["osm_longitude"], df_osm["osm_latitude"] = lon, lat
+    df_osm = df_osm[valid].drop(columns=["centroid"])
     df_osm.reset_index(drop=True, inplace=True)
+    df_osm["state"] = utils_state_index.assign_states(
+        df_osm["osm_longitude"], df_osm["osm_latitude"], boundaries_path=us_boundary_path
+    )["state"]
     return df_osm
 
 
@@ -189,14 +347,14 @@ def osm2gdf(osm_path):
     gdf_osm = gpd.GeoDataFrame(
         df_osm,
         geometry=gpd.points_from_xy(df_osm.osm_longitude, df_osm.osm_latitude),
+        crs="EPSG:4326",
     )
-    gdf_osm.crs = "EPSG:4326"
     return gdf_osm
 
 
 def read_client_data(client_data_path):
     """
-    Read client data and return a geodataframe
+    Read client data and return a geodataframe. Rows whose "Lat, Long" is not a pair of numbers are reported and skipped.
 
     Input:
     - client_data_path: path to the client data file
@@ -208,108 +366,152 @@ def read_client_data(client_data_path):
 
     df_client = pd.read_excel(client_data_path)
     df_client = df_client.loc[:, ["FacilityName", "Lat, Long"]]
-    df_client["lat"] = df_client["Lat, Long"].apply(lambda x: float(x.split(",")[0]))
-    df_client["lon"] = df_client["Lat, Long"].apply(lambda x: float(x.split(",")[1]))
-    df_client.drop(columns=["Lat, Long"], inplace=True)
+    df_client["lat"], df_client["lon"], valid = parse_lat_lon_pairs(df_client["Lat, Long"])
+    report_malformed(df_client, valid, "Lat, Long", client_data_path)
+    df_client = df_client[valid].drop(columns=["Lat, Long"])
 
     # convert to geodataframe
     gdf_client = gpd.GeoDataFrame(
-        df_client, geometry=gpd.points_from_xy(df_client.lon, df_client.lat)
+        df_client, geometry=gpd.points_from_xy(df_client.lon, df_client.lat), crs="epsg:4326"
     )
-    gdf_client.crs = "epsg:4326"
     return gdf_client
 
 
-def interactive_map(df):
+def interactive_map(
+    df,
+    color_col=None,
+    name_col=None,
+    lat_col="osm_latitude",
+    lon_col="osm_longitude",
+    aggregate=True,
+):
     """
     Create an interactive map with the given dataframe
 
+    The points are embedded as one compact array clustered in the browser, and the lower zoom levels show pre-aggregated grid layers (utils_web_map), so maps of all WWTPs of the country stay small.
+
     Input:
     - df: dataframe with osm data
+    - color_col: optional column to color the points by, e.g. the source, the label or the model probability
+    - name_col: optional column with the names shown when hovering over a point
+    - lat_col: column name of the latitude
+    - lon_col: column name of the longitude
+    - aggregate: if True, show aggregated grid layers at the lower zoom levels
 
     Output:
     - m: interactive map with the given data
     """
-    import folium
-    from folium.plugins import MarkerCluster
-    from folium.plugins import FastMarkerCluster
-
-    # Create a map
-    m = folium.Map(zoom_start=6)
-
-    # Add points to the map
-    mc = MarkerCluster()
-    for idx, row in df.iterrows():
-        mc.add_child(
-            folium.Marker(location=[row["osm_latitude"], row["osm_longitude"]])
-        )
-    m.add_child(mc)
-    return m
+    return utils_web_map.point_map(
+        df[lat_col],
+        df[lon_col],
+        color_values=None if color_col is None else df[color_col],
+        names=None if name_col is None else df[name_col],
+        legend_title=color_col or "",
+        aggregate_zooms=utils_web_map.AGGREGATE_ZOOMS if aggregate else (),
+    )
 
 
-def plt_world_map(gdf, us_boundary, color, title):
+def plt_world_map(gdf, us_boundary, color, title, mode="points", bin_pixels=4):
     """
     Plot the WWTP data on a world map
 
+    In "density" mode the points are binned into a grid at the resolution of the figure and drawn as one image over us_boundary, so the rendering time doesn't grow with the number of points and dense areas don't overplot. Several sources can be passed as a dictionary to plot them together, each in its own color channel.
+
     Input:
-    - gdf: geodataframe with WWTP data
+    - gdf: geodataframe with WWTP data, or dictionary mapping source names to geodataframes
     - us_boundary: geodataframe with US boundary
-    - color: color of the WWTP data points
+    - color: color of the WWTP data points, or dictionary mapping source names to colors
     - title: title of the plot
+    - mode: "points" to draw every WWTP as a marker, "density" to draw the number of WWTPs per bin
+    - bin_pixels: width and height of the bins in screen pixels, in "density" mode
     """
+    sources = gdf if isinstance(gdf, dict) else {None: gdf}
+    source_colors = color if isinstance(color, dict) else {name: color for name in sources}
+    extent = (-128, -65, 24, 50)
 
     fig, ax = plt.subplots()
     fig.set_size_inches(20, 20)
     us_boundary.plot(ax=ax, color="lightgrey", alpha=0.5, edgecolor="grey")
-    gdf.plot(ax=ax, color=color, markersize=2)
     # set x and y axis limits
-    ax.set_xlim(-128, -65)
-    ax.set_ylim(24, 50)
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+
+    if mode == "density":
+        # one bin per bin_pixels of the plotted area
+        ax.apply_aspect()
+        bbox = ax.get_window_extent()
+        shape = (
+            max(1, int(bbox.height / bin_pixels)),
+            max(1, int(bbox.width / bin_pixels)),
+        )
+        grids = [
+            utils_density.density_grid(source.geometry.x, source.geometry.y, extent, shape)
+            for source in sources.values()
+        ]
+        image = utils_density.density_image(grids, [source_colors[name] for name in sources])
+        ax.imshow(
+            image,
+            extent=extent,
+            origin="lower",
+            interpolation="nearest",
+            aspect=ax.get_aspect(),
+            zorder=2,
+        )
+    else:
+        for name, source in sources.items():
+            source.plot(ax=ax, color=source_colors[name], markersize=2, label=name)
+
+    if isinstance(gdf, dict):
+        from matplotlib.patches import Patch
+
+        ax.legend(
+            handles=[Patch(color=source_colors[name], label=name) for name in sources],
+            fontsize=15,
+        )
     plt.title(title, fontsize=20)
     plt.axis("off")
     plt.show()
 
 
 def statewise_WWTP_count(
-    hw_df, target_df, target_df_name, state_name_abbrev_pair, hw_color, target_color
+    hw_df,
+    target_df,
+    target_df_name,
+    state_name_abbrev_pair,
+    hw_color,
+    target_color,
+    cube_path=None,
 ):
     """
-    Calculate the number of WWTPs in each state from HydroWASTE and the target dataset, and plot the results
+    Calculate the number of WWTPs in each state from HydroWASTE and the target dataset, and plot the results. The counts are computed from the dataframes, or read from the summary cube written by python -m src.utils_summary_cube if cube_path is given, the file exists and it holds the target dataset.
 
     Input:
     - hw_df: dataframe with HydroWASTE data
     - target_df: dataframe with the target data
-    - target_df_name: name of the target dataset
+    - target_df_name: name of the target dataset, e.g. "epa" or "osm" (a key of utils_summary_cube.STATE_COLUMNS)
     - state_name_abbrev_pair: dictionary that maps state names to state abbreviations
     - hw_color: color of the HydroWASTE data
     - target_color: color of the target data
+    - cube_path: optional path of the stored summary cube (e.g. utils_summary_cube.SUMMARY_CUBE_PATH) to read the counts from instead of the dataframes, which then need to be the inputs of the cube
 
     Output:
     - sorted_wwtp_num: dataframe with the number of WWTPs in each state from HydroWASTE and the target dataset
     """
-    WWTP_num = pd.DataFrame()
-    for state_, state in state_name_abbrev_pair.items():
-        hw_num = len(hw_df[hw_df["state"] == state_])
-        if target_df_name == "epa":
-            target_num = len(target_df[target_df["CWP_STATE"] == state])
-        elif target_df_name == "osm":
-            target_num = len(target_df[target_df["state"] == state_])
-        WWTP_num = pd.concat(
-            [
-                WWTP_num,
-                pd.DataFrame(
-                    {
-                        "state": [state],
-                        "hw_num": [hw_num],
-                        f"{target_df_name}_num": [target_num],
-                    }
-                ),
-            ]
+    columns = ["state", "hw_num", f"{target_df_name}_num"]
+    cube = None
+    if cube_path is not None and os.path.exists(cube_path):
+        cube = utils_summary_cube.read_summary_cube(cube_path)
+        if set(columns) <= set(cube.columns):
+            # Rows in the order of state_name_abbrev_pair, like a freshly built cube
+            cube = cube.set_index("state").reindex(list(state_name_abbrev_pair.values())).reset_index()
+        else:
+            cube = None
+    if cube is None:
+        # Count both datasets per state in one grouped pass, with the manual OSM counts of California and Texas
+        cube = utils_summary_cube.build_summary_cube(
+            {"hw": hw_df, target_df_name: target_df}, state_name_abbrev_pair
         )
-    if target_df_name == "osm":
-        WWTP_num.loc[WWTP_num["state"] == "CA", f"{target_df_name}_num"] = 116 + 183
-        WWTP_num.loc[WWTP_num["state"] == "TX", f"{target_df_name}_num"] = 198 + 104
-    WWTP_num.reset_index(drop=True, inplace=True)
+    WWTP_num = cube.loc[:, columns]
 
     # print the number of WWTPs in each state
     print(f"Number of WWTPs in the US from HydroWASTE: ", len(hw_df))
@@ -347,51 +549,20 @@ def statewise_WWTP_count(
     return sorted_wwtp_num
 
 
-def closest_point(point, points):
-    """
-    Find closest point from a list of points.
-
-    Input:
-    - point: a given point
-    - points: a list of points
-
-    Output:
-    - the closest point in the list of points to the given point
-    """
-    return points[cKDTree(points).query(point)[1]]
-
-
-def calculate_distance(
-    row,
-    lat_col_1="hw_lat",
-    lon_col_1="hw_lon",
-    lat_col_2="epa_lat",
-    lon_col_2="epa_lon",
-):
-    """
-    Calculate the distance between two points
-
-    Input:
-    - row: row of a dataframe
-    - lat_col_1: column name of the latitude of the first point
-    - lon_col_1: column name of the longitude of the first point
-    - lat_col_2: column name of the latitude of the second point
-    - lon_col_2: column name of the longitude of the second point
-
-    Output:
-    - distance: distance between the two points
-    """
-    points_1 = (row[lat_col_1], row[lon_col_1])
-    points_2 = (row[lat_col_2], row[lon_col_2])
-    return geodesic(points_1, points_2).kilometers
-
-
 def find_closest_point(
-    source_df, target_df, source_lat_col, source_lon_col, target_lat_col, target_lon_col
+    source_df,
+    target_df,
+    source_lat_col,
+    source_lon_col,
+    target_lat_col,
+    target_lon_col,
+    target_name_col=None,
 ):
     """
     Find the closest point in the target dataframe for each point in the source dataframe
 
+    The target points are indexed once (utils_nearest.NearestIndex), all source points are matched in one batch by great-circle distance, and the geodesic distances are computed in one vectorized call.
+
     Input:
     - source_df: dataframe with the source points
     - target_df: dataframe with the target points
@@ -399,24 +570,25 @@ def find_closest_point(
     - source_lon_col: column name of the longitude of the source points
     - target_lat_col: column name of the latitude of the target points
     - target_lon_col: column name of the longitude of the target points
+    - target_name_col: optional column name of the names of the target points, copied to the source dataframe
 
     Output:
-    - source_df: dataframe with the closest points in the target dataframe
-    """
-    source_points = list(zip(source_df[source_lon_col], source_df[source_lat_col]))
-    target_points = list(zip(target_df[target_lon_col], target_df[target_lat_col]))
-    closest_target_points = [closest_point(p, target_points) for p in source_points]
-    source_df[target_lon_col], source_df[target_lat_col] = zip(*closest_target_points)
-    source_df["distance"] = source_df.apply(
-        lambda row: calculate_distance(
-            row,
-            source_lat_col,
-            source_lon_col,
-            target_lat_col,
-            target_lon_col,
-        ),
-        axis=1,
+    - source_df: dataframe with the coordinates (and name) of the closest points in the target dataframe and the distance in km, sorted by distance
+    """
+    index = utils_nearest.NearestIndex(
+        target_df[target_lon_col],
+        target_df[target_lat_col],
+        None if target_name_col is None else target_df[target_name_col],
     )
+    nearest = index.query(source_df[source_lon_col], source_df[source_lat_col])
+    target = nearest["target"].to_numpy()
+    found = target >= 0
+
+    for column in [target_lon_col, target_lat_col]:
+        source_df[column] = np.where(found, target_df[column].to_numpy(dtype=float)[target], np.nan)
+    if target_name_col is not None:
+        source_df[target_name_col] = nearest["target_name"].to_numpy()
+    source_df["distance"] = nearest["distance"].to_numpy()
     source_df.sort_values(by="distance", ascending=True, inplace=True)
     source_df.reset_index(drop=True, inplace=True)
     return source_df
@@ -460,8 +632,9 @@ def statewise_closest_points(state_name, state_name_abbrev_pair, epa, hw):
     print(f"Number of EPA WWTPs in {epa_state}: {epa_subset.shape[0]}")
 
     hw_subset = find_closest_point(
-        hw_subset, epa_subset, "hw_lat", "hw_lon", "epa_lat", "epa_lon"
+        hw_subset, epa_subset, "hw_lat", "hw_lon", "epa_lat", "epa_lon", "CWP_NAME"
     )
+    hw_subset.rename(columns={"CWP_NAME": "epa_name"}, inplace=True)
     print(
         f"Out of {hw_subset.shape[0]} HW WWTPs, {hw_subset[hw_subset['distance'] < 1].shape[0]} are within 1 km of its closest EPA WWTP."
     )
@@ -475,37 +648,92 @@ def statewise_closest_points(state_name, state_name_abbrev_pair, epa, hw):
     return hw_subset, summary_list
 
 
-def state_county_boundary(state_name):
+def national_closest_points(
+    epa, hw, state_name_abbrev_pair, threshold=1, num_workers=None
+):
     """
-    Retreive the boundary of the state and counties in the state
+    Calculate the closest EPA WWTP in the same state for each HW WWTP, for all states in one call.
+
+    Both dataframes are partitioned by state once, and the states are matched in parallel threads (the KD-tree queries and distance kernels release the GIL). Returns two outputs:
+    - hw_epa_distance: dataframe with the columns of statewise_closest_points, sorted by distance within every state
+    - summary: dataframe with one row per state and columns
+        - state: state abbreviation
+        - num_HW_WWTPs: number of HW WWTPs in the state
+        - num_EPA_WWTPs: number of EPA WWTPs in the state
+        - num_HW_WWTPs_within_{threshold}km: number of HW WWTPs within the threshold of its closest EPA WWTP
 
     Input:
-    - state_name: name of the state
+    - epa: dataframe with EPA WWTP data
+    - hw: dataframe with HW WWTP data
+    - state_name_abbrev_pair: dictionary that maps state names to state abbreviations, the states are matched in its order
+    - threshold: distance in km below which a HW WWTP counts as matched
+    - num_workers: number of threads, all cores if None
 
     Output:
-    - state_boundary: boundary of the state
-    - counties_boundary: boundary of the counties in the state
-    """
-    # URLs to shapefiles
-    url_state = "https://www2.census.gov/geo/tiger/GENZ2021/shp/cb_2021_us_state_5m.zip"
-    url_counties = (
-        "https://www2.census.gov/geo/tiger/GENZ2021/shp/cb_2021_us_county_5m.zip"
+    - hw_epa_distance: dataframe with columns hw_WWTP_NAME, hw_lat, hw_lon, state, epa_lon, epa_lat, epa_name, distance
+    - summary: dataframe with the counts of every state
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    hw_rows = hw.groupby("state", sort=False).indices
+    epa_rows = epa.groupby("CWP_STATE", sort=False).indices
+    hw_lon, hw_lat = hw["hw_lon"].to_numpy(dtype=float), hw["hw_lat"].to_numpy(dtype=float)
+    epa_lon, epa_lat = epa["epa_lon"].to_numpy(dtype=float), epa["epa_lat"].to_numpy(dtype=float)
+    empty = np.empty(0, dtype=np.int64)
+
+    def match_state(state):
+        source = hw_rows.get(state, empty)
+        target = epa_rows.get(state_name_abbrev_pair[state], empty)
+        nearest = utils_nearest.NearestIndex(epa_lon[target], epa_lat[target]).query(
+            hw_lon[source], hw_lat[source]
+        )
+        # Row of the closest EPA WWTP in epa, -1 if the state has none
+        epa_row = np.append(target, -1)[nearest["target"].to_numpy()]
+        distance = nearest["distance"].to_numpy()
+        order = np.argsort(distance, kind="stable")
+        return source[order], epa_row[order], distance[order], len(target)
+
+    states = list(state_name_abbrev_pair.keys())
+    with ThreadPoolExecutor(num_workers) as executor:
+        results = list(executor.map(match_state, states))
+
+    hw_epa_distance = hw.iloc[np.concatenate([r[0] for r in results])].reset_index(drop=True)
+    epa_row = np.concatenate([r[1] for r in results])
+    distance = np.concatenate([r[2] for r in results])
+    # The appended last value is taken for the HW WWTPs without an EPA WWTP (row -1)
+    hw_epa_distance["epa_lon"] = np.append(epa_lon, np.nan)[epa_row]
+    hw_epa_distance["epa_lat"] = np.append(epa_lat, np.nan)[epa_row]
+    hw_epa_distance["epa_name"] = np.append(epa["CWP_NAME"].to_numpy(dtype=object), None)[epa_row]
+    hw_epa_distance["distance"] = distance
+
+    summary = pd.DataFrame(
+        {
+            "state": [state_name_abbrev_pair[state] for state in states],
+            "num_HW_WWTPs": [len(r[0]) for r in results],
+            "num_EPA_WWTPs": [r[3] for r in results],
+            f"num_HW_WWTPs_within_{threshold:g}km": [
+                int((r[2] < threshold).sum()) for r in results
+            ],
+        }
     )
+    return hw_epa_distance, summary
 
-    # Load data
-    all_states = gpd.read_file(url_state)
-    all_counties = gpd.read_file(url_counties)
 
-    if state_name == "California":
-        state_boundary = all_states[all_states["STUSPS"] == "CA"]
-        counties_boundary = all_counties[all_counties["STATEFP"] == "06"]
+def state_county_boundary(state_name):
+    """
+    Retreive the boundary of the state and counties in the state
 
-    elif state_name == "Texas":
-        state_boundary = all_states[all_states["STUSPS"] == "TX"]
-        counties_boundary = all_counties[all_counties["STATEFP"] == "48"]
+    The national Census state and county layers are stored once as local GeoParquet keyed by FIPS code (utils_boundaries), so any state is served from the store without network access.
 
-    state_boundary.to_crs(epsg=4326, inplace=True)
-    counties_boundary.to_crs(epsg=4326, inplace=True)
+    Input:
+    - state_name: name, abbreviation or FIPS code of the state
+
+    Output:
+    - state_boundary: boundary of the state
+    - counties_boundary: boundary of the counties in the state
+    """
+    state_boundary = utils_boundaries.read_layer("state", state_name)
+    counties_boundary = utils_boundaries.read_layer("county", state_name)
     return state_boundary, counties_boundary
 
 
@@ -514,7 +742,7 @@ def merge_income_pop_boundary(state_boundary_path, income_path, pop_path, state_
     Merge the income and population data with the state boundary data
 
     Input:
-    - state_boundary_path: path to the state boundary shapefile
+    - state_boundary_path: path to the state boundary shapefile, or None to use the Census places of the state from the boundary store
     - income_path: path to the income data
     - pop_path: path to the population data
     - state_name: name of the state
@@ -522,8 +750,11 @@ def merge_income_pop_boundary(state_boundary_path, income_path, pop_path, state_
     Output:
     - gdf_MCD_pop_income: geodataframe with the merged data
     """
-    gdf_mcd = gpd.read_file(state_boundary_path)
-    gdf_mcd = gdf_mcd.to_crs(epsg=4326)
+    # The boundaries are read and reprojected once, later calls load them from the store
+    if state_boundary_path is None:
+        gdf_mcd = utils_boundaries.read_layer("place", state_name)
+    else:
+        gdf_mcd = utils_boundaries.read_boundary_file(state_boundary_path)
 
     pop = pd.read_csv(pop_path)
     pop = pop.transpose()
@@ -550,8 +781,8 @@ def merge_income_pop_boundary(state_boundary_path, income_path, pop_path, state_
     # merge population and income data
     pop_income = pd.merge(pop, income, on="Name")
 
-    # merge with gdf_CA_MCD
-    if state_name == "California":
+    # merge with gdf_CA_MCD, the Census places of the store are named like the California places
+    if state_name == "California" or state_boundary_path is None:
         gdf_MCD_pop_income = pd.merge(
             gdf_mcd, pop_income, left_on="NAMELSAD", right_on="Name"
         )
@@ -575,10 +806,14 @@ def plt_state_socioeconomic_map(
     - wwtp_gdf: geodataframe with WWTP locations
     - state_boudary: geodataframe with state boundary
     - counties_boundary: geodataframe with county boundary
-    - column: column name of the socioeconomic data
+    - column: column name of the socioeconomic data, or "counts" to color the polygons by their number of WWTPs
     - title: title of the plot
     - cmap: color map
     """
+    if column == "counts":
+        merged_gdf = merged_gdf.assign(
+            counts=utils_state_index.count_points(merged_gdf, wwtp_gdf)
+        )
 
     # plot the plants in three different markers, the background is the population
     fig, ax = plt.subplots(figsize=(15, 15))
@@ -598,7 +833,11 @@ def plt_state_socioeconomic_map(
     )
     sm._A = []
     cbar = fig.colorbar(sm, ax=ax, shrink=0.5)  # Adjust the shrink parameter as needed
-    cbar.set_label("Population", rotation=270, labelpad=20)
+    cbar.set_label(
+        "Number of WWTPs" if column == "counts" else "Population",
+        rotation=270,
+        labelpad=20,
+    )
 
     # Set title
     plt.title(title, fontsize=20)
@@ -618,9 +857,8 @@ def pop_income_boxplot(merged_gdf, wwtp_gdf):
     Output:
     - boxplots for the number of WWTP vs population and median income
     """
-    merged_gdf["counts"] = merged_gdf["geometry"].apply(
-        lambda x: wwtp_gdf.within(x).sum()
-    )
+    # Count the WWTPs within every polygon in one bulk pass
+    merged_gdf["counts"] = utils_state_index.count_points(merged_gdf, wwtp_gdf)
 
     # Plot setup
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7))
@@ -659,18 +897,22 @@ def wwtp_with_pop_distribution(wwtp, gridded_pop, color, colormap, title):
     ax.set_xlim(-125, -66)
     ax.set_ylim(24, 50)
 
-    # mask the no data values
-    gridded_pop_data = gridded_pop.read(1, masked=True)
-    # change no data values to 0
-    gridded_pop_data = np.nan_to_num(gridded_pop_data)
+    # the color scale comes from the cached statistics of the whole raster
+    stats = utils_raster.raster_stats(gridded_pop)
 
     # add a small number to avoid log(0)
     err = 1e-6
-    vmin = gridded_pop_data.min() + err
-    vmax = gridded_pop_data.max()
+    vmin = stats["min"] + err
+    vmax = stats["max"]
     norm = colors.LogNorm(vmin=vmin, vmax=vmax)
 
-    show(gridded_pop, ax=ax, cmap=colormap, norm=norm)
+    # only read the plotted extent, at the resolution of the axes
+    bbox = ax.get_window_extent()
+    gridded_pop_data, transform = utils_raster.read_extent(
+        gridded_pop, (-125, 24, -66, 50), out_size=(int(bbox.width), int(bbox.height))
+    )
+
+    show(gridded_pop_data, transform=transform, ax=ax, cmap=colormap, norm=norm)
     cbar = plt.colorbar(mappable=plt.cm.ScalarMappable(cmap=colormap, norm=norm), ax=ax)
 
     # plot the wwtp
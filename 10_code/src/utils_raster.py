@@ -0,0 +1,125 @@
+import json
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+# Number of rows read at a time when computing statistics, to bound the memory of full-raster passes
+STATS_ROWS = 1024
+
+def stats_path(filename):
+    """
+    Returns the path of the sidecar file holding the statistics of a raster
+    """
+    return filename + ".stats.json"
+
+def compute_stats(src, band=1, rows=STATS_ROWS):
+    """
+    Computes the minimum, maximum and number of the valid pixels of a raster band, reading it in strips of rows so the whole band is never in memory
+
+    Args:
+    src: open rasterio dataset
+    band: band number
+    rows: number of rows read at a time
+
+    Returns:
+    stats: dictionary with min, max and count
+    """
+    minimum, maximum, count = np.inf, -np.inf, 0
+    for row in range(0, src.height, rows):
+        data = src.read(band, window=Window(0, row, src.width, min(rows, src.height - row)), masked=True)
+        values = data.compressed()
+        values = values[np.isfinite(values)]
+        if len(values):
+            minimum = min(minimum, float(values.min()))
+            maximum = max(maximum, float(values.max()))
+            count += len(values)
+    return {"min": minimum, "max": maximum, "count": count}
+
+def raster_stats(src, band=1):
+    """
+    Returns the statistics of a raster band, cached in a JSON sidecar next to the raster. The sidecar is recomputed when the modification time or size of the raster changes.
+
+    Args:
+    src: open rasterio dataset
+    band: band number
+
+    Returns:
+    stats: dictionary with min, max and count of the valid pixels
+    """
+    filename = src.name
+    if not os.path.isfile(filename):
+        return compute_stats(src, band)
+
+    stat = os.stat(filename)
+    signature = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    sidecar = stats_path(filename)
+    cached = {}
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if cached.get("signature") == signature and str(band) in cached.get("bands", {}):
+            return cached["bands"][str(band)]
+
+    stats = compute_stats(src, band)
+    bands = cached.get("bands", {}) if cached.get("signature") == signature else {}
+    bands[str(band)] = stats
+    part_sidecar = f"{sidecar}.{os.getpid()}.part"
+    # The sidecar is an optimization, a read-only data directory only loses the caching
+    try:
+        with open(part_sidecar, "w") as f:
+            json.dump({"signature": signature, "bands": bands}, f)
+        os.replace(part_sidecar, sidecar)
+    except OSError:
+        pass
+    return stats
+
+def extent_window(src, bounds, bounds_crs="EPSG:4326"):
+    """
+    Returns the window of a raster covering the given bounds, clipped to the raster
+
+    Args:
+    src: open rasterio dataset
+    bounds: tuple (west, south, east, north)
+    bounds_crs: coordinate reference system of the bounds
+
+    Returns:
+    window: rasterio Window with integer offsets and size
+    """
+    if src.crs is not None and bounds_crs is not None and src.crs != rasterio.crs.CRS.from_user_input(bounds_crs):
+        bounds = transform_bounds(bounds_crs, src.crs, *bounds)
+    window = from_bounds(*bounds, transform=src.transform)
+    # Widened to whole pixels, so the window covers all pixels touching the bounds
+    col_off, row_off = np.floor(window.col_off), np.floor(window.row_off)
+    col_end, row_end = np.ceil(window.col_off + window.width), np.ceil(window.row_off + window.height)
+    window = Window(int(col_off), int(row_off), int(col_end - col_off), int(row_end - row_off))
+    return window.intersection(Window(0, 0, src.width, src.height))
+
+def read_extent(src, bounds, out_size=None, band=1, bounds_crs="EPSG:4326", resampling=Resampling.average):
+    """
+    Reads the part of a raster band within the given bounds, decimated to at most out_size pixels. Decimated reads are served from the overviews of the raster when it has them (e.g. after utils_cog.convert_to_cog), so only screen-resolution data is read.
+
+    Args:
+    src: open rasterio dataset
+    bounds: tuple (west, south, east, north)
+    out_size: optional tuple (width, height) of the output in pixels, e.g. the size of the axes the raster is shown in, read at full resolution if None
+    band: band number
+    bounds_crs: coordinate reference system of the bounds
+    resampling: resampling method of decimated reads
+
+    Returns:
+    data: masked numpy array of shape (height, width), masked where the raster has no data
+    transform: affine transform of the data, to plot it in map coordinates
+    """
+    window = extent_window(src, bounds, bounds_crs)
+    factor = 1.0
+    if out_size is not None:
+        factor = max(1.0, window.width / out_size[0], window.height / out_size[1])
+    out_shape = (max(1, int(window.height / factor)), max(1, int(window.width / factor)))
+
+    data = src.read(band, window=window, out_shape=out_shape, masked=True, resampling=resampling)
+    transform = src.window_transform(window)
+    transform = transform * transform.scale(window.width / out_shape[1], window.height / out_shape[0])
+    return data, transform
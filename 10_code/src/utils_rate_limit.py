@@ -0,0 +1,104 @@
+import random
+import threading
+import time
+import requests
+
+# Phrases of Earth Engine errors raised when the quota or the concurrency limit is exceeded. Status codes are only checked on HTTP errors, since bare numbers also appear in unrelated messages (e.g. byte counts).
+THROTTLING_MESSAGES = (
+    "quota",
+    "too many concurrent",
+    "too many requests",
+    "rate limit",
+    "resource_exhausted",
+    "resource exhausted",
+)
+
+def is_throttling_error(error):
+    """
+    Checks whether an error means that Earth Engine throttled the request (quota exceeded, too many concurrent requests)
+
+    Args:
+    error: exception raised by a download
+
+    Returns:
+    True if the request was throttled
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429
+    message = str(error).lower()
+    return any(phrase in message for phrase in THROTTLING_MESSAGES)
+
+def is_retryable_error(error):
+    """
+    Checks whether a download that raised the error is worth retrying: throttling, transient server errors (5xx), timeouts and dropped connections
+
+    Args:
+    error: exception raised by a download
+
+    Returns:
+    True if the download should be retried
+    """
+    if is_throttling_error(error):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+def backoff_delay(attempt, base=1.0, cap=120.0):
+    """
+    Computes the delay before a retry with exponential backoff and full jitter, so that throttled workers don't retry in lockstep
+
+    Args:
+    attempt: number of the retry, starting at 0
+    base: delay of the first retry in seconds before jitter
+    cap: maximum delay in seconds
+
+    Returns:
+    delay: time to wait in seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class AIMDController:
+    """
+    Adaptive concurrency limit with additive increase and multiplicative decrease (AIMD), as used for TCP congestion control. The limit grows by one request for every limit successful requests, and is cut by the decrease factor when a request is throttled. Throttled requests that were started before the last cut don't cut it again, so one burst of throttling errors only counts once.
+
+    Args:
+    initial: initial number of requests in flight
+    minimum: lower bound of the limit
+    maximum: upper bound of the limit
+    decrease: factor the limit is multiplied with on throttling
+    """
+    def __init__(self, initial=2, minimum=1, maximum=16, decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """
+        Current number of requests allowed in flight
+        """
+        return int(self._limit)
+
+    def on_success(self):
+        """
+        Records a successful request, increasing the limit additively
+        """
+        with self._lock:
+            self._limit = min(self.maximum, self._limit + 1 / self._limit)
+
+    def on_throttle(self, started_at):
+        """
+        Records a throttled request, decreasing the limit multiplicatively
+
+        Args:
+        started_at: time the throttled request was started
+        """
+        with self._lock:
+            if started_at < self._last_decrease:
+                return
+            self._limit = max(self.minimum, self._limit * self.decrease)
+            self._last_decrease = time.time()
@@ -0,0 +1,220 @@
+import functools
+import numpy as np
+import pandas as pd
+from src import utils_cache
+
+# Boundaries used to assign states and counties to points
+STATE_BOUNDARIES_PATH = "../00_source_data/US_State_Boundaries"
+COUNTY_BOUNDARIES_PATH = "https://www2.census.gov/geo/tiger/GENZ2021/shp/cb_2021_us_county_5m.zip"
+
+# Number of points looked up at a time, to bound the memory of the sorted coordinates
+CHUNK_SIZE = 1_000_000
+
+@utils_cache.cached_reader("path")
+def read_regions(path, columns):
+    """
+    Reads region polygons in longitude and latitude with the given attribute columns. The result is cached as GeoParquet, so the boundaries are only read and reprojected once.
+
+    Args:
+    path: path or URL of the boundary file
+    columns: tuple of the attribute columns to keep
+
+    Returns:
+    regions: geodataframe with the attribute columns and geometry in "EPSG:4326"
+    """
+    import geopandas as gpd
+
+    regions = gpd.read_file(path, columns=list(columns)).to_crs(epsg=4326)
+    return regions.loc[:, [*columns, "geometry"]].reset_index(drop=True)
+
+class RegionIndex:
+    """
+    Index over region polygons (e.g. states or counties) that assigns points to the region containing them. The polygons are prepared once, and points are looked up in vectorized chunks directly from their coordinates: the points of a chunk are sorted by longitude, so every polygon only tests the points within its bounding box, without building a geometry per point.
+
+    Args:
+    regions: geodataframe of region polygons in "EPSG:4326" with attribute columns
+    """
+    def __init__(self, regions):
+        import shapely
+
+        self.geometries = np.asarray(regions.geometry.values)
+        shapely.prepare(self.geometries)
+        self.bounds = shapely.bounds(self.geometries)
+        self.attributes = pd.DataFrame(regions.drop(columns=regions.geometry.name)).reset_index(drop=True)
+
+    def lookup(self, lon, lat, chunk_size=CHUNK_SIZE):
+        """
+        Finds the region containing every point. A point on the border of two regions is assigned to the first one.
+
+        Args:
+        lon: array-like of longitudes
+        lat: array-like of latitudes
+        chunk_size: number of points looked up at a time
+
+        Returns:
+        rows: numpy array with the row of the region of every point, -1 for points outside all regions or with missing coordinates
+        """
+        import shapely
+
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        rows = np.full(len(lon), -1, dtype=np.int64)
+
+        for start in range(0, len(lon), chunk_size):
+            order = start + np.argsort(lon[start:start + chunk_size], kind="stable")
+            chunk_lon, chunk_lat = lon[order], lat[order]
+            chunk_rows = np.full(len(order), -1, dtype=np.int64)
+
+            for region, (xmin, ymin, xmax, ymax) in enumerate(self.bounds):
+                # Points within the longitude range of the region, then within its latitude range
+                first = np.searchsorted(chunk_lon, xmin, side="left")
+                last = np.searchsorted(chunk_lon, xmax, side="right")
+                candidates = first + np.flatnonzero(
+                    (chunk_lat[first:last] >= ymin) & (chunk_lat[first:last] <= ymax) & (chunk_rows[first:last] < 0)
+                )
+                inside = shapely.intersects_xy(self.geometries[region], chunk_lon[candidates], chunk_lat[candidates])
+                chunk_rows[candidates[inside]] = region
+
+            rows[order] = chunk_rows
+
+        return rows
+
+    def count(self, lon, lat, chunk_size=CHUNK_SIZE):
+        """
+        Counts the points strictly inside every region, like GeoSeries.within. Unlike lookup, a point within several overlapping regions is counted in each of them.
+
+        Args:
+        lon: array-like of longitudes (x coordinates in the coordinate reference system of the regions)
+        lat: array-like of latitudes (y coordinates)
+        chunk_size: number of points counted at a time
+
+        Returns:
+        counts: numpy array with the number of points of every region
+        """
+        import shapely
+
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        counts = np.zeros(len(self.geometries), dtype=np.int64)
+
+        for start in range(0, len(lon), chunk_size):
+            order = start + np.argsort(lon[start:start + chunk_size], kind="stable")
+            chunk_lon, chunk_lat = lon[order], lat[order]
+
+            for region, (xmin, ymin, xmax, ymax) in enumerate(self.bounds):
+                first = np.searchsorted(chunk_lon, xmin, side="left")
+                last = np.searchsorted(chunk_lon, xmax, side="right")
+                candidates = first + np.flatnonzero((chunk_lat[first:last] >= ymin) & (chunk_lat[first:last] <= ymax))
+                counts[region] += np.count_nonzero(
+                    shapely.contains_xy(self.geometries[region], chunk_lon[candidates], chunk_lat[candidates])
+                )
+
+        return counts
+
+    def nearest(self, lon, lat):
+        """
+        Finds the region closest to every point in longitude and latitude, e.g. for points just off the coast
+
+        Args:
+        lon: array-like of longitudes
+        lat: array-like of latitudes
+
+        Returns:
+        rows: numpy array with the row of the nearest region of every point, -1 for points with missing coordinates
+        """
+        import shapely
+
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        rows = np.full(len(lon), -1, dtype=np.int64)
+        valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+        if len(valid):
+            # One nearest region per point, ties are broken by the first region
+            points, regions = shapely.STRtree(self.geometries).query_nearest(shapely.points(lon[valid], lat[valid]), all_matches=False)
+            rows[valid[points]] = regions
+        return rows
+
+    def assign(self, lon, lat, chunk_size=CHUNK_SIZE, nearest=False):
+        """
+        Returns the attributes of the region containing every point
+
+        Args:
+        lon: array-like of longitudes
+        lat: array-like of latitudes
+        chunk_size: number of points looked up at a time
+        nearest: if True, points outside all regions get the attributes of the nearest region
+
+        Returns:
+        attributes: dataframe with one row per point and the attribute columns of its region, missing for points outside all regions (unless nearest is True) or with missing coordinates
+        """
+        rows = self.lookup(lon, lat, chunk_size)
+        if nearest and (rows < 0).any():
+            outside = np.flatnonzero(rows < 0)
+            rows[outside] = self.nearest(np.asarray(lon, dtype=float)[outside], np.asarray(lat, dtype=float)[outside])
+        attributes = {}
+        for column in self.attributes.columns:
+            # The last value is None for the points outside all regions (row -1)
+            values = np.append(self.attributes[column].to_numpy(dtype=object), None)
+            attributes[column] = values[rows]
+        return pd.DataFrame(attributes)
+
+@functools.lru_cache(maxsize=None)
+def region_index(path, columns):
+    """
+    Returns the region index of a boundary file, built once per process
+
+    Args:
+    path: path or URL of the boundary file
+    columns: tuple of the attribute columns to keep
+
+    Returns:
+    index: RegionIndex
+    """
+    return RegionIndex(read_regions(path, columns))
+
+def assign_states(
+    lon,
+    lat,
+    counties=False,
+    boundaries_path=STATE_BOUNDARIES_PATH,
+    county_path=COUNTY_BOUNDARIES_PATH,
+    chunk_size=CHUNK_SIZE,
+    nearest=False,
+):
+    """
+    Assigns the state, and optionally the county, to points given by longitude and latitude. All readers and downloaders use this function, so every data source gets the same state labels.
+
+    Args:
+    lon: array-like of longitudes
+    lat: array-like of latitudes
+    counties: if True, also assign the county FIPS codes
+    boundaries_path: path of the state boundaries with columns NAME and STATE_ABBR
+    county_path: path or URL of the county boundaries with column GEOID
+    chunk_size: number of points looked up at a time
+    nearest: if True, points outside all states (and counties) get the nearest one
+
+    Returns:
+    states: dataframe with one row per point and columns state (name) and state_abbr, plus county_fips if counties is True; missing for points outside all states (unless nearest is True) or with missing coordinates
+    """
+    states = region_index(boundaries_path, ("NAME", "STATE_ABBR")).assign(lon, lat, chunk_size, nearest)
+    states.columns = ["state", "state_abbr"]
+    if counties:
+        states["county_fips"] = region_index(county_path, ("GEOID",)).assign(lon, lat, chunk_size, nearest)["GEOID"]
+    return states
+
+def count_points(regions, points, chunk_size=CHUNK_SIZE):
+    """
+    Counts the points within every region polygon in one bulk pass, e.g. the WWTPs of every place or county of a state. The points are reprojected to the coordinate reference system of the regions if needed.
+
+    Args:
+    regions: geodataframe of region polygons
+    points: geodataframe of points
+    chunk_size: number of points counted at a time
+
+    Returns:
+    counts: series with the number of points within every region, with the index of the regions
+    """
+    if regions.crs is not None and points.crs is not None and points.crs != regions.crs:
+        points = points.to_crs(regions.crs)
+    counts = RegionIndex(regions).count(points.geometry.x, points.geometry.y, chunk_size)
+    return pd.Series(counts, index=regions.index, name="counts")
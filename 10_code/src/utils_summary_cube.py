@@ -0,0 +1,157 @@
+import itertools
+import os
+import pandas as pd
+
+# The summary cube is stored next to the source data
+SUMMARY_CUBE_PATH = "../00_source_data/state_summary.parquet"
+
+# Column holding the state name or abbreviation of every source
+STATE_COLUMNS = {"hw": "state", "epa": "CWP_STATE", "osm": "state", "client": "state"}
+
+# Counts replacing the computed ones: the OSM plants of California and Texas were tagged manually (yes + maybe)
+STATE_COUNT_OVERRIDES = {"osm": {"CA": 116 + 183, "TX": 198 + 104}}
+
+# FIPS codes of the states, the key of the census tables and boundaries
+STATE_FIPS = {
+    "AL": "01", "AK": "02", "AZ": "04", "AR": "05", "CA": "06", "CO": "08", "CT": "09", "DE": "10",
+    "DC": "11", "FL": "12", "GA": "13", "HI": "15", "ID": "16", "IL": "17", "IN": "18", "IA": "19",
+    "KS": "20", "KY": "21", "LA": "22", "ME": "23", "MD": "24", "MA": "25", "MI": "26", "MN": "27",
+    "MS": "28", "MO": "29", "MT": "30", "NE": "31", "NV": "32", "NH": "33", "NJ": "34", "NM": "35",
+    "NY": "36", "NC": "37", "ND": "38", "OH": "39", "OK": "40", "OR": "41", "PA": "42", "RI": "44",
+    "SC": "45", "SD": "46", "TN": "47", "TX": "48", "UT": "49", "VT": "50", "VA": "51", "WA": "53",
+    "WV": "54", "WI": "55", "WY": "56", "PR": "72",
+}
+
+def state_abbreviations(states, state_name_abbrev_pair):
+    """
+    Converts state names or abbreviations to abbreviations
+
+    Args:
+    states: series of state names or abbreviations
+    state_name_abbrev_pair: dictionary that maps state names to state abbreviations
+
+    Returns:
+    abbreviations: series of state abbreviations, missing for unknown states
+    """
+    mapping = {**state_name_abbrev_pair, **{abbrev: abbrev for abbrev in state_name_abbrev_pair.values()}}
+    return states.map(mapping)
+
+def build_summary_cube(
+    sources,
+    state_name_abbrev_pair,
+    facilities=None,
+    socioeconomic=(),
+    state_columns=STATE_COLUMNS,
+    overrides=STATE_COUNT_OVERRIDES,
+):
+    """
+    Builds the state-level summary cube of any number of WWTP sources. The state labels of all sources are stacked and counted in one grouped pass, and the overlaps between sources are counted from the canonical facilities of utils_entity_resolution in another.
+
+    Args:
+    sources: dictionary mapping source names to their dataframes
+    state_name_abbrev_pair: dictionary that maps state names to state abbreviations, the rows of the cube are in its order
+    facilities: optional dataframe of canonical facilities with columns state and num_<source>
+    socioeconomic: dataframes with a column state of upper-case state names (e.g. from utils_plot.process_state_data), merged into the cube
+    state_columns: dictionary mapping source names to their column with state names or abbreviations
+    overrides: dictionary mapping source names to dictionaries of state abbreviations and counts replacing the computed ones
+
+    Returns:
+    cube: dataframe with one row per state and columns state (abbreviation), state_name, state_fips, state_key (upper-case name, the key of the socioeconomic tables), <source>_num for every source, and if facilities are given facilities_num and <source>_<source>_overlap for every pair of sources, plus the socioeconomic columns
+    """
+    cube = pd.DataFrame(
+        {
+            "state": list(state_name_abbrev_pair.values()),
+            "state_name": list(state_name_abbrev_pair.keys()),
+        }
+    )
+    cube["state_fips"] = cube["state"].map(STATE_FIPS)
+    cube["state_key"] = cube["state_name"].str.upper()
+
+    labels = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "state": state_abbreviations(df[state_columns.get(source, "state")], state_name_abbrev_pair).to_numpy(),
+                    "source": source,
+                }
+            )
+            for source, df in sources.items()
+        ],
+        ignore_index=True,
+    )
+    counts = labels.groupby(["state", "source"]).size().unstack(fill_value=0)
+    for source in sources:
+        column = counts[source] if source in counts.columns else pd.Series(dtype=int)
+        cube[f"{source}_num"] = cube["state"].map(column).fillna(0).astype(int)
+        for state, count in overrides.get(source, {}).items():
+            cube.loc[cube["state"] == state, f"{source}_num"] = count
+
+    if facilities is not None:
+        present = {
+            column[len("num_"):]: facilities[column] > 0
+            for column in facilities.columns
+            if column.startswith("num_") and column not in ("num_sources", "num_records")
+        }
+        overlaps = pd.DataFrame(
+            {f"{a}_{b}_overlap": present[a] & present[b] for a, b in itertools.combinations(present, 2)}
+        )
+        overlaps.insert(0, "facilities_num", 1)
+        overlaps = overlaps.groupby(
+            state_abbreviations(facilities["state"], state_name_abbrev_pair).to_numpy()
+        ).sum()
+        for column in overlaps.columns:
+            cube[column] = cube["state"].map(overlaps[column]).fillna(0).astype(int)
+
+    for df in socioeconomic:
+        cube = cube.merge(df.rename(columns={"state": "state_key"}), on="state_key", how="left")
+
+    return cube
+
+def write_summary_cube(cube, path=SUMMARY_CUBE_PATH):
+    """
+    Writes the summary cube as a Parquet file. The file is written under a temporary name and renamed once complete.
+    """
+    part_path = f"{path}.{os.getpid()}.part"
+    cube.to_parquet(part_path, index=False)
+    os.replace(part_path, path)
+
+def read_summary_cube(path=SUMMARY_CUBE_PATH):
+    """
+    Reads the summary cube written by write_summary_cube
+    """
+    return pd.read_parquet(path)
+
+def main():
+    """
+    Builds and writes the summary cube of HydroWASTE, EPA, OSM and the optional client data from the command line, with the overlaps of the canonical facilities if they have been written
+    """
+    import argparse
+    from src import utils_entity_resolution, utils_plot, utils_state_index
+
+    parser = argparse.ArgumentParser(description="Build the state-level summary cube of the WWTP sources")
+    parser.add_argument("--hydrowaste", default=utils_entity_resolution.HYDROWASTE_PATH, help="path of the HydroWASTE data")
+    parser.add_argument("--epa", default=utils_entity_resolution.EPA_PATH, help="path of the EPA data")
+    parser.add_argument("--osm", default=utils_entity_resolution.OSM_PATH, help="path of the OSM data")
+    parser.add_argument("--client", default=None, help="optional path of the client data")
+    parser.add_argument("--facilities", default=utils_entity_resolution.FACILITIES_PATH, help="path of the canonical facilities, skipped if it doesn't exist")
+    parser.add_argument("--us-boundary", default=utils_state_index.STATE_BOUNDARIES_PATH, help="path of the US boundary shapefile")
+    parser.add_argument("--output", default=SUMMARY_CUBE_PATH, help="path of the output Parquet file")
+    args = parser.parse_args()
+
+    sources = {
+        "hw": utils_plot.read_HydroWaste_data(args.hydrowaste, args.us_boundary),
+        "epa": utils_plot.read_EPA_data(args.epa, us_boundary_path=args.us_boundary),
+        "osm": utils_plot.read_osm_data(args.osm, args.us_boundary),
+    }
+    if args.client is not None:
+        sources["client"] = utils_plot.read_client_data(args.client)
+    facilities = None
+    if os.path.exists(args.facilities):
+        facilities = utils_entity_resolution.read_facilities(args.facilities)
+
+    cube = build_summary_cube(sources, utils_plot.state_name_abbrev_pair(), facilities)
+    write_summary_cube(cube, args.output)
+    print(f"Wrote the summary cube of {len(cube)} states and {len(sources)} sources to {args.output}")
+
+if __name__ == "__main__":
+    main()
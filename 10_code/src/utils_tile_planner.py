@@ -0,0 +1,237 @@
+import hashlib
+import os
+import time
+import numpy as np
+from src import utils_cog, utils_download_images, utils_download_manifest, utils_ee_pipeline
+
+# Approximate number of meters per degree of latitude and per degree of longitude at the equator
+METERS_PER_DEGREE_LAT = 110574
+METERS_PER_DEGREE_LON = 111320
+
+# Earth Engine rejects getDownloadURL requests larger than this many bytes. Covering rasters are kept well below it, since the estimate is approximate.
+EE_REQUEST_LIMIT = 50331648
+MAX_JOB_BYTES = int(0.8 * EE_REQUEST_LIMIT)
+
+def estimate_bytes(bounds, scale=1, bands=3):
+    """
+    Estimates the size of an uncompressed 8 bit image of the given bounds. Works on single bounds as well as on numpy arrays of bounds.
+
+    Args:
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude)
+    scale: size of a pixel in meters
+    bands: number of channels
+
+    Returns:
+    size: estimated number of bytes
+    """
+    xmin, ymin, xmax, ymax = bounds
+    width = (xmax - xmin) * METERS_PER_DEGREE_LON * np.cos(np.radians((ymin + ymax) / 2)) / scale
+    height = (ymax - ymin) * METERS_PER_DEGREE_LAT / scale
+    return width * height * bands
+
+def plan_jobs(tasks, max_extent=0.06, max_bytes=MAX_JOB_BYTES):
+    """
+    Groups the download tasks of wwtps whose image areas overlap, so that a single raster covering the group can be downloaded instead of one image per wwtp. Overlapping pairs are merged closest first with union-find, and a merge is only accepted if the covering raster is smaller than the rasters it replaces, no wider or higher than max_extent and its estimated size is at most max_bytes, so it stays within the Earth Engine request limit.
+
+    Args:
+    tasks: list of tasks from utils_download_images.plant_tasks
+    max_extent: maximum width and height of a covering raster in degrees
+    max_bytes: maximum estimated size of a covering raster in bytes
+
+    Returns:
+    jobs: list of lists of tasks, every list is downloaded with a single request
+    """
+    import shapely
+
+    if len(tasks) == 0:
+        return []
+
+    center_x = np.array([task[2] for task in tasks], dtype=float)
+    center_y = np.array([task[3] for task in tasks], dtype=float)
+    xmin, ymin, xmax, ymax = utils_download_images.tile_bounds(center_x, center_y)
+
+    # Find all pairs of overlapping image areas at once
+    boxes = shapely.box(xmin, ymin, xmax, ymax)
+    left, right = shapely.STRtree(boxes).query(boxes, predicate="intersects")
+    keep = left < right
+    left, right = left[keep], right[keep]
+
+    # Merge the closest pairs first
+    order = np.argsort(np.hypot(center_x[left] - center_x[right], center_y[left] - center_y[right]))
+
+    # Union-find over the tasks, tracking the bounds and the cost (estimated bytes) of every group
+    parent = np.arange(len(tasks))
+    group_bounds = np.column_stack([xmin, ymin, xmax, ymax])
+    group_cost = estimate_bytes((xmin, ymin, xmax, ymax))
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in zip(left[order], right[order]):
+        a, b = find(i), find(j)
+        if a == b:
+            continue
+
+        merged = np.concatenate([
+            np.minimum(group_bounds[a, :2], group_bounds[b, :2]),
+            np.maximum(group_bounds[a, 2:], group_bounds[b, 2:]),
+        ])
+        merged_cost = estimate_bytes(merged)
+        if (
+            merged[2] - merged[0] > max_extent
+            or merged[3] - merged[1] > max_extent
+            or merged_cost >= group_cost[a] + group_cost[b]
+            or merged_cost > max_bytes
+        ):
+            continue
+
+        parent[b] = a
+        group_bounds[a] = merged
+        group_cost[a] = merged_cost
+
+    groups = {}
+    for i, task in enumerate(tasks):
+        groups.setdefault(find(i), []).append(task)
+
+    return list(groups.values())
+
+def job_bounds(job):
+    """
+    Computes the bounds of the raster covering all tasks of a job
+
+    Args:
+    job: list of tasks
+
+    Returns:
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude)
+    """
+    bounds = np.array([utils_download_images.tile_bounds(task[2], task[3]) for task in job])
+    return (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max())
+
+def plan_summary(jobs):
+    """
+    Reports how many requests and bytes the grouping saves compared to downloading one image per wwtp
+
+    Args:
+    jobs: list of lists of tasks from plan_jobs
+
+    Returns:
+    summary: dictionary with the number of images, requests, saved requests, estimated bytes without and with grouping and saved bytes
+    """
+    tasks = [task for job in jobs for task in job]
+    individual_bytes = sum(
+        estimate_bytes(utils_download_images.tile_bounds(task[2], task[3])) for task in tasks
+    )
+    grouped_bytes = sum(estimate_bytes(job_bounds(job)) for job in jobs)
+
+    return {
+        "images": len(tasks),
+        "requests": len(jobs),
+        "requests_saved": len(tasks) - len(jobs),
+        "individual_bytes": int(individual_bytes),
+        "grouped_bytes": int(grouped_bytes),
+        "bytes_saved": int(individual_bytes - grouped_bytes),
+    }
+
+def cut_tile(source_filename, bounds, filename, cog=True):
+    """
+    Cuts the image of one wwtp out of a covering raster with a windowed read and writes it with the same layout as a directly downloaded image
+
+    Args:
+    source_filename: path of the covering raster
+    bounds: tuple (min longitude, min latitude, max longitude, max latitude) of the image
+    filename: path of the output .tif file
+    cog: if True, write a tiled, compressed cloud optimized GeoTIFF with overviews
+    """
+    import rasterio
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import from_bounds
+
+    with rasterio.open(source_filename) as src:
+        window = from_bounds(
+            *transform_bounds("EPSG:4326", src.crs, *bounds), transform=src.transform
+        ).round_offsets().round_lengths()
+        data = src.read(window=window, boundless=True, fill_value=0)
+
+        profile = src.profile.copy()
+        profile.update(
+            width=int(window.width),
+            height=int(window.height),
+            transform=src.window_transform(window),
+        )
+        # The layout of the image is set when writing, not inherited from the covering raster
+        for key in ("tiled", "blockxsize", "blockysize", "compress", "predictor", "interleave"):
+            profile.pop(key, None)
+
+    part_filename = filename + ".part"
+    with rasterio.open(part_filename, "w", **profile) as dst:
+        dst.write(data)
+
+    if cog:
+        utils_cog.convert_to_cog(part_filename, filename)
+        os.remove(part_filename)
+    else:
+        os.replace(part_filename, filename)
+
+def fetch_job(job, url_fn=utils_download_images.download_url, validate=True, cog=True):
+    """
+    Downloads the images of a job. A single task is downloaded directly. For a group, one raster covering the group is downloaded and every image is cut from it locally.
+
+    Args:
+    job: list of tasks
+    url_fn: function returning the download URL of region bounds
+    validate: if True, check that the written files are complete GeoTIFFs
+    cog: if True, write the images as cloud optimized GeoTIFFs
+
+    Returns:
+    results: list with a dictionary per image of the job, as returned by utils_ee_pipeline.fetch_tile
+    """
+    if len(job) == 1:
+        return [utils_ee_pipeline.fetch_tile(job[0], url_fn, validate, cog)]
+
+    bounds = job_bounds(job)
+
+    # Covering rasters are kept in a separate directory until they are cut
+    group_directory = "../00_source_data/WWTP_Images/_groups"
+    os.makedirs(group_directory, exist_ok=True)
+    group_id = hashlib.sha1(repr(bounds).encode()).hexdigest()[:16]
+    group_filename = os.path.join(group_directory, f"{group_id}.tif")
+
+    try:
+        start = time.time()
+        url = url_fn(bounds)
+        url_done = time.time()
+        transfer_bytes, _ = utils_ee_pipeline.stream_to_file(url, group_filename)
+        transfer_done = time.time()
+
+        results = []
+        for task in job:
+            write_start = time.time()
+            filename = utils_download_images.image_path(task[0], task[1])
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            cut_tile(group_filename, utils_download_images.tile_bounds(task[2], task[3]), filename, cog)
+
+            error = utils_download_manifest.validate_image(filename) if validate else None
+            if error is not None:
+                os.remove(filename)
+            results.append({
+                "size": os.path.getsize(filename) if error is None else None,
+                "checksum": utils_download_manifest.file_checksum(filename) if error is None else None,
+                "error": error,
+                # The covering raster is downloaded once for the whole group
+                "transfer_bytes": transfer_bytes if not results else 0,
+                "url_s": url_done - start,
+                "transfer_s": transfer_done - url_done,
+                "write_s": time.time() - write_start,
+            })
+    finally:
+        if os.path.exists(group_filename):
+            os.remove(group_filename)
+
+    return results
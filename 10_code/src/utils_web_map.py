@@ -0,0 +1,247 @@
+import json
+import numpy as np
+import pandas as pd
+from branca.element import MacroElement
+from folium.template import Template
+
+# Colors of the categories (e.g. sources or labels), cycled if there are more categories
+PALETTE = ["#1a80bb", "#ea801c", "#6abf69", "#c0392b", "#8e44ad", "#f1c40f", "#16a085", "#7f8c8d"]
+MISSING_COLOR = "#b8b8b8"
+
+# Numeric values (e.g. model probabilities) are colored in this many bins between 0 and 1
+PROBABILITY_BINS = 10
+
+# First zoom level of every aggregated layer, and the zoom level from which the individual points are shown
+AGGREGATE_ZOOMS = (3, 5, 7)
+POINTS_ZOOM = 9
+
+# Coordinates are embedded with this many decimals (about 1 m)
+COORDINATE_DECIMALS = 5
+
+def color_codes(values):
+    """
+    Encodes the values points are colored by as small integer codes into a palette. Categories (e.g. source or label) get one color each, numeric values (e.g. probabilities between 0 and 1) are binned into a sequential color scale.
+
+    Args:
+    values: series of categories or numbers
+
+    Returns:
+    codes: numpy array of the palette index of every point
+    palette: list of colors
+    labels: list of the legend labels of the colors
+    """
+    values = pd.Series(values).reset_index(drop=True)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        import branca.colormap
+
+        colormap = branca.colormap.linear.YlOrRd_09.scale(0, 1)
+        edges = np.linspace(0, 1, PROBABILITY_BINS + 1)
+        codes = np.clip(np.floor(values.to_numpy(dtype=float) * PROBABILITY_BINS), 0, PROBABILITY_BINS - 1)
+        palette = [colormap((low + high) / 2) for low, high in zip(edges[:-1], edges[1:])]
+        labels = [f"{low:.1f} - {high:.1f}" for low, high in zip(edges[:-1], edges[1:])]
+        missing = np.isnan(codes)
+        codes = np.where(missing, PROBABILITY_BINS, np.nan_to_num(codes)).astype(np.int64)
+    else:
+        codes, categories = pd.factorize(values, sort=True)
+        palette = [PALETTE[i % len(PALETTE)] for i in range(len(categories))]
+        labels = [str(category) for category in categories]
+        missing = codes < 0
+        codes = np.where(missing, len(categories), codes)
+
+    palette.append(MISSING_COLOR)
+    labels.append("missing")
+    if not missing.any():
+        palette, labels = palette[:-1], labels[:-1]
+    return codes, palette, labels
+
+def grid_aggregate(lat, lon, codes, cell_size):
+    """
+    Aggregates points into the cells of a regular grid in one vectorized pass
+
+    Args:
+    lat: numpy array of latitudes
+    lon: numpy array of longitudes
+    codes: numpy array of the color codes of the points
+    cell_size: width and height of the cells in degrees
+
+    Returns:
+    cells: dataframe with one row per non-empty cell and columns lat and lon (mean of its points), count and code (most frequent color code)
+    """
+    keys = np.floor(lon / cell_size).astype(np.int64) * 1_000_000 + np.floor(lat / cell_size).astype(np.int64)
+    cell_keys, cell = np.unique(keys, return_inverse=True)
+    counts = np.bincount(cell, minlength=len(cell_keys))
+    num_codes = codes.max() + 1 if len(codes) else 1
+    code_counts = np.bincount(cell * num_codes + codes, minlength=len(cell_keys) * num_codes)
+    return pd.DataFrame(
+        {
+            "lat": np.bincount(cell, weights=lat) / counts,
+            "lon": np.bincount(cell, weights=lon) / counts,
+            "count": counts,
+            "code": code_counts.reshape(len(cell_keys), num_codes).argmax(axis=1),
+        }
+    )
+
+class ArrayLayer(MacroElement):
+    """
+    Leaflet layer of circle markers drawn in the browser from one compact array of [lat, lon, count, radius, code] rows, used for the aggregated cells
+
+    Args:
+    cells: dataframe from grid_aggregate
+    palette: list of colors of the codes
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var palette = {{ this.palette|tojson }};
+                var data = {{ this.data|tojson }};
+                var layer = L.layerGroup();
+                for (var i = 0; i < data.length; i++) {
+                    var row = data[i];
+                    L.circleMarker([row[0], row[1]], {radius: row[3], color: palette[row[4]], weight: 1, fillOpacity: 0.6})
+                        .bindTooltip(row[2] + " WWTPs")
+                        .addTo(layer);
+                }
+                return layer;
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, cells, palette):
+        super().__init__()
+        self._name = "ArrayLayer"
+        radius = np.clip(3 * np.sqrt(cells["count"].to_numpy()), 4, 30).round(1)
+        self.data = list(
+            zip(
+                cells["lat"].round(COORDINATE_DECIMALS).tolist(),
+                cells["lon"].round(COORDINATE_DECIMALS).tolist(),
+                cells["count"].tolist(),
+                radius.tolist(),
+                cells["code"].tolist(),
+            )
+        )
+        self.palette = palette
+
+class ZoomLayers(MacroElement):
+    """
+    Shows every layer only within its range of zoom levels, so the map switches from aggregated cells to clustered points while zooming in
+
+    Args:
+    levels: list of tuples (layer, first zoom level, first zoom level after the range)
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            (function(){
+                var map = {{ this._parent.get_name() }};
+                var levels = [
+                    {%- for layer, min_zoom, max_zoom in this.levels %}
+                    [{{ layer.get_name() }}, {{ min_zoom }}, {{ max_zoom }}],
+                    {%- endfor %}
+                ];
+                function update() {
+                    var zoom = map.getZoom();
+                    levels.forEach(function(level) {
+                        var visible = zoom >= level[1] && zoom < level[2];
+                        if (visible && !map.hasLayer(level[0])) { map.addLayer(level[0]); }
+                        if (!visible && map.hasLayer(level[0])) { map.removeLayer(level[0]); }
+                    });
+                }
+                map.on("zoomend", update);
+                update();
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, levels):
+        super().__init__()
+        self._name = "ZoomLayers"
+        self.levels = levels
+
+class Legend(MacroElement):
+    """
+    Legend of the point colors in the corner of the map
+
+    Args:
+    title: title of the legend
+    palette: list of colors
+    labels: list of the labels of the colors
+    """
+    _template = Template(
+        """
+        {% macro html(this, kwargs) %}
+            <div style="position: fixed; bottom: 30px; left: 30px; z-index: 1000; background: white; padding: 6px 10px; border: 1px solid grey; font-size: 12px;">
+                <b>{{ this.title }}</b><br>
+                {%- for color, label in this.entries %}
+                <span style="display: inline-block; width: 10px; height: 10px; border-radius: 5px; background: {{ color }};"></span> {{ label }}<br>
+                {%- endfor %}
+            </div>
+        {% endmacro %}"""
+    )
+
+    def __init__(self, title, palette, labels):
+        super().__init__()
+        self._name = "Legend"
+        self.title = title
+        self.entries = list(zip(palette, labels))
+
+def point_map(lat, lon, color_values=None, names=None, legend_title="", aggregate_zooms=AGGREGATE_ZOOMS, points_zoom=POINTS_ZOOM):
+    """
+    Creates an interactive map of many points. The points are embedded as one compact array and clustered in the browser, and for the lower zoom levels pre-aggregated grid layers are shown instead, so nationwide maps stay small and open quickly.
+
+    Args:
+    lat: array-like of latitudes
+    lon: array-like of longitudes
+    color_values: optional array-like of categories (e.g. source or label) or probabilities between 0 and 1 to color the points by
+    names: optional array-like of the names shown when hovering over a point
+    legend_title: title of the legend of the colors
+    aggregate_zooms: first zoom level of every aggregated layer, no aggregated layers if empty
+    points_zoom: zoom level from which the clustered points are shown, if there are aggregated layers
+
+    Returns:
+    m: folium map
+    """
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if color_values is None:
+        codes, palette, labels = np.zeros(len(lat), dtype=np.int64), [PALETTE[0]], []
+    else:
+        codes, palette, labels = color_codes(color_values)
+
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    lat, lon, codes = lat[valid], lon[valid], codes[valid]
+
+    m = folium.Map(zoom_start=6)
+    if len(lat):
+        m.fit_bounds([[lat.min(), lon.min()], [lat.max(), lon.max()]])
+
+    # One array of [lat, lon, color code(, name)] rows for all points
+    columns = [np.round(lat, COORDINATE_DECIMALS).tolist(), np.round(lon, COORDINATE_DECIMALS).tolist(), codes.tolist()]
+    if names is not None:
+        columns.append(pd.Series(names).reset_index(drop=True)[valid].astype(str).tolist())
+    callback = """function (row) {
+        var palette = %s;
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 5, color: palette[row[2]], weight: 1, fillOpacity: 0.8});
+        if (row.length > 3) { marker.bindTooltip(row[3]); }
+        return marker;
+    }""" % json.dumps(palette)
+    points = FastMarkerCluster(list(zip(*columns)), callback=callback, name="WWTPs")
+    m.add_child(points)
+
+    if len(aggregate_zooms) and len(lat):
+        levels = []
+        bounds = list(aggregate_zooms) + [points_zoom]
+        for min_zoom, max_zoom in zip(bounds[:-1], bounds[1:]):
+            # Cells of about a quarter of the width of a map tile at the first zoom level of the layer
+            layer = ArrayLayer(grid_aggregate(lat, lon, codes, 360 / 2 ** (min_zoom + 2)), palette)
+            m.add_child(layer)
+            levels.append((layer, min_zoom if levels else 0, max_zoom))
+        levels.append((points, points_zoom, 99))
+        m.add_child(ZoomLayers(levels))
+
+    if labels:
+        m.add_child(Legend(legend_title, palette, labels))
+    return m
@@ -0,0 +1,228 @@
+import concurrent.futures
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.errors import WindowError
+from src import utils_entity_resolution, utils_nearest, utils_raster
+
+# The service population of the canonical facilities is stored next to the source data
+SERVICE_POPULATION_PATH = "../00_source_data/facility_population.parquet"
+POPULATION_RASTER_PATH = "../00_source_data/us/usa_ppp_2020_1km_Aggregated.tif"
+
+# Radii in km around every WWTP, and number of WWTPs per chunk of work
+RADII = (1, 5, 10)
+CHUNK_SIZE = 1000
+
+# Maximum area in square degrees of the bounding box of the WWTPs of a chunk, so a chunk crossing a jump of the Z-order curve doesn't read a large part of the raster
+MAX_CHUNK_AREA = 25.0
+
+KM_PER_DEGREE = utils_nearest.EARTH_RADIUS_KM * np.pi / 180
+
+def morton_order(lon, lat, bits=16):
+    """
+    Sorts points along a Z-order curve, so consecutive points are close to each other and every chunk of the sorted points covers a small area
+
+    Args:
+    lon: numpy array of longitudes
+    lat: numpy array of latitudes
+    bits: number of bits of the quantized coordinates
+
+    Returns:
+    order: numpy array of the point indices in Z-order
+    """
+    def spread(v):
+        # Inserts a zero bit after every bit of the quantized coordinate
+        v = v.astype(np.uint64)
+        for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)):
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+
+    scale = 2**bits - 1
+    x = np.round((lon - lon.min()) / max(np.ptp(lon), 1e-12) * scale)
+    y = np.round((lat - lat.min()) / max(np.ptp(lat), 1e-12) * scale)
+    return np.argsort(spread(x) | (spread(y) << np.uint64(1)), kind="stable")
+
+def spatial_chunks(lon, lat, order, chunk_size=CHUNK_SIZE, max_area=MAX_CHUNK_AREA):
+    """
+    Splits points sorted along a Z-order curve into chunks of at most chunk_size points whose bounding box covers at most max_area square degrees
+
+    Args:
+    lon: numpy array of longitudes
+    lat: numpy array of latitudes
+    order: numpy array of the point indices in Z-order, from morton_order
+    chunk_size: maximum number of points per chunk
+    max_area: maximum area of the bounding box of a chunk in square degrees
+
+    Returns:
+    chunks: list of numpy arrays of point indices
+    """
+    chunks = []
+    start = 0
+    xmin = ymin = np.inf
+    xmax = ymax = -np.inf
+    for i, (x, y) in enumerate(zip(lon[order].tolist(), lat[order].tolist())):
+        x_low, x_high, y_low, y_high = min(xmin, x), max(xmax, x), min(ymin, y), max(ymax, y)
+        if i > start and (i - start >= chunk_size or (x_high - x_low) * (y_high - y_low) > max_area):
+            chunks.append(order[start:i])
+            start = i
+            x_low = x_high = x
+            y_low = y_high = y
+        xmin, xmax, ymin, ymax = x_low, x_high, y_low, y_high
+    if start < len(order):
+        chunks.append(order[start:])
+    return chunks
+
+def stat_columns(radii):
+    """
+    Returns the names of the statistics columns, pop_{sum, mean, max}_{radius}km for every radius
+    """
+    return [f"pop_{stat}_{radius:g}km" for radius in radii for stat in ("sum", "mean", "max")]
+
+def chunk_stats(raster_path, lon, lat, radii=RADII, band=1):
+    """
+    Computes the population statistics around a chunk of nearby WWTPs. Only the window of the raster covering the chunk and the largest radius is read. A pixel belongs to the area of a WWTP if its center is within the radius; the statistics are missing for radii without any pixel of the raster, e.g. for WWTPs outside the raster.
+
+    Args:
+    raster_path: path of the population raster in geographic coordinates
+    lon: numpy array of the WWTP longitudes
+    lat: numpy array of the WWTP latitudes
+    radii: radii in km
+    band: band number
+
+    Returns:
+    stats: numpy array of shape (number of WWTPs, 3 * number of radii) with sum, mean and max for every radius, in the order of stat_columns
+    """
+    stats = np.full((len(lon), 3 * len(radii)), np.nan)
+    max_radius = max(radii)
+    cos_lat = np.cos(np.radians(np.minimum(np.abs(lat) + max_radius / KM_PER_DEGREE, 89.9)))
+    dlon = max_radius / (KM_PER_DEGREE * cos_lat)
+    dlat = max_radius / KM_PER_DEGREE
+
+    with rasterio.open(raster_path) as src:
+        if src.crs is not None and not src.crs.is_geographic:
+            raise ValueError(f"{raster_path} is not in geographic coordinates")
+        bounds = ((lon - dlon).min(), lat.min() - dlat, (lon + dlon).max(), lat.max() + dlat)
+        try:
+            window = utils_raster.extent_window(src, bounds, bounds_crs=None)
+        except WindowError:
+            # The chunk is outside the raster
+            return stats
+        data = src.read(band, window=window, masked=True).astype(float).filled(np.nan)
+        transform = src.window_transform(window)
+
+    # Pixel center coordinates of the window
+    x_centers = transform.c + (np.arange(data.shape[1]) + 0.5) * transform.a
+    y_centers = transform.f + (np.arange(data.shape[0]) + 0.5) * transform.e
+    col_start = np.floor((lon - dlon - transform.c) / transform.a).astype(int)
+    col_end = np.ceil((lon + dlon - transform.c) / transform.a).astype(int)
+    row_start = np.floor((lat + dlat - transform.f) / transform.e).astype(int)
+    row_end = np.ceil((lat - dlat - transform.f) / transform.e).astype(int)
+
+    for i in range(len(lon)):
+        rows = slice(max(row_start[i], 0), max(min(row_end[i], data.shape[0]), 0))
+        cols = slice(max(col_start[i], 0), max(min(col_end[i], data.shape[1]), 0))
+        values = data[rows, cols]
+        if values.size == 0:
+            # The area of the WWTP is outside the raster, like for chunks outside the raster
+            continue
+        distance = utils_nearest.haversine_distance(lon[i], lat[i], x_centers[None, cols], y_centers[rows, None])
+        valid = ~np.isnan(values)
+        for j, radius in enumerate(radii):
+            within = distance <= radius
+            if not within.any():
+                # No pixel of the raster is within the radius
+                continue
+            inside = values[valid & within]
+            stats[i, 3 * j] = inside.sum()
+            if len(inside):
+                stats[i, 3 * j + 1] = inside.mean()
+                stats[i, 3 * j + 2] = inside.max()
+
+    return stats
+
+def zonal_stats(lon, lat, raster_path=POPULATION_RASTER_PATH, radii=RADII, chunk_size=CHUNK_SIZE, num_workers=4, band=1, max_chunk_area=MAX_CHUNK_AREA):
+    """
+    Computes the population within every radius around every WWTP (sum, mean and max of the pixels) straight from the raster. The WWTPs are sorted along a Z-order curve and split into chunks of nearby plants, bounded in number and in area, every chunk reads only its window of the raster, and the chunks are processed in parallel worker processes, so the national grid is never loaded.
+
+    Args:
+    lon: array-like of the WWTP longitudes
+    lat: array-like of the WWTP latitudes
+    raster_path: path of the population raster in geographic coordinates
+    radii: radii in km
+    chunk_size: number of WWTPs per chunk
+    num_workers: number of worker processes, the chunks are processed in this process if 1
+    band: band number
+    max_chunk_area: maximum area of the bounding box of the WWTPs of a chunk in square degrees
+
+    Returns:
+    stats: dataframe with one row per WWTP in the given order and the columns of stat_columns, missing for WWTPs with missing coordinates
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    radii = tuple(radii)
+    stats = np.full((len(lon), 3 * len(radii)), np.nan)
+
+    valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+    order = valid[morton_order(lon[valid], lat[valid])] if len(valid) else valid
+    chunks = spatial_chunks(lon, lat, order, chunk_size, max_chunk_area)
+    args = (
+        [raster_path] * len(chunks),
+        [lon[chunk] for chunk in chunks],
+        [lat[chunk] for chunk in chunks],
+        [radii] * len(chunks),
+        [band] * len(chunks),
+    )
+
+    if num_workers > 1 and len(chunks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(chunk_stats, *args))
+    else:
+        results = list(map(chunk_stats, *args))
+
+    for chunk, result in zip(chunks, results):
+        stats[chunk] = result
+    return pd.DataFrame(stats, columns=stat_columns(radii))
+
+def facility_population(facilities, raster_path=POPULATION_RASTER_PATH, radii=RADII, chunk_size=CHUNK_SIZE, num_workers=4):
+    """
+    Computes the service population table of the canonical facilities of all sources
+
+    Args:
+    facilities: dataframe of canonical facilities with columns facility_id, lon and lat
+    raster_path: path of the population raster in geographic coordinates
+    radii: radii in km
+    chunk_size: number of WWTPs per chunk
+    num_workers: number of worker processes
+
+    Returns:
+    population: dataframe with one row per facility and columns facility_id and the columns of stat_columns
+    """
+    stats = zonal_stats(facilities["lon"], facilities["lat"], raster_path, radii, chunk_size, num_workers)
+    stats.insert(0, "facility_id", facilities["facility_id"].to_numpy())
+    return stats
+
+def main():
+    """
+    Computes the service population of the canonical facilities from the command line
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute the population around every WWTP from the gridded population raster")
+    parser.add_argument("--raster", default=POPULATION_RASTER_PATH, help="path of the population raster")
+    parser.add_argument("--facilities", default=utils_entity_resolution.FACILITIES_PATH, help="path of the canonical facilities")
+    parser.add_argument("--output", default=SERVICE_POPULATION_PATH, help="path of the output Parquet file")
+    parser.add_argument("--radii", type=float, nargs="+", default=list(RADII), help="radii in km")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="number of WWTPs per chunk")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    args = parser.parse_args()
+
+    facilities = utils_entity_resolution.read_facilities(args.facilities)
+    population = facility_population(facilities, args.raster, args.radii, args.chunk_size, args.workers)
+    part_output = f"{args.output}.{os.getpid()}.part"
+    population.to_parquet(part_output, index=False)
+    os.replace(part_output, args.output)
+    print(f"Wrote the population around {len(population)} facilities to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from src import utils_entity_resolution
+
+KM_PER_DEGREE_LON = 111.32 * np.cos(np.radians(40))
+
+def make_points(records):
+    # records: list of (source, km east of the origin)
+    return pd.DataFrame(
+        {
+            "source": [source for source, _ in records],
+            "source_row": np.arange(len(records)),
+            "name": [f"{source}_{i}" for i, (source, _) in enumerate(records)],
+            "lon": [-100 + km / KM_PER_DEGREE_LON for _, km in records],
+            "lat": 40.0,
+            "state": "Kansas",
+        }
+    )
+
+def test_records_of_different_sources_are_merged():
+    points = make_points([("osm", 0.0), ("epa", 0.3), ("hw", 0.5), ("osm", 5.0)])
+    labels = utils_entity_resolution.cluster_points(points, radius=1.0)
+    assert labels.tolist() == [0, 0, 0, 3]
+
+def test_distinct_plants_of_one_source_are_not_chained():
+    # An EPA record between two OSM plants 1.6 km apart is within the radius of both, but must not merge them
+    points = make_points([("osm", 0.0), ("epa", 0.7), ("osm", 1.6), ("hw", 1.7)])
+    labels = utils_entity_resolution.cluster_points(points, radius=1.0)
+    assert labels.tolist() == [0, 0, 2, 2]
+
+    facilities, _ = utils_entity_resolution.canonical_facilities(points, labels)
+    assert len(facilities) == 2
+    assert (facilities["num_osm"] == 1).all()
+
+def test_link_same_source_chains_plants():
+    points = make_points([("osm", 0.0), ("epa", 0.7), ("osm", 1.6)])
+    labels = utils_entity_resolution.cluster_points(points, radius=1.0, link_same_source=True)
+    assert labels.tolist() == [0, 0, 0]